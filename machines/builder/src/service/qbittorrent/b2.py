@@ -0,0 +1,323 @@
+"""Resumable large-file uploads through the native B2 API.
+
+rclone uploads big files as B2 large files too, but keeps the session
+in memory only: if the upload service is stopped halfway through a
+50 GB remux, the next run starts again from byte zero and the abandoned
+session stays in the bucket.
+
+upload_large_file records the session (file ID, part size) and the SHA1
+of every finished part in the state database (see state.py). A later
+run with the same file (same device, inode, size and mtime) asks B2
+which parts it has, skips those whose SHA1 matches the recorded one and
+uploads the rest. The file info matches what rclone writes
+(src_last_modified_millis, large_file_sha1), so rclone and the cached
+bucket listing see the same modification time and SHA1 as for files
+rclone uploaded itself.
+
+cancel_abandoned cancels sessions nothing will resume: recorded ones
+whose file changed or disappeared, and unfinished large files in the
+bucket that aren't recorded at all (e.g. from an interrupted rclone).
+
+Credentials are the rclone ones (RCLONE_CONFIG_B2_ACCOUNT/KEY).
+"""
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+from state import file_key
+
+AUTH_URL = "https://api.backblazeb2.com/b2api/v2/b2_authorize_account"
+
+# B2 recommends 100 MB parts; at most 10,000 parts per file
+PART_SIZE = 100 * 1000 * 1000
+MAX_PARTS = 10_000
+
+# Files at least this big are uploaded as resumable large files
+LARGE_FILE_MIN = 1000 * 1000 * 1000
+
+# Unrecorded unfinished large files younger than this may belong to a
+# running rclone and are left alone
+ABANDONED_AGE = 24 * 3600
+
+
+class B2Error(Exception):
+    """A B2 API call failed."""
+
+    def __init__(self, message, status=None, code=None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+
+def _request(req, timeout):
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        # B2 reports errors as JSON with status, code and message
+        try:
+            body = json.loads(e.read())
+        except (json.JSONDecodeError, OSError):
+            body = {}
+        raise B2Error(
+            f"{req.full_url}: {body.get('message') or e.reason}",
+            e.code,
+            body.get("code"),
+        ) from e
+    except (urllib.error.URLError, OSError, json.JSONDecodeError) as e:
+        raise B2Error(f"{req.full_url}: {e}") from e
+
+
+class B2:
+    """Minimal B2 native API client for one bucket.
+
+    Safe to share between threads. The account authorization is renewed
+    when B2 reports it expired.
+    """
+
+    def __init__(self, account_id, key, bucket):
+        self.account_id = account_id
+        self.key = key
+        self.bucket = bucket
+        self.lock = threading.Lock()
+        self.auth = None
+        self.bucket_id = None
+
+    def authorize(self):
+        creds = base64.b64encode(f"{self.account_id}:{self.key}".encode()).decode()
+        req = urllib.request.Request(
+            AUTH_URL, headers={"Authorization": f"Basic {creds}"}
+        )
+        auth = _request(req, timeout=60)
+        with self.lock:
+            self.auth = auth
+        if self.bucket_id is None:
+            allowed = auth.get("allowed") or {}
+            if allowed.get("bucketName") == self.bucket:
+                self.bucket_id = allowed["bucketId"]
+            else:
+                reply = self.call(
+                    "b2_list_buckets",
+                    {"accountId": auth["accountId"], "bucketName": self.bucket},
+                )
+                if not reply["buckets"]:
+                    raise B2Error(f"Bucket not found: {self.bucket}")
+                self.bucket_id = reply["buckets"][0]["bucketId"]
+
+    def call(self, api, params, timeout=60):
+        """POST one API call and return its decoded JSON reply."""
+        if self.auth is None:
+            self.authorize()
+        for attempt in range(2):
+            req = urllib.request.Request(
+                f"{self.auth['apiUrl']}/b2api/v2/{api}",
+                data=json.dumps(params).encode(),
+                headers={"Authorization": self.auth["authorizationToken"]},
+                method="POST",
+            )
+            try:
+                return _request(req, timeout)
+            except B2Error as e:
+                if e.status != 401 or attempt:
+                    raise
+                # Authorization tokens expire after 24 hours
+                self.authorize()
+
+    def upload_part(self, upload, part_number, data, sha1):
+        """Upload one part to an upload URL from b2_get_upload_part_url."""
+        req = urllib.request.Request(
+            upload["uploadUrl"],
+            data=data,
+            headers={
+                "Authorization": upload["authorizationToken"],
+                "X-Bz-Part-Number": str(part_number),
+                "Content-Length": str(len(data)),
+                "X-Bz-Content-Sha1": sha1,
+            },
+            method="POST",
+        )
+        return _request(req, timeout=600)
+
+    def list_parts(self, file_id):
+        """Return {part number: SHA1} of the parts B2 has for file_id."""
+        parts = {}
+        start = 1
+        while start is not None:
+            reply = self.call(
+                "b2_list_parts",
+                {"fileId": file_id, "startPartNumber": start, "maxPartCount": 1000},
+            )
+            for part in reply["parts"]:
+                parts[part["partNumber"]] = part["contentSha1"]
+            start = reply.get("nextPartNumber")
+        return parts
+
+    def list_unfinished(self):
+        """Return every unfinished large file in the bucket."""
+        files = []
+        start = None
+        while True:
+            params = {"bucketId": self.bucket_id, "maxFileCount": 100}
+            if start:
+                params["startFileId"] = start
+            reply = self.call("b2_list_unfinished_large_files", params)
+            files.extend(reply["files"])
+            start = reply.get("nextFileId")
+            if not start:
+                return files
+
+
+def _part_size(size):
+    return max(PART_SIZE, -(-size // MAX_PARTS))
+
+
+def _read_part(path, part_number, part_size):
+    with open(path, "rb") as f:
+        f.seek((part_number - 1) * part_size)
+        return f.read(part_size)
+
+
+def upload_large_file(
+    client, state, path, name, transfers=4, throttle=None, budget=None
+):
+    """Upload file path to B2 object name, resuming a recorded session.
+
+    Parts are uploaded on up to `transfers` threads, each with its own
+    upload URL, paced by throttle (a bwlimit.Throttle) if given. With a
+    budget (upload.TransferBudget), each part holds one of its transfers
+    while it is read and sent, so the parts in memory count against the
+    same cap as rclone's transfers. Returns True on success. On failure
+    the session stays recorded and the next call continues where this
+    one stopped.
+    """
+    try:
+        st = os.stat(path)
+        session = state.large_file(path, name)
+        if session is not None:
+            file_id, part_size, recorded = session
+            try:
+                on_b2 = client.list_parts(file_id)
+            except B2Error as e:
+                if e.status != 400:
+                    raise
+                # Cancelled or finished elsewhere — start over
+                state.drop_large_file(file_id)
+                session = None
+            else:
+                done = {n: sha1 for n, sha1 in recorded.items() if on_b2.get(n) == sha1}
+                print(f"Resuming {name}: {len(done)} parts already on B2")
+        if session is None:
+            sha1 = state.sha1(path)
+            if sha1 is None or file_key(os.stat(path)) != file_key(st):
+                print(f"Upload failed: {path} changed while hashing")
+                return False
+            part_size = _part_size(st.st_size)
+            reply = client.call(
+                "b2_start_large_file",
+                {
+                    "bucketId": client.bucket_id,
+                    "fileName": name,
+                    "contentType": "b2/x-auto",
+                    "fileInfo": {
+                        "src_last_modified_millis": str(st.st_mtime_ns // 1_000_000),
+                        "large_file_sha1": sha1,
+                    },
+                },
+            )
+            file_id = reply["fileId"]
+            state.start_large_file(path, name, file_id, part_size)
+            done = {}
+
+        parts = -(-st.st_size // part_size)
+        todo = [n for n in range(1, parts + 1) if n not in done]
+        local = threading.local()
+
+        def send(part_number):
+            with budget.take(1) if budget is not None else nullcontext():
+                return send_part(part_number)
+
+        def send_part(part_number):
+            data = _read_part(path, part_number, part_size)
+            sha1 = hashlib.sha1(data).hexdigest()
+            if throttle is not None:
+                throttle.wait(len(data))
+            for attempt in range(3):
+                if getattr(local, "upload", None) is None:
+                    local.upload = client.call(
+                        "b2_get_upload_part_url", {"fileId": file_id}
+                    )
+                try:
+                    client.upload_part(local.upload, part_number, data, sha1)
+                    break
+                except B2Error:
+                    # Upload URLs can go stale (busy pod, expired token)
+                    local.upload = None
+                    if attempt == 2:
+                        raise
+                    time.sleep(2**attempt)
+            state.save_large_file_part(file_id, part_number, sha1)
+            return part_number, sha1
+
+        with ThreadPoolExecutor(max_workers=max(1, transfers)) as pool:
+            done.update(pool.map(send, todo))
+
+        if file_key(os.stat(path)) != file_key(st):
+            print(f"Upload failed: {path} changed during upload")
+            return False
+        client.call(
+            "b2_finish_large_file",
+            {
+                "fileId": file_id,
+                "partSha1Array": [done[n] for n in range(1, parts + 1)],
+            },
+        )
+    except (B2Error, OSError) as e:
+        print(f"Upload failed: {path}: {e}")
+        return False
+    state.drop_large_file(file_id)
+    return True
+
+
+def cancel_abandoned(client, state, max_age=ABANDONED_AGE):
+    """Cancel large-file sessions that will never be finished.
+
+    Returns the number of sessions cancelled.
+    """
+    keep = set()
+    stale = set()
+    for file_id, path, key in state.large_files():
+        try:
+            current = file_key(os.stat(path))
+        except OSError:
+            current = None
+        if current == key:
+            keep.add(file_id)
+        else:
+            # The file changed or is gone, so the parts can't be reused
+            stale.add(file_id)
+            state.drop_large_file(file_id)
+
+    cancelled = 0
+    now_ms = time.time() * 1000
+    for f in client.list_unfinished():
+        if f["fileId"] in keep:
+            continue
+        age_ms = now_ms - f.get("uploadTimestamp", 0)
+        if f["fileId"] not in stale and age_ms < max_age * 1000:
+            continue
+        try:
+            client.call("b2_cancel_large_file", {"fileId": f["fileId"]})
+        except B2Error as e:
+            print(f"Cannot cancel unfinished upload {f['fileName']}: {e}")
+            continue
+        print(f"Cancelled unfinished upload: {f['fileName']}")
+        cancelled += 1
+    return cancelled
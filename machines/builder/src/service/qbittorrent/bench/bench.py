@@ -0,0 +1,477 @@
+"""Benchmarks for the upload and cleanup hot paths on a synthetic library.
+
+The tests check behaviour on a handful of files; this shows how the
+tree-walking steps scale to a real library. It builds one in a temporary
+directory, laid out like builder:
+
+  completed/tv/Show.0001.S01.1080p.WEB/Show.0001.S01E01.1080p.WEB.mkv ...
+      season packs, one per torrent, hard linked by "Sonarr" into
+  arr/tv/Show 0001/Season 01/Show 0001 - S01E01 - WEB-1080p.mkv ...
+      with copied (not linked) subtitles next to some episodes
+  completed/movies/Movie.0001.2020.1080p/... -> arr/movies/Movie 0001 (2020)/...
+  completed/tv/<pack>.cross/  cross-seeds hard linking the same files again
+                              (three links per inode)
+  completed/tv/Manual.*       manual downloads not linked yet
+  completed/*.mkv             uncategorized downloads
+
+Most episodes and movies are recorded as uploaded in a fresh state
+database, some only through legacy .uploaded markers, and some records
+point at files that are gone. qBittorrent is stubbed with a torrent list
+in which most torrents are done seeding and some are missing (orphans).
+rclone is a stub on PATH that only counts its calls (none of the steps
+benchmarked should start it).
+
+Each step is then timed in the order a run does them:
+
+  open_state         legacy marker import
+  tree               walk.Tree listing of completed/ and the import dirs
+  scan_import_dir    first scan (stat + record lookup per file), then
+                     again with the directory snapshots it saved
+  link_to_import_dir linking the manual downloads
+  propagate_markers  first propagation (walks every completed/ item)
+  cleanup.scan_dir   cleanup of every torrent done seeding and every
+                     orphan, with remove_hardlinks and prune_empty_dirs
+  cleanup_orphaned_records
+
+Steps that don't change the tree run --repeat times (fastest kept).
+Besides wall time, each result has the filesystem calls the step made
+through the os module (stat, lstat, scandir, link, unlink, rmdir, ...;
+DirEntry.stat() is cached by scandir and not counted) and the step's
+phases (see phases.py).
+
+Results are printed as a table and, with --output, appended to a JSON
+lines file together with the git commit, so regressions show up across
+commits. --compare prints the change against the last result in that
+file for the same scale.
+
+  python3 bench/bench.py --scale full --output bench/results.jsonl --compare
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from unittest.mock import patch
+
+# Import the scripts from the directory above, as the tests do
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import cleanup  # noqa: E402
+import upload  # noqa: E402
+from state import UploadState, open_state  # noqa: E402
+from walk import Tree  # noqa: E402
+
+# torrents: season packs and movies; episodes: total over all season packs
+SCALES = {
+    "tiny": {"torrents": 60, "episodes": 300, "movies": 5},
+    "small": {"torrents": 200, "episodes": 5_000, "movies": 50},
+    "full": {"torrents": 2_000, "episodes": 50_000, "movies": 400},
+}
+
+# Filesystem calls counted per step
+FS_CALLS = (
+    "stat",
+    "lstat",
+    "scandir",
+    "listdir",
+    "link",
+    "unlink",
+    "remove",
+    "rmdir",
+    "mkdir",
+    "open",
+)
+
+# Share of the library in each situation, by torrent (or file) number
+CROSS_SEED_EVERY = 10  # every 10th season pack is cross-seeded
+MANUAL_EVERY = 50  # every 50th torrent is a manual download, not linked yet
+ORPHAN_EVERY = 20  # every 20th torrent was removed from qBittorrent
+SEEDING_EVERY = 3  # every 3rd torrent is still seeding
+UNRECORDED_EVERY = 10  # every 10th torrent isn't uploaded yet
+MARKER_EVERY = 25  # every 25th file is only recorded by a legacy marker
+SUBTITLE_EVERY = 4  # every 4th episode has a copied subtitle
+
+MIN_SEEDING = 340 * 3600
+
+
+@contextmanager
+def count_fs_calls():
+    """Count calls to the os module's filesystem functions in the block."""
+    counts = Counter()
+    originals = {name: getattr(os, name) for name in FS_CALLS}
+
+    def counting(name, func):
+        def wrapper(*args, **kwargs):
+            counts[name] += 1
+            return func(*args, **kwargs)
+
+        return wrapper
+
+    for name, func in originals.items():
+        setattr(os, name, counting(name, func))
+    try:
+        yield counts
+    finally:
+        for name, func in originals.items():
+            setattr(os, name, func)
+
+
+def _touch(path, data=b"x"):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+
+
+def build_library(root, torrents, episodes, movies):
+    """Create the synthetic library under root.
+
+    Returns (torrent list as cleanup.fetch_torrents returns it, files to
+    record as uploaded as [(path, dest)], files with a legacy marker).
+    """
+    completed = root / "completed"
+    arr = root / "arr"
+    now = int(time.time())
+    packs = max(1, torrents - movies)
+    per_pack = max(1, episodes // packs)
+    qbt = []
+    uploaded = []
+    markers = []
+    counter = 0
+
+    def record(n, path, dest):
+        nonlocal counter
+        counter += 1
+        if n % UNRECORDED_EVERY == UNRECORDED_EVERY - 1:
+            return
+        if counter % MARKER_EVERY == 0:
+            markers.append(path)
+        else:
+            uploaded.append((path, dest))
+
+    def add_torrent(n, content_path):
+        if n % ORPHAN_EVERY == 0:
+            return
+        seeding = n % SEEDING_EVERY == 0
+        qbt.append(
+            {
+                "hash": f"{n:040x}",
+                "content_path": str(content_path),
+                "completion_on": now - (3600 if seeding else 2 * MIN_SEEDING),
+                "uploaded": 10**12 if seeding else 0,
+                "size": 0,
+            }
+        )
+
+    for n in range(packs):
+        show, season = divmod(n, 5)
+        pack = completed / "tv" / f"Show.{show:04d}.S{season + 1:02d}.1080p.WEB"
+        if n % MANUAL_EVERY == MANUAL_EVERY - 1:
+            pack = pack.with_name(f"Manual.{pack.name}")
+        pack.mkdir(parents=True)
+        season_dir = arr / "tv" / f"Show {show:04d}" / f"Season {season + 1:02d}"
+        for e in range(per_pack):
+            tag = f"S{season + 1:02d}E{e + 1:02d}"
+            src = pack / f"Show.{show:04d}.{tag}.1080p.WEB.mkv"
+            _touch(src)
+            if pack.name.startswith("Manual."):
+                continue
+            dst = season_dir / f"Show {show:04d} - {tag} - WEB-1080p.mkv"
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            os.link(src, dst)
+            record(n, dst, dst.relative_to(arr).as_posix())
+            if e % SUBTITLE_EVERY == 0:
+                srt = dst.with_suffix(".en.srt")
+                _touch(srt)
+                record(n, srt, srt.relative_to(arr).as_posix())
+        if n % CROSS_SEED_EVERY == 0 and not pack.name.startswith("Manual."):
+            cross = pack.with_name(f"{pack.name}.cross")
+            cross.mkdir()
+            for f in pack.iterdir():
+                if f.suffix == ".mkv":
+                    os.link(f, cross / f.name)
+            add_torrent(n + torrents, cross)
+        add_torrent(n, pack)
+
+    for m in range(movies):
+        n = packs + m
+        name = f"Movie.{m:04d}.2020.1080p"
+        src = completed / "movies" / name / f"{name}.mkv"
+        _touch(src)
+        dst = arr / "movies" / f"Movie {m:04d} (2020)" / f"Movie {m:04d} (2020).mkv"
+        dst.parent.mkdir(parents=True)
+        os.link(src, dst)
+        record(n, dst, dst.relative_to(arr).as_posix())
+        add_torrent(n, src.parent)
+
+    # Uncategorized downloads, one per 100 torrents
+    for d in range(max(1, torrents // 100)):
+        item = completed / f"Download.{d:04d}.mkv"
+        _touch(item)
+        uploaded.append((item, f"downloads/{item.name}"))
+        add_torrent(2 * torrents + d, item)
+
+    for path in markers:
+        _touch(Path(f"{path}.uploaded"), b"")
+    return qbt, uploaded, markers
+
+
+def seed_state(state, uploaded, gone):
+    """Record the uploaded files, plus records whose files are gone."""
+    # Setup only: don't pay for an fsync per record
+    state.db.execute("PRAGMA synchronous=OFF")
+    for path, dest in uploaded:
+        state.mark(path, dest)
+    for path in gone:
+        path.write_bytes(b"gone")
+        state.mark(path, f"tv/{path.name}")
+        path.unlink()
+    state.db.execute("PRAGMA synchronous=FULL")
+
+
+class Bench:
+    """Times steps and collects their results."""
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = {}
+
+    def run(self, name, func, repeat=False):
+        """Time func (repeat times if repeat) and record the fastest run."""
+        runs = []
+        for _ in range(self.repeat if repeat else 1):
+            for phases in (upload.PHASES, cleanup.PHASES):
+                phases.totals, phases.started = {}, None
+            with count_fs_calls() as calls:
+                started = time.perf_counter()
+                value = func()
+                seconds = time.perf_counter() - started
+            phases = {
+                **upload.PHASES.totals,
+                **{f"cleanup.{k}": v for k, v in cleanup.PHASES.totals.items()},
+            }
+            runs.append((seconds, dict(calls), phases))
+        seconds, calls, phases = min(runs, key=lambda r: r[0])
+        self.results[name] = {
+            "seconds": round(seconds, 4),
+            "median_seconds": round(statistics.median(r[0] for r in runs), 4),
+            "runs": len(runs),
+            "fs_calls": calls,
+            "phases": {
+                k: {"seconds": round(v[0], 4), "calls": v[1], "entries": v[2]}
+                for k, v in phases.items()
+            },
+        }
+        return value
+
+
+def run_benchmarks(root, scale, repeat=3):
+    """Build the library under root and time every step. Returns the results."""
+    completed = root / "completed"
+    arr = root / "arr"
+    subdirs = ["movies", "tv"]
+    import_dirs = [str(arr / subdir) for subdir in subdirs]
+    category_dirs = {str(completed / subdir) for subdir in subdirs}
+
+    started = time.perf_counter()
+    torrents, uploaded, _ = build_library(root, **scale)
+    state_db = root / "upload-state.db"
+    state = UploadState(state_db)
+    gone = [root / "gone" / f"old.{i}.mkv" for i in range(len(uploaded) // 50)]
+    (root / "gone").mkdir()
+    seed_state(state, uploaded, gone)
+    state.close()
+    setup = time.perf_counter() - started
+
+    # Stub rclone: count invocations, succeed without doing anything
+    bin_dir = root / "bin"
+    bin_dir.mkdir()
+    rclone_log = root / "rclone-calls"
+    stub = bin_dir / "rclone"
+    stub.write_text(f'#!/bin/sh\necho "$@" >> "{rclone_log}"\n')
+    stub.chmod(0o755)
+
+    bench = Bench(repeat)
+    env = {"PATH": f"{bin_dir}:{os.environ.get('PATH', '')}"}
+    with (
+        patch.dict(os.environ, env),
+        patch("upload.RC_URL", None),
+        patch("upload.MOUNT_RC_URL", None),
+        patch("cleanup.remove_torrent", return_value=True),
+        patch("builtins.print"),
+    ):
+        state = bench.run(
+            "open_state",
+            lambda: open_state(state_db, str(completed), str(arr), subdirs),
+        )
+        tree_roots = [str(completed)] + import_dirs
+        bench.run("tree", lambda: Tree(tree_roots), repeat=True)
+
+        def scan():
+            tree = Tree(tree_roots)
+            pending = []
+            for subdir in subdirs:
+                upload.scan_import_dir(
+                    arr / subdir, f"{subdir}/", "b2:bench", "", state, pending, tree
+                )
+            return pending
+
+        pending = bench.run("scan_import_dir", scan)
+        bench.run("scan_import_dir (snapshots)", scan, repeat=True)
+        bench.run(
+            "link_to_import_dir",
+            lambda: upload.link_to_import_dir(
+                str(completed), str(arr), subdirs, state, Tree(tree_roots)
+            ),
+        )
+        bench.run(
+            "propagate_markers",
+            lambda: upload.propagate_markers(
+                str(completed), str(arr), subdirs, state, Tree(tree_roots)
+            ),
+        )
+
+        stats = {"cleaned": 0, "seeding": 0, "skipped": 0}
+
+        def clean():
+            tree = Tree(tree_roots)
+            now = int(time.time())
+            for directory, skip in [(str(completed), category_dirs)] + [
+                (str(completed / subdir), set()) for subdir in subdirs
+            ]:
+                cleanup.scan_dir(
+                    directory,
+                    torrents,
+                    "http://qbittorrent.invalid",
+                    now,
+                    MIN_SEEDING,
+                    2048,
+                    import_dirs,
+                    skip,
+                    stats,
+                    state,
+                    tree,
+                )
+            return tree
+
+        tree = bench.run("cleanup.scan_dir", clean)
+        bench.run(
+            "cleanup_orphaned_records",
+            lambda: cleanup.cleanup_orphaned_records(state, tree),
+        )
+        state.close()
+
+    rclone_calls = (
+        len(rclone_log.read_text().splitlines()) if rclone_log.exists() else 0
+    )
+    return {
+        "setup_seconds": round(setup, 2),
+        "pending": len(pending),
+        "cleanup": stats,
+        "rclone_calls": rclone_calls,
+        "steps": bench.results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=Path(__file__).resolve().parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def last_result(path, scale_name):
+    """Return the last recorded result for scale_name in path, or None."""
+    try:
+        lines = Path(path).read_text().splitlines()
+    except OSError:
+        return None
+    for line in reversed(lines):
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if record.get("scale") == scale_name:
+            return record
+    return None
+
+
+def print_results(record, previous=None):
+    print(
+        f"{record['scale']} library ({record['library']}), setup "
+        f"{record['results']['setup_seconds']}s, commit {record['commit']}"
+    )
+    print(f"{'step':30} {'seconds':>9} {'fs calls':>9}  change")
+    for name, step in record["results"]["steps"].items():
+        change = ""
+        if previous is not None:
+            before = previous["results"]["steps"].get(name)
+            if before and before["seconds"]:
+                pct = (step["seconds"] / before["seconds"] - 1) * 100
+                change = f"{pct:+.0f}% vs {previous['commit']}"
+        calls = sum(step["fs_calls"].values())
+        print(f"{name:30} {step['seconds']:9.3f} {calls:9d}  {change}")
+        phases = ", ".join(
+            f"{phase} {p['seconds']:.3f}s" for phase, p in step["phases"].items()
+        )
+        if phases:
+            print(f"  {phases}")
+    results = record["results"]
+    print(
+        f"pending {results['pending']}, cleanup {results['cleanup']}, "
+        f"rclone calls {results['rclone_calls']}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scale", choices=SCALES, default="small")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of read-only steps")
+    parser.add_argument("--output", help="append the results to this JSON lines file")
+    parser.add_argument(
+        "--compare",
+        action="store_true",
+        help="show the change against the last result in --output",
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the library")
+    args = parser.parse_args()
+
+    scale = SCALES[args.scale]
+    root = Path(tempfile.mkdtemp(prefix="qbt-bench."))
+    try:
+        results = run_benchmarks(root, scale, args.repeat)
+    finally:
+        if args.keep:
+            print(f"Library kept in {root}")
+        else:
+            subprocess.run(["rm", "-rf", str(root)])
+
+    record = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "scale": args.scale,
+        "library": scale,
+        "results": results,
+    }
+    previous = last_result(args.output, args.scale) if args.compare else None
+    print_results(record, previous)
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+"""Upload bandwidth control for the upload daemon.
+
+The upload limit is worked out every few seconds from:
+
+  - a time-of-day timetable in rclone's --bwlimit syntax, e.g.
+    "18:00,4M 23:30,off" (4 MiB/s from 18:00 until 23:30, unlimited
+    otherwise). A single rate ("8M") applies all day.
+  - qBittorrent's current upload rate (/api/v2/transfer/info): seeding
+    keeps whatever it is using, and B2 uploads get the rest of the uplink
+    (never less than a floor, so uploads don't stall completely).
+  - the B2 FUSE mount's rclone rc (core/stats): while it is transferring
+    (Jellyfin playing a cold file), uploads drop to a lower cap so the
+    player's reads don't buffer.
+
+The lowest of these wins. It is one budget for every upload running at
+once, split evenly between them (see BandwidthController.consumer):
+jobs on the upload rcd get their part through core/bwlimit, which also
+throttles transfers already running, and uploads that don't go through
+the rcd (b2.py large files, streamed zip members) get theirs from one
+Throttle they all pace their bytes with. A plain rclone process (no
+rcd) gets an equal part with --bwlimit at start and keeps it, so
+processes started later only share what it left; the service always
+runs the rcd.
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+import urllib.error
+import urllib.request
+
+from rc import RcError, rc_call
+
+UNITS = {"": 1024, "B": 1, "K": 1024, "M": 1024**2, "G": 1024**3}
+
+# Least part of the limit an upload gets (rclone's --bwlimit has 1K steps)
+MIN_SHARE = 1024
+
+# Ways an upload is limited (see BandwidthController.consumer)
+CONSUMERS = ("rcd", "throttle", "process")
+
+
+def parse_rate(value):
+    """Parse an rclone-style rate ("512K", "4M", "off") to bytes/s.
+
+    A bare number is KiB/s, as for rclone --bwlimit. Returns None for
+    "off" or 0 (unlimited).
+    """
+    value = value.strip()
+    if value.lower() == "off":
+        return None
+    unit = value[-1].upper() if value[-1].isalpha() else ""
+    number = value[:-1] if unit else value
+    if unit not in UNITS:
+        raise ValueError(f"Bad rate: {value!r}")
+    rate = int(float(number) * UNITS[unit])
+    return rate or None
+
+
+def format_rate(rate):
+    """Format bytes/s for rclone core/bwlimit (inverse of parse_rate)."""
+    if rate is None:
+        return "off"
+    return f"{max(1, rate // 1024)}K"
+
+
+def parse_timetable(value):
+    """Parse "HH:MM,rate HH:MM,rate ..." into [(minute of day, rate)].
+
+    A single rate without a time applies all day.
+    """
+    table = []
+    for entry in value.split():
+        if "," not in entry:
+            table.append((0, parse_rate(entry)))
+            continue
+        at, rate = entry.split(",", 1)
+        hours, minutes = at.split(":")
+        table.append((int(hours) * 60 + int(minutes), parse_rate(rate)))
+    return sorted(table, key=lambda entry: entry[0])
+
+
+def scheduled_rate(table, minute):
+    """Return the timetable's rate at minute of day.
+
+    Each entry applies until the next one; before the first entry of the
+    day, the last one (from the previous evening) is still in effect.
+    """
+    if not table:
+        return None
+    rate = table[-1][1]
+    for start, entry_rate in table:
+        if start <= minute:
+            rate = entry_rate
+    return rate
+
+
+def _min_rate(*rates):
+    """Lowest of rates, where None means unlimited."""
+    limited = [rate for rate in rates if rate is not None]
+    return min(limited) if limited else None
+
+
+class Throttle:
+    """Token bucket pacing uploads that rclone doesn't see."""
+
+    def __init__(self):
+        self.rate = None
+        self.lock = threading.Lock()
+        self.next_free = 0.0
+
+    def wait(self, nbytes):
+        """Sleep as long as sending nbytes takes at the current rate."""
+        with self.lock:
+            if self.rate is None:
+                return
+            now = time.monotonic()
+            start = max(now, self.next_free)
+            self.next_free = start + nbytes / self.rate
+            delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class BandwidthController:
+    """Re-computes the upload limit every interval seconds and applies it.
+
+    uplink is the connection's upload capacity in bytes/s (None to ignore
+    qBittorrent), floor the least uploads get while qBittorrent is busy,
+    and mount_rate the cap while the B2 mount is transferring (None to
+    ignore the mount).
+    """
+
+    def __init__(
+        self,
+        timetable,
+        uplink,
+        floor,
+        mount_rate,
+        qbt_api_url,
+        mount_rc_url,
+        rc_url=None,
+        interval=10,
+    ):
+        self.timetable = timetable
+        self.uplink = uplink
+        self.floor = floor
+        self.mount_rate = mount_rate
+        self.qbt_api_url = qbt_api_url
+        self.mount_rc_url = mount_rc_url
+        self.rc_url = rc_url
+        self.interval = interval
+        self.throttle = Throttle()
+        # Last limit applied; False until the first poll
+        self.rate = False
+        # Part of it last sent to the rcd; False until sent
+        self.rcd_rate = False
+        # Uploads running per kind, and the bytes/s rclone processes hold
+        self.active = dict.fromkeys(CONSUMERS, 0)
+        self.reserved = 0
+        self.lock = threading.Lock()
+
+    def seeding_rate(self):
+        """qBittorrent's current upload rate in bytes/s (0 if unknown)."""
+        if not self.qbt_api_url:
+            return 0
+        try:
+            resp = urllib.request.urlopen(
+                f"{self.qbt_api_url}/transfer/info", timeout=5
+            )
+            return int(json.loads(resp.read()).get("up_info_speed", 0))
+        except (urllib.error.URLError, OSError, json.JSONDecodeError, ValueError):
+            return 0
+
+    def mount_busy(self):
+        """Check whether the B2 mount is transferring anything right now."""
+        if not self.mount_rc_url:
+            return False
+        try:
+            stats = rc_call(self.mount_rc_url, "core/stats", timeout=5)
+        except RcError:
+            return False
+        return bool(stats.get("transferring"))
+
+    def target(self, minute, seeding, mount_busy):
+        """Work out the upload limit (bytes/s, None for unlimited)."""
+        rate = scheduled_rate(self.timetable, minute)
+        if self.uplink is not None:
+            rate = _min_rate(rate, max(self.floor, self.uplink - seeding))
+        if mount_busy:
+            rate = _min_rate(rate, self.mount_rate)
+        return rate
+
+    def split(self, rate):
+        """Return the (rcd, Throttle) parts of rate for the running uploads.
+
+        What rclone processes don't hold is split between the uploads on
+        the rcd and those paced by the Throttle, by their numbers. A kind
+        with nothing running may use all of it: its first upload splits
+        it again before sending anything.
+        """
+        if rate is None:
+            return None, None
+        left = max(MIN_SHARE, rate - self.reserved)
+        shared = self.active["rcd"] + self.active["throttle"]
+
+        def part(kind):
+            n = self.active[kind]
+            return max(MIN_SHARE, left * n // shared) if n else left
+
+        return part("rcd"), part("throttle")
+
+    def _apply(self, rate):
+        """Apply rate's parts (see split); False if the rcd can't be set."""
+        rcd_rate, throttle_rate = self.split(rate)
+        if self.rc_url and rcd_rate != self.rcd_rate:
+            try:
+                rc_call(self.rc_url, "core/bwlimit", {"rate": format_rate(rcd_rate)})
+            except RcError as e:
+                print(f"Cannot set upload bandwidth limit: {e}")
+                return False
+            self.rcd_rate = rcd_rate
+        self.throttle.rate = throttle_rate
+        return True
+
+    def poll(self):
+        """Compute the current limit and apply it if it changed."""
+        now = time.localtime()
+        rate = self.target(
+            now.tm_hour * 60 + now.tm_min, self.seeding_rate(), self.mount_busy()
+        )
+        with self.lock:
+            # Also retries an rcd update a consumer change couldn't send
+            if not self._apply(rate):
+                return
+            changed = rate != self.rate
+            self.rate = rate
+        if changed:
+            print(f"Upload bandwidth limit: {format_rate(rate)}")
+
+    @contextmanager
+    def consumer(self, kind):
+        """Count the with-block as one upload sharing the limit.
+
+        kind is "rcd" (a job on the upload rcd), "throttle" (bytes paced
+        with self.throttle) or "process" (an rclone process of its own).
+        A process is given an equal part of what the others don't hold,
+        yielded as its --bwlimit, and keeps it until it ends; the others
+        yield None, and their parts follow every change (see split).
+        """
+        with self.lock:
+            self.active[kind] += 1
+            held = 0
+            rate = self.rate or None
+            if kind == "process" and rate is not None:
+                others = self.active["rcd"] + self.active["throttle"]
+                held = max(MIN_SHARE, (rate - self.reserved) // (others + 1))
+                self.reserved += held
+            if self.rate is not False:
+                self._apply(rate)
+        try:
+            yield format_rate(held or None) if kind == "process" else None
+        finally:
+            with self.lock:
+                self.active[kind] -= 1
+                self.reserved -= held
+                if self.rate is not False:
+                    self._apply(self.rate or None)
+
+    def start(self):
+        """Poll in a background thread for as long as the process runs."""
+
+        def loop():
+            while True:
+                self.poll()
+                time.sleep(self.interval)
+
+        threading.Thread(target=loop, name="bwlimit", daemon=True).start()
@@ -6,7 +6,10 @@ and seeded for >= MIN_SEEDING_HOURS with avg upload rate < MIN_AVG_RATE:
   - Deletes files from completed/ (the seeding copy)
   - Finds and deletes hard links from import directories by inode
   - Prunes empty directories left behind
-  - Cleans up orphaned .uploaded markers
+  - Drops upload records for files that no longer exist
+
+Upload status is read from the state database shared with upload.py
+(see state.py).
 
 Triggered by qbt-cleanup.timer every 10 minutes.
 
@@ -17,6 +20,8 @@ Environment variables:
   MIN_SEEDING_HOURS  - minimum hours to seed before considering removal
   MIN_AVG_RATE       - minimum avg upload rate in bytes/sec to keep seeding
   CATEGORIES         - comma-separated name:subdir pairs
+  STATE_DB           - path to the upload state database (SQLite)
+  PROFILE_FILE       - (optional) write a cProfile dump of the run here
 """
 
 import json
@@ -29,6 +34,13 @@ import urllib.parse
 import urllib.request
 from pathlib import Path
 
+from phases import Phases, profiled
+from state import open_state
+from walk import Tree
+
+# Time, entries and bytes per phase of the run, printed at the end
+PHASES = Phases()
+
 
 def parse_categories(env_value):
     """Parse CATEGORIES env var into a dict.
@@ -46,6 +58,7 @@ def parse_categories(env_value):
     return result
 
 
+@PHASES.timed("torrents")
 def fetch_torrents(api_url):
     """Fetch all torrents from qBittorrent API.
 
@@ -90,6 +103,7 @@ def find_torrent_by_path(torrents, content_path):
     return None
 
 
+@PHASES.timed("torrents")
 def remove_torrent(api_url, torrent_hash):
     """Remove a torrent from qBittorrent (keeps files on disk).
 
@@ -113,86 +127,92 @@ def remove_torrent(api_url, torrent_hash):
         return False
 
 
-def collect_inodes(item):
+def collect_inodes(item, tree=None):
     """Collect inode numbers for all files in item (file or directory)."""
-    item = Path(item)
+    if tree is None:
+        tree = Tree([item])
     inodes = set()
-    if item.is_file():
-        try:
-            inodes.add(os.stat(item).st_ino)
-        except OSError:
-            pass
-    elif item.is_dir():
-        for f in item.rglob("*"):
-            if f.is_file():
-                try:
-                    inodes.add(os.stat(f).st_ino)
-                except OSError:
-                    continue
+    for f in tree.files(item):
+        st = tree.stat(f)
+        if st is not None:
+            inodes.add(st.st_ino)
     return inodes
 
 
-def remove_hardlinks(item, import_dirs):
+@PHASES.timed("hardlinks")
+def remove_hardlinks(item, import_dirs, state, tree=None):
     """Remove hard links in import directories that share inodes with item.
 
     When we delete from completed/, hard links in import dirs would keep
     the data alive (link count drops from 2 to 1). We explicitly find
     and delete them by inode number.
 
-    Also cleans up associated files (subtitles, metadata, .uploaded markers)
-    that share the same name stem as deleted files. Radarr may copy these
-    instead of hard-linking, giving them different inodes that the
-    inode-based pass misses.
+    Also cleans up associated files (subtitles, metadata, leftover
+    .uploaded markers) that share the same name stem as deleted files.
+    Radarr may copy these instead of hard-linking, giving them different
+    inodes that the inode-based pass misses. Upload records for every
+    deleted file are dropped from the state.
+
+    tree (a walk.Tree covering item and import_dirs) is shared across
+    items in a run so the import dirs are listed and stat'ed only once;
+    deletions are recorded in it.
     """
-    inodes = collect_inodes(item)
+    if tree is None:
+        tree = Tree([item] + list(import_dirs))
+    inodes = collect_inodes(item, tree)
     if not inodes:
         return
 
     # First pass: delete files by inode match, track what was deleted
     deleted_files = []
     for import_dir in import_dirs:
-        import_path = Path(import_dir)
-        if not import_path.exists():
-            continue
-        for f in import_path.rglob("*"):
-            if f.is_file():
-                try:
-                    if os.stat(f).st_ino in inodes:
-                        deleted_files.append(f)
-                        f.unlink()
-                except OSError:
-                    continue
+        for f in tree.files(import_dir):
+            st = tree.stat(f)
+            if st is None or st.st_ino not in inodes:
+                continue
+            deleted_files.append(Path(f))
+            try:
+                os.unlink(f)
+            except OSError:
+                continue
+            tree.remove(f)
 
     # Second pass: clean up sibling files that share the same name stem
-    # as deleted files (e.g. subtitles, .nfo, .uploaded markers)
+    # as deleted files (e.g. subtitles, .nfo, leftover .uploaded markers)
+    deleted_siblings = []
     for deleted in deleted_files:
         stem = deleted.stem
-        parent = deleted.parent
-        if not parent.exists():
-            continue
-        for sibling in list(parent.iterdir()):
-            if sibling.is_file() and sibling.name.startswith(stem):
+        for sibling in tree.listdir(deleted.parent) or []:
+            if tree.is_file(sibling) and Path(sibling).name.startswith(stem):
                 try:
-                    sibling.unlink()
+                    os.unlink(sibling)
                 except OSError:
                     continue
+                tree.remove(sibling)
+                deleted_siblings.append(Path(sibling))
+
+    for deleted in deleted_files + deleted_siblings:
+        state.forget(deleted)
+    PHASES.count("hardlinks", entries=len(deleted_files) + len(deleted_siblings))
 
-    prune_empty_dirs(import_dirs)
+    prune_empty_dirs(import_dirs, tree)
 
 
-def prune_empty_dirs(directories):
+@PHASES.timed("prune")
+def prune_empty_dirs(directories, tree=None):
     """Remove empty directories bottom-up in the given directories."""
+    if tree is None:
+        tree = Tree(directories)
     for d in directories:
-        path = Path(d)
-        if not path.exists():
-            continue
         # Walk bottom-up so child dirs are removed before parents
-        for dirpath in sorted(path.rglob("*"), reverse=True):
-            if dirpath.is_dir():
-                try:
-                    dirpath.rmdir()  # Only succeeds if empty
-                except OSError:
-                    pass
+        for dirpath in sorted(tree.dirs(d), reverse=True):
+            if tree.listdir(dirpath):
+                continue
+            try:
+                os.rmdir(dirpath)  # Only succeeds if empty
+            except OSError:
+                continue
+            tree.remove(dirpath)
 
 
 def should_keep_seeding(torrent, now, min_age, min_avg_rate):
@@ -215,16 +235,18 @@ def should_keep_seeding(torrent, now, min_age, min_avg_rate):
     return False, None
 
 
-def cleanup_orphaned_markers(import_dirs):
-    """Remove .uploaded markers in import dirs with no corresponding file."""
-    for import_dir in import_dirs:
-        path = Path(import_dir)
-        if not path.exists():
-            continue
-        for marker in path.rglob("*.uploaded"):
-            source = marker.with_suffix("")
-            if not source.exists():
-                marker.unlink(missing_ok=True)
+@PHASES.timed("records")
+def cleanup_orphaned_records(state, tree=None):
+    """Drop upload records whose file no longer exists.
+
+    Catches files removed outside cleanup (e.g. Sonarr/Radarr deleting the
+    old file on a quality upgrade). With a tree, existence is answered from
+    the run's listing instead of one lstat per record. Returns the number
+    of records dropped.
+    """
+    if tree is None:
+        return state.prune_missing()
+    return state.prune_missing(tree.exists)
 
 
 def scan_dir(
@@ -237,26 +259,29 @@ def scan_dir(
     import_dirs,
     category_dirs,
     stats,
+    state,
+    tree=None,
 ):
     """Process items in a directory for cleanup.
 
     Checks each item's upload status and seeding metrics, removes
     torrents and files when ready, and cleans up hard links.
     """
-    directory = Path(directory)
-    if not directory.exists():
+    if tree is None:
+        tree = Tree([directory] + list(import_dirs))
+    children = tree.listdir(directory)
+    if children is None:
         return
 
-    for item in sorted(directory.iterdir()):
-        if item.name.endswith(".uploaded"):
-            continue
-
+    for child in children:
         # Skip category subdirectories when scanning top-level completed/
-        if item.is_dir() and str(item) in category_dirs:
+        if child in category_dirs:
             continue
+        item = Path(child)
 
         # Never delete files that haven't been uploaded to B2 yet
-        if not Path(f"{item}.uploaded").exists():
+        st = tree.stat(item)
+        if st is None or not state.is_uploaded_stat(st):
             print(f"Skipping (not yet uploaded): {item.name}")
             stats["skipped"] += 1
             continue
@@ -284,14 +309,20 @@ def scan_dir(
             print(f"Cleaning orphan: {item.name}")
 
         # Remove hard links in import directories before deleting source
-        remove_hardlinks(item, import_dirs)
+        remove_hardlinks(item, import_dirs, state, tree)
 
-        # Delete the item and its upload marker
-        if item.is_dir():
-            shutil.rmtree(item, ignore_errors=True)
-        else:
-            item.unlink(missing_ok=True)
-        Path(f"{item}.uploaded").unlink(missing_ok=True)
+        # Delete the item and its upload records
+        with PHASES.phase("delete"):
+            size = sum(
+                st.st_size for st in map(tree.stat, tree.files(item)) if st is not None
+            )
+            if tree.is_dir(item):
+                shutil.rmtree(item, ignore_errors=True)
+            else:
+                item.unlink(missing_ok=True)
+            tree.remove(item)
+            state.forget(item)
+        PHASES.count("delete", nbytes=size)
         stats["cleaned"] += 1
 
 
@@ -302,6 +333,7 @@ def main():
     min_seeding_hours = int(os.environ["MIN_SEEDING_HOURS"])
     min_avg_rate = int(os.environ["MIN_AVG_RATE"])
     categories = parse_categories(os.environ["CATEGORIES"])
+    state_db = os.environ["STATE_DB"]
 
     min_age = min_seeding_hours * 3600
     now = int(time.time())
@@ -316,6 +348,13 @@ def main():
     category_dirs = {f"{completed_dir}/{subdir}" for subdir in subdirs}
     import_dirs = [f"{import_base}/{subdir}" for subdir in subdirs]
 
+    state = open_state(state_db, completed_dir, import_base, subdirs)
+
+    # One listing of completed/ and the import dirs, shared by every step
+    with PHASES.phase("list"):
+        tree = Tree([completed_dir] + import_dirs)
+    PHASES.count("list", entries=len(tree.entries))
+
     stats = {"cleaned": 0, "seeding": 0, "skipped": 0}
 
     # Scan uncategorized downloads and each category subdirectory
@@ -329,6 +368,8 @@ def main():
         import_dirs,
         category_dirs,
         stats,
+        state,
+        tree,
     )
     for subdir in subdirs:
         scan_dir(
@@ -341,14 +382,19 @@ def main():
             import_dirs,
             set(),
             stats,  # No category dirs to skip inside subdirs
+            state,
+            tree,
         )
 
-    cleanup_orphaned_markers(import_dirs)
+    cleanup_orphaned_records(state, tree)
+    state.close()
 
     print(
         f"Cleanup done: {stats['cleaned']} removed, {stats['seeding']} seeding, {stats['skipped']} skipped"
     )
+    PHASES.report("Cleanup run")
 
 
 if __name__ == "__main__":
-    main()
+    with profiled(os.environ.get("PROFILE_FILE")):
+        main()
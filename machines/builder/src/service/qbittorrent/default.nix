@@ -14,10 +14,18 @@
        files into /media/arr/tv/ or /media/arr/movies/ (their root folders).
        Since all services run as the same user and files are on the same
        filesystem, hard links work — zero extra disk usage.
-    4. qbt-upload-b2.timer fires every 2 minutes. The upload service scans
-       /media/arr/tv/ and /media/arr/movies/ for new files (nice names from
-       *arr) and uploads them to B2. Falls back to scanning completed/ for
-       uncategorized downloads not managed by *arr.
+    4. qbt-upload-b2 runs as a daemon watching /media/arr/tv/,
+       /media/arr/movies/ and completed/ with inotify. New files (nice names
+       from *arr) are uploaded to B2 once they've been quiet for
+       uploadDebounce seconds; uncategorized downloads in completed/ are
+       uploaded under downloads/. A full scan runs at startup and every
+       rescanInterval as a safety net. Uploaded items are recorded in the
+       upload state database (stateDb), keyed by inode. qBittorrent's
+       "run on torrent finished" hook (hook.py) tells the daemon about each
+       finished torrent over hookSocket, so it is linked (manual categories)
+       and uploaded within seconds instead of after the debounce. Sonarr
+       and Radarr post their imports, upgrades and renames to the daemon's
+       webhook listener (webhookPort) for the same reason.
      5. qBittorrent seeds indefinitely (no built-in ratio/time limits).
      6. qbt-cleanup.timer runs every 10 minutes. For items that have been uploaded
         and seeded for >= minSeedingHours (340 hours) with avg upload rate < 2 KB/s:
@@ -28,10 +36,14 @@
 
   Archive extraction (zip, rar):
     If a completed item is an archive or a directory containing archives,
-    the upload service extracts them to a temporary extracted/ directory,
-    uploads the extracted contents to B2, then deletes extracted/ immediately.
-    The original archive stays in completed/ for seeding. Only top-level
-    archives are extracted (nested archives are ignored).
+    the upload service uploads their contents to B2 next to the archive.
+    Zips are streamed member by member into `rclone rcat` without touching
+    the disk. Rars (and zips that can't be streamed) are extracted to a
+    per-item temporary directory under extracted/, uploaded, then deleted
+    immediately. Leftovers from an interrupted run are cleared at startup.
+    The original archive stays in completed/ for seeding. Archives anywhere
+    inside an item are extracted into their own directory on B2 (e.g.
+    Subs/subs.rar); archives inside archives are ignored.
 
   Categories:
     Downloads are organized by category. Each category maps to a subdirectory
@@ -53,31 +65,40 @@
     /var/lib/qBittorrent/completed/tv — TV series (Sonarr category)
     /var/lib/qBittorrent/completed/movies — movies (Radarr category)
     /var/lib/qBittorrent/extracted    — temporary extraction dir (ephemeral)
+    /var/lib/qBittorrent/upload-state.db — what has been uploaded (SQLite)
     /media/arr/tv                     — Sonarr root folder (hard links)
     /media/arr/movies                 — Radarr root folder (hard links)
 
   Manual operations:
     - To free disk early: remove the torrent from qBittorrent's web UI, then
       either wait up to 10 minutes or run `systemctl start qbt-cleanup`.
-    - To monitor: `just qbt-logs` (follows qbittorrent, upload, and cleanup).
-    - To retry a failed upload: `systemctl start qbt-upload-b2`.
+    - To monitor: `just qbt-logs` (follows qbittorrent, upload, its rclone
+      rcd, and cleanup).
+    - To retry a failed upload: `systemctl restart qbt-upload-b2` (the
+      daemon does a full scan on startup).
 
   Verifying after deploy:
     ssh builder "systemctl restart qbt-categories && journalctl -u qbt-categories --no-pager -n 15 --since '1 minute ago'"
-    ssh builder "systemctl start qbt-upload-b2 && journalctl -u qbt-upload-b2 --no-pager -n 50 --since '1 minute ago'"
+    ssh builder "systemctl restart qbt-upload-b2 && sleep 30 && journalctl -u qbt-upload-b2 --no-pager -n 50 --since '1 minute ago'"
     ssh builder "systemctl start qbt-cleanup && journalctl -u qbt-cleanup --no-pager -n 50 --since '1 minute ago'"
     Expected: categories prints "Category: <name> -> <subdir>/", upload
-    completes (may have nothing to do), cleanup reports seeding/skipped/removed.
+    prints "Watching N directories" and finishes its startup scan (may have
+    nothing to do), cleanup reports seeding/skipped/removed.
 
   Scripts:
     The three companion services (categories, upload, cleanup) are implemented
     as standalone Python scripts alongside this module. They read all
     configuration from environment variables set by systemd, making them
     independently testable. Run `just test` to execute the test suite.
+    upload and cleanup share the upload state database through state.py, so
+    the whole directory is copied to the store (scriptDir) and the scripts
+    import their siblings from there.
 
   Systemd units:
-    qbt-upload-b2.timer      — polls every 2 min for new files to upload
-    qbt-upload-b2.service    — uploads to B2 from /media/arr/ and completed/
+    qbt-upload-b2.service    — daemon, uploads new files in /media/arr/ and
+                               completed/ to B2 as inotify reports them
+    qbt-rclone-rcd.service   — rclone rcd that runs the upload service's copies
+    qbt-upload-plan.service  — on demand, prints what the next upload run would do
     qbt-categories.service   — creates qBittorrent categories via API on boot
     qbt-cleanup.timer        — fires every 10 min
     qbt-cleanup.service      — removes torrents after seedingDays, cleans up
@@ -87,12 +108,31 @@ let
   ids = config.homelab.identifiers;
   completedDir = "/var/lib/qBittorrent/completed";
   extractedDir = "/var/lib/qBittorrent/extracted";
+  stateDb = "/var/lib/qBittorrent/upload-state.db"; # upload records (state.py)
+  metricsDir = "/var/lib/prometheus-node-exporter-text"; # textfile collector dir
   importBase = "/media/arr";
   b2Remote = "b2:entertainment-netmount";
   webuiPort = 8080; # WebUI for torrent management (LAN/Tailscale)
   torrentingPort = 6881; # BitTorrent peer connections (incoming)
   minSeedingHours = 340; # Minimum hours to seed before considering removal
   minAvgRate = 2048; # Minimum avg upload rate (bytes/sec) to keep seeding (2 KB/s)
+  manifestMaxAge = 6 * 3600; # Seconds before upload re-lists the whole B2 bucket
+  uploadWorkers = 3; # Upload jobs (per-root batches, archive items) run in parallel
+  maxTransfers = 8; # Total transfers (rclone's, large-file parts) across upload jobs (disk I/O cap)
+  uploadPolicy = "oldest"; # Upload order: oldest, smallest or pressure (schedule.py)
+  uploadMinFree = 10; # Below this % free disk, upload items blocking cleanup first
+  uploadDebounce = 30; # Seconds a changed file must be quiet before it's uploaded
+  rescanInterval = 3600; # Seconds between the upload daemon's full safety-net scans
+  uploadRcPort = 5573; # rclone rcd used by the upload service (localhost only)
+  mountRcPort = 5572; # rc of the B2 FUSE mount (rclone-b2.nix)
+  hookSocket = "/run/qbt-upload/hook.sock"; # completion hook -> upload daemon
+  webhookPort = 5574; # Sonarr/Radarr webhooks -> upload daemon (localhost only)
+  # Upload bandwidth (bwlimit.py), re-evaluated every 10 seconds. Rates use
+  # rclone --bwlimit syntax (bare numbers are KiB/s, "off" is unlimited).
+  uploadBwlimit = "18:00,4M 23:30,off"; # Time-of-day timetable (evening cap)
+  uplinkRate = "5M"; # Connection upload capacity, shared with seeding
+  uploadMinRate = "512K"; # Uploads never drop below this for seeding
+  mountBusyRate = "1M"; # Cap while the B2 mount is transferring (playback)
 
   # Download categories — each maps to a subdirectory under completed/ and an
   # import directory under importBase/ where files are hard linked with nice names.
@@ -106,12 +146,64 @@ let
     movie = "movies";
   };
 
+  # What B2 gets of archive (rar/zip) releases, per B2 root: "both" uploads
+  # the unpacked contents and the original volumes, "extracted" only the
+  # contents (the volumes stay on disk for seeding, then cleanup removes
+  # them like any uploaded file). Roots not listed use "both".
+  archivePolicy = {
+    tv = "extracted";
+    movies = "extracted";
+    downloads = "both"; # uncategorized: could be anything, keep it as is
+  };
+
+  # Categories nobody imports: the completion hook links these itself
+  manualCategories = [
+    "tv"
+    "movie"
+  ];
+
   # Serialized for Python scripts: "tv-sonarr:tv,radarr:movies"
   categoriesEnv = builtins.concatStringsSep "," (
     builtins.attrValues (builtins.mapAttrs (name: subdir: "${name}:${subdir}") categories)
   );
 
+  # "downloads:both,movies:extracted,tv:extracted"
+  archivePolicyEnv = builtins.concatStringsSep "," (
+    builtins.attrValues (builtins.mapAttrs (root: policy: "${root}:${policy}") archivePolicy)
+  );
+
+  # Environment of the upload daemon, shared with qbt-upload-plan
+  uploadEnvironment = [
+    "COMPLETED_DIR=${completedDir}"
+    "EXTRACTED_DIR=${extractedDir}"
+    "IMPORT_BASE=${importBase}"
+    "B2_REMOTE=${b2Remote}"
+    "CATEGORIES=${categoriesEnv}"
+    "MANUAL_CATEGORIES=${builtins.concatStringsSep "," manualCategories}"
+    "STATE_DB=${stateDb}"
+    "MANIFEST_MAX_AGE=${toString manifestMaxAge}"
+    "UPLOAD_WORKERS=${toString uploadWorkers}"
+    "MAX_TRANSFERS=${toString maxTransfers}"
+    "UPLOAD_POLICY=${uploadPolicy}"
+    "UPLOAD_MIN_FREE=${toString uploadMinFree}"
+    "MIN_SEEDING_HOURS=${toString minSeedingHours}"
+    "ARCHIVE_POLICY=${archivePolicyEnv}"
+    "UPLOAD_DEBOUNCE=${toString uploadDebounce}"
+    "RESCAN_INTERVAL=${toString rescanInterval}"
+    "RCLONE_RC_URL=http://127.0.0.1:${toString uploadRcPort}"
+    "METRICS_FILE=${metricsDir}/qbt-upload.prom"
+    "UPLOAD_BWLIMIT=${uploadBwlimit}"
+    "UPLINK_RATE=${uplinkRate}"
+    "UPLOAD_MIN_RATE=${uploadMinRate}"
+    "MOUNT_BUSY_RATE=${mountBusyRate}"
+    "QBT_API_URL=http://localhost:${toString webuiPort}/api/v2"
+    "MOUNT_RC_URL=http://127.0.0.1:${toString mountRcPort}"
+    # Log lines reach the journal as they happen, not when a buffer fills
+    "PYTHONUNBUFFERED=1"
+  ];
+
   python = "${pkgs.python3}/bin/python3";
+  scriptDir = ./.; # scripts import shared modules (state.py) from their own directory
 in
 {
   services.qbittorrent = {
@@ -133,6 +225,15 @@ in
         "WebUI\\AuthSubnetWhitelist" = "100.64.0.0/10";
       };
 
+      # Tell the upload daemon about every finished torrent (hash, category,
+      # content path) so it uploads it right away. The quotes keep an empty
+      # category as an argument; they are escaped because QSettings strips
+      # bare ones when reading the ini.
+      AutoRun = {
+        enabled = true;
+        program = ''${python} ${scriptDir}/hook.py --socket ${hookSocket} \"%I\" \"%L\" \"%F\"'';
+      };
+
       BitTorrent.Session = {
         DefaultSavePath = completedDir;
         TempPathEnabled = true;
@@ -150,6 +251,7 @@ in
     "d ${completedDir} 0755 media media -"
     "d ${extractedDir} 0755 media media -"
     "d ${importBase} 0755 media media -"
+    "d ${metricsDir} 0755 media media -"
   ] ++ map (sub: "d ${completedDir}/${sub} 0755 media media -")
     (builtins.attrValues categories)
   ++ map (sub: "d ${importBase}/${sub} 0755 media media -")
@@ -169,7 +271,7 @@ in
       User = "media";
       Group = "media";
       RemainAfterExit = true;
-      ExecStart = "${python} ${./categories.py}";
+      ExecStart = "${python} ${scriptDir}/categories.py";
       Environment = [
         "QBT_API_URL=http://localhost:${toString webuiPort}/api/v2"
         "COMPLETED_DIR=${completedDir}"
@@ -179,42 +281,85 @@ in
   };
 
   # Upload completed downloads to B2.
-  # Primary: scans /media/arr/tv/ and /media/arr/movies/ (nice names from Sonarr/Radarr)
-  # Fallback: scans completed/ for uncategorized downloads (torrent names)
-  # Triggered by qbt-upload-b2.timer every 2 minutes.
+  # Primary: watches /media/arr/tv/ and /media/arr/movies/ (nice names from Sonarr/Radarr)
+  # Fallback: watches completed/ for uncategorized downloads (torrent names)
+  # Long-running: inotify picks up new files within uploadDebounce seconds.
+  # We used to poll with a 2-minute timer, which re-scanned every tree from
+  # scratch even when nothing had changed. A path unit doesn't work either:
+  # DirectoryNotEmpty re-triggers endlessly when files are left in place for
+  # seeding. The daemon still does a full scan every rescanInterval in case
+  # inotify missed something (e.g. the event queue overflowed).
   systemd.services.qbt-upload-b2 = {
     description = "Upload completed qBittorrent downloads to B2";
+    after = [ "network-online.target" "qbt-rclone-rcd.service" ];
+    wants = [ "network-online.target" ];
+    requires = [ "qbt-rclone-rcd.service" ];
+    wantedBy = [ "multi-user.target" ];
 
     serviceConfig = {
-      Type = "oneshot";
+      Type = "simple";
       User = "media";
       Group = "media";
-      ExecStart = "${python} ${./upload.py}";
+      ExecStart = "${python} ${scriptDir}/upload.py --daemon";
+      Restart = "on-failure";
+      RestartSec = "1min";
+      # /run/qbt-upload holds hookSocket; qBittorrent runs hook.py as media too
+      RuntimeDirectory = "qbt-upload";
       EnvironmentFile = config.sops.templates.rclone_b2_env.path;
-      Environment = [
-        "COMPLETED_DIR=${completedDir}"
-        "EXTRACTED_DIR=${extractedDir}"
-        "IMPORT_BASE=${importBase}"
-        "B2_REMOTE=${b2Remote}"
-        "CATEGORIES=${categoriesEnv}"
+      Environment = uploadEnvironment ++ [
+        "HOOK_SOCKET=${hookSocket}"
+        "WEBHOOK_ADDR=127.0.0.1:${toString webhookPort}"
       ];
     };
 
     path = with pkgs; [ rclone unar ];
   };
 
-  # Poll for new completed downloads and upload them.
-  # We use a timer instead of a path unit because DirectoryNotEmpty re-triggers
-  # endlessly when files are left in place for seeding (the directory is never
-  # emptied). A 2-minute poll is a good balance between latency and overhead —
-  # the upload itself is the bottleneck, not detection.
-  systemd.timers.qbt-upload-b2 = {
-    description = "Poll for completed qBittorrent downloads to upload";
-    wantedBy = [ "timers.target" ];
+  # Dry run of the upload daemon's next full scan (upload.py --plan): what
+  # it would link, upload and propagate, with total size and estimated
+  # duration. Links nothing, uploads nothing and doesn't contact B2, so it
+  # is safe to start while the daemon runs. Nothing starts it; output goes
+  # to the journal:
+  #   systemctl start qbt-upload-plan && journalctl -u qbt-upload-plan -n 100
+  systemd.services.qbt-upload-plan = {
+    description = "Show what the next B2 upload run would do";
 
-    timerConfig = {
-      OnBootSec = "1min";
-      OnUnitActiveSec = "2min";
+    serviceConfig = {
+      Type = "oneshot";
+      User = "media";
+      Group = "media";
+      ExecStart = "${python} ${scriptDir}/upload.py --plan";
+      EnvironmentFile = config.sops.templates.rclone_b2_env.path;
+      Environment = uploadEnvironment;
+    };
+  };
+
+  # Long-running rclone for the upload service. upload.py submits copies and
+  # listings to it as rc jobs instead of starting a new rclone for each one,
+  # so config loading, B2 authorization and HTTP connections are paid once.
+  # Separate from the mount's rc (:5572), which runs as root and serves
+  # streaming. Runs as media so it can read completed/ and /media/arr/.
+  # Listens on localhost only; --rc-no-auth is needed for sync/* and
+  # operations/* calls.
+  systemd.services.qbt-rclone-rcd = {
+    description = "rclone remote control daemon for B2 uploads";
+    after = [ "network-online.target" ];
+    wants = [ "network-online.target" ];
+
+    serviceConfig = {
+      User = "media";
+      Group = "media";
+      EnvironmentFile = config.sops.templates.rclone_b2_env.path;
+      ExecStart = ''
+        ${pkgs.rclone}/bin/rclone rcd \
+          --rc-addr 127.0.0.1:${toString uploadRcPort} \
+          --rc-no-auth \
+          --stats 30s \
+          --stats-log-level NOTICE \
+          --log-level INFO
+      '';
+      Restart = "on-failure";
+      RestartSec = "10s";
     };
   };
 
@@ -235,7 +380,7 @@ in
       Type = "oneshot";
       User = "media";
       Group = "media";
-      ExecStart = "${python} ${./cleanup.py}";
+      ExecStart = "${python} ${scriptDir}/cleanup.py";
       Environment = [
         "QBT_API_URL=http://localhost:${toString webuiPort}/api/v2"
         "COMPLETED_DIR=${completedDir}"
@@ -243,6 +388,7 @@ in
         "MIN_SEEDING_HOURS=${toString minSeedingHours}"
         "MIN_AVG_RATE=${toString minAvgRate}"
         "CATEGORIES=${categoriesEnv}"
+        "STATE_DB=${stateDb}"
       ];
     };
   };
@@ -257,6 +403,14 @@ in
     };
   };
 
+  # Serves upload.py's metrics (METRICS_FILE) to the Prometheus on house,
+  # which scrapes builder:9100 over Tailscale (trusted interface, no open port)
+  services.prometheus.exporters.node = {
+    enable = true;
+    enabledCollectors = [ "textfile" ];
+    extraFlags = [ "--collector.textfile.directory=${metricsDir}" ];
+  };
+
   networking.firewall.allowedTCPPorts = [
     webuiPort      # qBittorrent WebUI (LAN/Tailscale)
     torrentingPort # BitTorrent incoming peer connections
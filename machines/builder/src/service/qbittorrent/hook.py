@@ -0,0 +1,128 @@
+"""qBittorrent "run external program on torrent finished" hook.
+
+qBittorrent runs this when a torrent completes:
+
+  hook.py --socket /run/qbt-upload/hook.sock "%I" "%L" "%F"
+
+(info hash, category, content path). It sends them as one JSON datagram
+to the upload daemon's Unix socket and exits. The daemon (upload.py
+--daemon, see HookListener) links and uploads that item straight away,
+instead of waiting for inotify's debounce: a finished torrent's files
+are complete, so there is nothing to wait for.
+
+The hook never fails or holds up the torrent: if the daemon isn't
+listening (stopped, restarting) or its socket queue is full, the message
+is dropped and inotify or the next full scan picks the item up as before.
+"""
+
+import argparse
+import json
+import os
+import socket
+import threading
+
+from watch import EventQueue
+
+# Datagrams are small; anything bigger than this isn't from hook.py
+MAX_MESSAGE = 64 * 1024
+
+
+def send_completion(socket_path, info_hash, category, content_path):
+    """Send one completion to the daemon. Returns False if nobody listens."""
+    message = json.dumps(
+        {"hash": info_hash, "category": category, "path": content_path}
+    ).encode()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        try:
+            # A full queue (net.unix.max_dgram_qlen) would block qBittorrent's
+            # process until the daemon reads
+            sock.sendto(message, socket.MSG_DONTWAIT, socket_path)
+        except BlockingIOError:
+            print(f"Upload daemon busy, dropping completion of {content_path}")
+            return False
+        except OSError as e:
+            print(f"Upload daemon not listening on {socket_path}: {e}")
+            return False
+    return True
+
+
+def parse_message(data):
+    """Return the (hash, category, path) of a datagram, None if malformed."""
+    try:
+        message = json.loads(data)
+        return message["hash"], message["category"], message["path"]
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        print(f"Ignoring bad completion message {data[:200]!r}: {e}")
+        return None
+
+
+class HookListener:
+    """The daemon's end of the hook socket.
+
+    Binds a datagram socket at path (replacing a stale one left by a
+    previous run) and reads it on a thread of its own, so completions are
+    taken off the socket while the daemon is busy and hook.py never finds
+    the queue full. They wait in an EventQueue: fileno() lets the daemon
+    wait on it together with inotify.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(path)
+        self.queue = EventQueue()
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._serve, name="hook", daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                data = self.sock.recv(MAX_MESSAGE)
+            except OSError:
+                return
+            # Woken by close()
+            if self.closed.is_set():
+                return
+            completion = parse_message(data)
+            if completion is not None:
+                self.queue.put(completion)
+
+    def fileno(self):
+        return self.queue.fileno()
+
+    def close(self):
+        self.closed.set()
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.thread.join()
+        self.sock.close()
+        self.queue.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def receive(self):
+        """Return every completion received so far as (hash, category, path).
+
+        Malformed messages are logged and dropped.
+        """
+        return self.queue.get_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--socket", required=True, help="upload daemon's socket")
+    parser.add_argument("hash", help="torrent info hash (%%I)")
+    parser.add_argument("category", help="torrent category, may be empty (%%L)")
+    parser.add_argument("path", help="torrent content path (%%F)")
+    args = parser.parse_args()
+    send_completion(args.socket, args.hash, args.category, args.path)
+
+
+if __name__ == "__main__":
+    main()
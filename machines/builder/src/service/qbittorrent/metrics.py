@@ -0,0 +1,114 @@
+"""Prometheus metrics written as a node_exporter textfile.
+
+upload.py records counters, gauges and histograms here and writes them to
+METRICS_FILE after each run. node_exporter's textfile collector serves
+the file on the next scrape. The file is replaced atomically (written
+next to it, then renamed) so a scrape never sees half a file.
+
+Counters live in memory and restart from zero with the service, which
+Prometheus' rate() and increase() handle as a counter reset.
+"""
+
+import math
+import os
+import tempfile
+import threading
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    pairs = ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+    return f"{{{pairs}}}"
+
+
+def _value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metrics:
+    """Thread-safe metric store for one process.
+
+    definitions maps metric name -> (type, help, buckets), where type is
+    "counter", "gauge" or "histogram" and buckets (upper bounds, for
+    histograms only) is otherwise None.
+    """
+
+    def __init__(self, path, definitions):
+        self.path = path
+        self.definitions = definitions
+        self.lock = threading.Lock()
+        # name -> {label tuple: value}; histograms hold [bucket counts, sum, count]
+        self.values = {name: {} for name in definitions}
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self.definitions[name][2]
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            if key not in series:
+                series[key] = [[0] * len(buckets), 0.0, 0]
+            counts, _, _ = entry = series[key]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def total(self, name):
+        """Sum of a counter or gauge over all its label values."""
+        with self.lock:
+            return sum(self.values[name].values())
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, buckets) in sorted(self.definitions.items()):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for key, value in sorted(self.values[name].items()):
+                    labels = dict(key)
+                    if kind != "histogram":
+                        lines.append(f"{name}{_labels(labels)} {_value(value)}")
+                        continue
+                    counts, total, count = value
+                    for bound, n in zip([*buckets, math.inf], [*counts, count]):
+                        le = _labels({**labels, "le": _value(bound)})
+                        lines.append(f"{name}_bucket{le} {n}")
+                    lines.append(f"{name}_sum{_labels(labels)} {_value(total)}")
+                    lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "".join(f"{line}\n" for line in lines)
+
+    def write(self):
+        """Replace the textfile with the current values (no-op without path)."""
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path) or "."
+        try:
+            fd, tmp = tempfile.mkstemp(prefix=".qbt-upload-", dir=directory)
+            with os.fdopen(fd, "w") as f:
+                f.write(self.render())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Cannot write metrics to {self.path}: {e}")
@@ -0,0 +1,127 @@
+"""Per-phase timing and opt-in profiling for upload.py and cleanup.py.
+
+A run is split into phases (listing the trees, linking, rclone checks,
+extraction, uploads, marker propagation; hard link removal and pruning
+in cleanup). Phases records the wall time, number of calls, entries
+visited and bytes moved of each, and report() prints them as one line
+at the end of the run, e.g.
+
+  Upload run 312.4s: list 0.8s (48213 entries), scan 0.2s (3 entries),
+  upload 305.1s x3 (4210.5 MB), propagate 0.1s
+
+Phases running on several upload workers at once add up their time, so
+together they can exceed the run's wall time. A phase nested in another
+(prune inside hardlinks) counts in both.
+
+profiled() runs code under cProfile when PROFILE_FILE is set, and writes
+the stats to that file on exit (including systemctl stop), for
+`python -m pstats` or snakeviz. Only the main thread is profiled: time
+upload workers spend on their jobs shows up as waiting on the pool.
+"""
+
+import cProfile
+import functools
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Phases:
+    """Thread-safe per-phase totals for one run at a time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> [seconds, calls, entries, bytes], in first-use order
+        self.totals = {}
+        # Start of the first phase since the last report (run wall time)
+        self.started = None
+
+    def add(self, name, seconds=0.0, calls=1, entries=0, nbytes=0, started=None):
+        with self.lock:
+            if started is not None and (self.started is None or started < self.started):
+                self.started = started
+            total = self.totals.setdefault(name, [0.0, 0, 0, 0])
+            total[0] += seconds
+            total[1] += calls
+            total[2] += entries
+            total[3] += nbytes
+
+    def count(self, name, entries=0, nbytes=0):
+        """Add entries visited or bytes moved to a phase, without timing."""
+        self.add(name, calls=0, entries=entries, nbytes=nbytes)
+
+    @contextmanager
+    def phase(self, name):
+        """Time the block as one call of phase name."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - started, started=started)
+
+    def timed(self, name):
+        """Decorator timing every call of a function as phase name."""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.phase(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def summary(self):
+        """Return "<wall>s: <phase> <seconds>s [xN] [(entries, MB)], ..."."""
+        with self.lock:
+            wall = 0.0 if self.started is None else time.monotonic() - self.started
+            parts = []
+            for name, (seconds, calls, entries, nbytes) in self.totals.items():
+                part = f"{name} {seconds:.1f}s"
+                if calls > 1:
+                    part += f" x{calls}"
+                extra = []
+                if entries:
+                    extra.append(f"{entries} entries")
+                if nbytes:
+                    extra.append(f"{nbytes / 1e6:.1f} MB")
+                if extra:
+                    part += f" ({', '.join(extra)})"
+                parts.append(part)
+        return f"{wall:.1f}s: {', '.join(parts) or 'nothing done'}"
+
+    def report(self, label):
+        """Print the summary line and start over for the next run."""
+        print(f"{label} {self.summary()}")
+        with self.lock:
+            self.totals = {}
+            self.started = None
+
+
+def _stop(signum, frame):
+    # Unwind normally on systemctl stop so the profile gets written
+    sys.exit(0)
+
+
+@contextmanager
+def profiled(path):
+    """Profile the block with cProfile into path (pstats format), if set."""
+    if not path:
+        yield
+        return
+    previous = signal.signal(signal.SIGTERM, _stop)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        signal.signal(signal.SIGTERM, previous)
+        try:
+            profiler.dump_stats(path)
+            print(f"Profile written to {path}")
+        except OSError as e:
+            print(f"Cannot write profile to {path}: {e}")
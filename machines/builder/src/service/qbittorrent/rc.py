@@ -0,0 +1,69 @@
+"""Client for a long-running rclone remote control daemon (rclone rcd).
+
+upload.py sends its copies and listings here when RCLONE_RC_URL is set,
+instead of starting a new rclone process for each one. The daemon keeps
+its config, B2 authorization and HTTP connections warm across calls.
+
+Long operations run as async jobs (`_async`), polled via job/status. Each
+job's transfers are accounted in the stats group "job/<id>", which
+core/transferred reports per file.
+"""
+
+import json
+import time
+import urllib.error
+import urllib.request
+
+
+class RcError(Exception):
+    """The rc call failed, or the daemon couldn't be reached."""
+
+
+def rc_call(rc_url, command, params=None, timeout=60):
+    """POST one rc command and return its decoded JSON reply."""
+    req = urllib.request.Request(
+        f"{rc_url.rstrip('/')}/{command}",
+        data=json.dumps(params or {}).encode(),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            return json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        # rclone reports errors as JSON with an "error" field
+        try:
+            message = json.loads(e.read()).get("error", e.reason)
+        except (json.JSONDecodeError, OSError):
+            message = e.reason
+        raise RcError(f"{command}: {message}") from e
+    except (urllib.error.URLError, OSError, json.JSONDecodeError) as e:
+        raise RcError(f"{command}: {e}") from e
+
+
+def rc_job(rc_url, command, params, poll_interval=2):
+    """Run command as an async job and wait for it to finish.
+
+    Returns (error, transferred): error is None if the job succeeded, and
+    transferred maps each file name the job copied to its error ("" if
+    ok). rclone keeps only the most recent completed transfers per stats
+    group, so transferred may not cover every file of a large job. The
+    job's stats group is deleted afterwards so the daemon doesn't keep
+    accumulating them.
+    """
+    job_id = rc_call(rc_url, command, {**params, "_async": True})["jobid"]
+    while True:
+        status = rc_call(rc_url, "job/status", {"jobid": job_id})
+        if status.get("finished"):
+            break
+        time.sleep(poll_interval)
+
+    group = f"job/{job_id}"
+    reply = rc_call(rc_url, "core/transferred", {"group": group})
+    transferred = {
+        t["name"]: t.get("error") or "" for t in reply.get("transferred", [])
+    }
+    rc_call(rc_url, "core/stats-delete", {"group": group})
+    if status.get("success"):
+        return None, transferred
+    return status.get("error") or "unknown error", transferred
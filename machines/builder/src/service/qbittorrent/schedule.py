@@ -0,0 +1,123 @@
+"""Upload queue ordering for upload.py.
+
+Pending items come from every import dir (tv/, movies/) and from
+uncategorized downloads in completed/. A Scheduler orders them by one of
+these policies:
+
+  oldest   - oldest first, by the newest file mtime in the item (roughly
+             when qBittorrent finished it)
+  smallest - smallest first, so a pile of episodes isn't stuck behind
+             one huge remux
+  pressure - items that hold back cleanup first: their seeding copy in
+             completed/ (hard linked from there, or the uncategorized
+             download itself) has seeded for min_seeding seconds, so
+             cleanup would delete it now if only it were on B2. Oldest
+             first among those, then the rest oldest first.
+
+When free space on the download disk drops below min_free (a fraction
+of its size), the pressure policy is used whatever the configured one.
+
+Categories (B2 roots) take turns by bytes: the next item always comes
+from the category that has been given the fewest bytes so far, so a
+60 GB movie is followed by episodes until tv/ has caught up.
+"""
+
+import os
+import time
+
+from walk import Tree
+
+POLICIES = ("oldest", "smallest", "pressure")
+
+
+def item_info(item, b2_base):
+    """Return (size, mtime_ns, seeding) of a pending item.
+
+    size is the total of its files and mtime_ns the newest file mtime.
+    seeding is True if the item has a seeding copy in completed/ that
+    cleanup can only delete once it is uploaded.
+    """
+    tree = Tree([item])
+    size = mtime_ns = 0
+    linked = False
+    for f in tree.files(item):
+        st = tree.stat(f)
+        if st is None:
+            continue
+        size += st.st_size
+        mtime_ns = max(mtime_ns, st.st_mtime_ns)
+        linked = linked or st.st_nlink > 1
+    return size, mtime_ns, linked or b2_base.startswith("downloads/")
+
+
+class Scheduler:
+    """Orders pending uploads by policy, sharing the uplink by category."""
+
+    def __init__(self, policy="oldest", min_free=0.0, min_seeding=0):
+        if policy not in POLICIES:
+            raise ValueError(
+                f"Unknown upload policy {policy!r} (expected one of {POLICIES})"
+            )
+        self.policy = policy
+        self.min_free = min_free
+        # Seconds an item seeds before cleanup may delete it (see cleanup.py)
+        self.min_seeding = min_seeding
+
+    def current_policy(self, path):
+        """Return the policy to use for items on the disk holding path."""
+        if self.min_free <= 0 or self.policy == "pressure":
+            return self.policy
+        try:
+            vfs = os.statvfs(path)
+        except OSError:
+            return self.policy
+        if vfs.f_bavail < vfs.f_blocks * self.min_free:
+            print("Disk nearly full, uploading items that block cleanup first")
+            return "pressure"
+        return self.policy
+
+    def order(self, pending, info=None):
+        """Return pending (item, b2_base) entries in upload order.
+
+        The item_info of each item is kept in info (item -> tuple), if
+        given, for the caller to reuse.
+        """
+        if not pending:
+            return []
+        policy = self.current_policy(pending[0][0])
+        if info is None:
+            info = {}
+        # Items whose mtime is older than this have seeded long enough
+        seeded_ns = time.time_ns() - int(self.min_seeding * 10**9)
+
+        # category -> [(sort key, item, b2_base, size)]
+        queues = {}
+        for item, b2_base in pending:
+            if item not in info:
+                info[item] = item_info(item, b2_base)
+            size, mtime_ns, seeding = info[item]
+            if policy == "smallest":
+                key = (size, mtime_ns)
+            elif policy == "pressure":
+                blocking = seeding and mtime_ns <= seeded_ns
+                key = (not blocking, mtime_ns)
+            else:
+                key = (mtime_ns, size)
+            category = b2_base.partition("/")[0]
+            queues.setdefault(category, []).append(
+                ((*key, str(item)), item, b2_base, size)
+            )
+        for queue in queues.values():
+            # Highest priority last, so pop() takes it
+            queue.sort(key=lambda entry: entry[0], reverse=True)
+
+        given = dict.fromkeys(queues, 0)
+        ordered = []
+        while queues:
+            category = min(queues, key=lambda c: (given[c], c))
+            _, item, b2_base, size = queues[category].pop()
+            ordered.append((item, b2_base))
+            given[category] += size
+            if not queues[category]:
+                del queues[category]
+        return ordered
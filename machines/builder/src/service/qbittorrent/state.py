@@ -0,0 +1,616 @@
+"""Persistent upload state shared by upload.py and cleanup.py.
+
+Records which files and directories have been uploaded to B2 in a small
+SQLite database instead of `.uploaded` marker files next to every item.
+Entries are keyed by the on-disk identity of the content (device, inode,
+size, mtime) plus the bucket-relative B2 destination, so:
+  - hard links in completed/ and /media/arr/ share one record
+  - a file replaced in place (new inode or mtime) counts as not uploaded
+  - the same content uploaded to two destinations has two records
+
+The whole table is loaded into memory once per run; "uploaded?" is then a
+single stat of the item plus a dict lookup.
+
+On first open, existing `.uploaded` markers are imported and removed so the
+directories Jellyfin and Copyparty list are no longer cluttered.
+
+The database also caches a listing of the B2 bucket (the manifest): path,
+size, modification time and SHA1 of every object, refreshed by upload.py
+when it is older than MANIFEST_MAX_AGE. The loaded listing is also
+indexed by content (size, SHA1), so upload.py can find a file that is
+already in the bucket under another name and copy it server-side.
+
+Local SHA1s are cached under the same (dev, ino, size, mtime_ns) key, so
+each file is read for hashing once no matter how many hard links point to
+it or how often it is compared against B2.
+
+It keeps a snapshot (mtime, entry count) of every import directory
+whose files were all uploaded, so the next scan can skip looking at
+those files until the directory changes.
+
+Finally, it remembers the file keys of each completed/ item that is
+waiting for its content to be uploaded under the import dir names.
+Propagating upload status to such an item is then a set of dict lookups
+against the upload records instead of a walk of the item. Matching the
+whole key, not just the inode, keeps an inode reused after cleanup
+deleted the uploaded file from passing for it.
+
+Unfinished B2 large-file uploads (see b2.py) are recorded with the SHA1
+of each finished part, so an interrupted upload can be resumed.
+"""
+
+import hashlib
+import os
+import sqlite3
+import stat
+import threading
+import time
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    dest TEXT NOT NULL,
+    path TEXT NOT NULL,
+    uploaded_at INTEGER NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime_ns, dest)
+);
+CREATE INDEX IF NOT EXISTS uploads_path ON uploads (path);
+CREATE TABLE IF NOT EXISTS b2_objects (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT
+);
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (dev, ino, size, mtime_ns)
+);
+CREATE INDEX IF NOT EXISTS hashes_path ON hashes (path);
+CREATE TABLE IF NOT EXISTS dir_snapshots (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    entries INTEGER NOT NULL
+);
+-- Replaced by item_files, which keys files by content, not just inode
+DROP TABLE IF EXISTS item_inodes;
+CREATE TABLE IF NOT EXISTS item_files (
+    path TEXT NOT NULL,
+    item_mtime_ns INTEGER NOT NULL,
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (path, dev, ino)
+);
+CREATE TABLE IF NOT EXISTS large_files (
+    file_id TEXT PRIMARY KEY,
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    part_size INTEGER NOT NULL,
+    started_at INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS large_file_parts (
+    file_id TEXT NOT NULL,
+    part INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    PRIMARY KEY (file_id, part)
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def file_key(st):
+    """Identity of an item's content on disk: (dev, ino, size, mtime_ns).
+
+    Directories are keyed by (dev, ino) only, with -1 for size and mtime.
+    Their size and mtime change whenever an entry is added or removed inside
+    them (e.g. a subtitle), which says nothing about whether the item itself
+    was uploaded.
+    """
+    if stat.S_ISDIR(st.st_mode):
+        return (st.st_dev, st.st_ino, -1, -1)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def _subtree_bounds(path):
+    """Return (lo, hi) so that lo <= p < hi matches every path below path.
+
+    "0" is the character after "/", so this range covers exactly the
+    paths starting with "<path>/" without LIKE escaping.
+    """
+    path = str(path).rstrip("/")
+    return f"{path}/", f"{path}0"
+
+
+class UploadState:
+    """In-memory view of the upload state database.
+
+    Safe to share between upload worker threads: every database access and
+    in-memory update happens under self.lock.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = str(db_path)
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        # key -> {dest: path}
+        self.uploads = {}
+        self.reload()
+        # Cached bucket listing: path -> (size, mtime_ns, sha1), or None
+        # when no fresh listing has been loaded (see load_manifest)
+        self.manifest = None
+        # size -> {sha1: path} over the manifest's objects with a SHA1
+        self.contents = {}
+
+    def close(self):
+        self.db.close()
+
+    def reload(self):
+        """Re-read upload records, e.g. after cleanup.py changed the database.
+
+        Only needed by long-running processes (upload.py --daemon).
+        """
+        uploads = {}
+        with self.lock:
+            for dev, ino, size, mtime_ns, dest, path in self.db.execute(
+                "SELECT dev, ino, size, mtime_ns, dest, path FROM uploads"
+            ):
+                uploads.setdefault((dev, ino, size, mtime_ns), {})[dest] = path
+            self.uploads = uploads
+            # path -> (mtime_ns, entries)
+            self.dir_snapshots = {
+                path: (mtime_ns, entries)
+                for path, mtime_ns, entries in self.db.execute(
+                    "SELECT path, mtime_ns, entries FROM dir_snapshots"
+                )
+            }
+            # completed/ item path -> (mtime_ns, frozenset of file keys)
+            items = {}
+            for path, item_mtime_ns, *key in self.db.execute(
+                "SELECT path, item_mtime_ns, dev, ino, size, mtime_ns FROM item_files"
+            ):
+                items.setdefault(path, (item_mtime_ns, set()))[1].add(tuple(key))
+            self.item_files = {
+                path: (mtime_ns, frozenset(keys))
+                for path, (mtime_ns, keys) in items.items()
+            }
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, str(value)),
+            )
+
+    def is_uploaded_stat(self, st, dest=None):
+        """Check a stat result against the state.
+
+        With dest=None, any destination counts (used by cleanup, which only
+        needs to know the content is on B2 somewhere).
+        """
+        dests = self.uploads.get(file_key(st))
+        if not dests:
+            return False
+        return dest is None or dest in dests
+
+    def is_uploaded(self, path, dest=None):
+        """Check whether path has been uploaded (to dest, if given)."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return self.is_uploaded_stat(st, dest)
+
+    def destinations(self, st):
+        """Return {dest: path} of every upload record for a stat result."""
+        with self.lock:
+            return dict(self.uploads.get(file_key(st), {}))
+
+    def files_uploaded(self, keys):
+        """Check whether every file key (see file_key) has an upload record."""
+        with self.lock:
+            return all(key in self.uploads for key in keys)
+
+    def mark(self, path, dest):
+        """Record path as uploaded to dest (bucket-relative, e.g. "tv/Show/ep.mkv").
+
+        Raises OSError if path can't be stat'ed and sqlite3.Error if the
+        database can't be written.
+        """
+        key = file_key(os.stat(path))
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO uploads"
+                    " (dev, ino, size, mtime_ns, dest, path, uploaded_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (*key, dest, str(path), int(time.time())),
+                )
+            self.uploads.setdefault(key, {})[dest] = str(path)
+
+    def dir_unchanged(self, path, st, entries):
+        """Check a directory against its snapshot from the last complete scan.
+
+        True means every file directly inside it was already uploaded and
+        no entry has been added, removed or renamed since.
+        """
+        return self.dir_snapshots.get(str(path)) == (st.st_mtime_ns, entries)
+
+    def save_dir_snapshot(self, path, st, entries):
+        """Record that every file directly inside directory path is uploaded."""
+        with self.lock:
+            with self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO dir_snapshots (path, mtime_ns, entries)"
+                    " VALUES (?, ?, ?)",
+                    (str(path), st.st_mtime_ns, entries),
+                )
+            self.dir_snapshots[str(path)] = (st.st_mtime_ns, entries)
+
+    def item_keys(self, path, st):
+        """Return the cached file keys of completed/ item path, or None.
+
+        st is the item's stat result. The cache is only used while the
+        item's mtime is unchanged. Items only appear in completed/ once
+        qBittorrent has finished them, so their files don't change below
+        the top level.
+        """
+        cached = self.item_files.get(str(path))
+        if cached is None or cached[0] != st.st_mtime_ns:
+            return None
+        return cached[1]
+
+    def save_item_keys(self, path, st, keys):
+        """Cache the file key of every file in completed/ item path."""
+        keys = frozenset(keys)
+        with self.lock:
+            with self.db:
+                self.db.execute("DELETE FROM item_files WHERE path = ?", (str(path),))
+                self.db.executemany(
+                    "INSERT INTO item_files"
+                    " (path, item_mtime_ns, dev, ino, size, mtime_ns)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    ((str(path), st.st_mtime_ns, *key) for key in keys),
+                )
+            self.item_files[str(path)] = (st.st_mtime_ns, keys)
+
+    def sha1(self, path):
+        """Return the SHA1 of file path, hashing it only if not cached.
+
+        Returns None if the file can't be read.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = file_key(st)
+        cached = self.cached_sha1(st)
+        if cached:
+            return cached
+
+        h = hashlib.sha1()
+        try:
+            with open(path, "rb") as f:
+                while chunk := f.read(1024 * 1024):
+                    h.update(chunk)
+            changed = file_key(os.stat(path)) != key
+        except OSError:
+            return None
+        if changed:
+            # Written to while we were reading it — don't cache a torn hash
+            return h.hexdigest()
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO hashes"
+                " (dev, ino, size, mtime_ns, sha1, path) VALUES (?, ?, ?, ?, ?, ?)",
+                (*key, h.hexdigest(), str(path)),
+            )
+        return h.hexdigest()
+
+    def cached_sha1(self, st):
+        """Return the cached SHA1 of a file's content (stat result), or None."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT sha1 FROM hashes"
+                " WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?",
+                file_key(st),
+            ).fetchone()
+        return row[0] if row else None
+
+    def large_file(self, path, name):
+        """Return the recorded B2 large-file session uploading path to name.
+
+        Returns (file_id, part_size, {part number: SHA1}) or None if there
+        is none for the file's current content.
+        """
+        key = file_key(os.stat(path))
+        with self.lock:
+            row = self.db.execute(
+                "SELECT file_id, part_size FROM large_files"
+                " WHERE dev = ? AND ino = ? AND size = ? AND mtime_ns = ?"
+                " AND name = ?",
+                (*key, name),
+            ).fetchone()
+            if row is None:
+                return None
+            parts = dict(
+                self.db.execute(
+                    "SELECT part, sha1 FROM large_file_parts WHERE file_id = ?",
+                    (row[0],),
+                )
+            )
+        return row[0], row[1], parts
+
+    def start_large_file(self, path, name, file_id, part_size):
+        """Record a new B2 large-file session uploading path to name."""
+        key = file_key(os.stat(path))
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO large_files"
+                " (file_id, dev, ino, size, mtime_ns, name, path, part_size,"
+                " started_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (file_id, *key, name, str(path), part_size, int(time.time())),
+            )
+
+    def save_large_file_part(self, file_id, part, sha1):
+        """Record that part number part of file_id is on B2."""
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO large_file_parts (file_id, part, sha1)"
+                " VALUES (?, ?, ?)",
+                (file_id, part, sha1),
+            )
+
+    def drop_large_file(self, file_id):
+        """Forget a large-file session (finished, cancelled or abandoned)."""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM large_files WHERE file_id = ?", (file_id,))
+            self.db.execute(
+                "DELETE FROM large_file_parts WHERE file_id = ?", (file_id,)
+            )
+
+    def large_files(self):
+        """Return (file_id, path, key) of every recorded large-file session."""
+        with self.lock:
+            return [
+                (file_id, path, (dev, ino, size, mtime_ns))
+                for file_id, path, dev, ino, size, mtime_ns in self.db.execute(
+                    "SELECT file_id, path, dev, ino, size, mtime_ns FROM large_files"
+                )
+            ]
+
+    def uploaded_at(self, path, dest):
+        """Return when path was recorded as uploaded to dest (epoch), or None."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT MAX(uploaded_at) FROM uploads WHERE path = ? AND dest = ?",
+                (str(path), dest),
+            ).fetchone()
+        return row[0]
+
+    def forget(self, path):
+        """Drop records, hashes, snapshots and item files for path and below.
+
+        Called by cleanup before deleting files, so the state doesn't keep
+        growing with content that no longer exists locally.
+        """
+        path = str(path).rstrip("/")
+        lo, hi = _subtree_bounds(path)
+        where = "path = ? OR (path >= ? AND path < ?)"
+        with self.lock:
+            with self.db:
+                rows = self.db.execute(
+                    f"SELECT dev, ino, size, mtime_ns, dest FROM uploads WHERE {where}",
+                    (path, lo, hi),
+                ).fetchall()
+                self.db.execute(f"DELETE FROM uploads WHERE {where}", (path, lo, hi))
+                self.db.execute(f"DELETE FROM hashes WHERE {where}", (path, lo, hi))
+                self.db.execute(
+                    f"DELETE FROM dir_snapshots WHERE {where}", (path, lo, hi)
+                )
+                self.db.execute(f"DELETE FROM item_files WHERE {where}", (path, lo, hi))
+            self.dir_snapshots = {
+                p: snapshot
+                for p, snapshot in self.dir_snapshots.items()
+                if p != path and not lo <= p < hi
+            }
+            self.item_files = {
+                p: cached
+                for p, cached in self.item_files.items()
+                if p != path and not lo <= p < hi
+            }
+            for dev, ino, size, mtime_ns, dest in rows:
+                key = (dev, ino, size, mtime_ns)
+                dests = self.uploads.get(key)
+                if dests is None:
+                    continue
+                dests.pop(dest, None)
+                if not dests:
+                    del self.uploads[key]
+        return len(rows)
+
+    def prune_missing(self, exists=os.path.lexists):
+        """Drop records whose path no longer exists.
+
+        Cached hashes, directory snapshots and item files of missing
+        paths are dropped too. exists checks a path (e.g. walk.Tree.exists,
+        to answer from a directory listing). Returns the number of upload
+        records removed.
+        """
+        with self.lock:
+            paths = {path for dests in self.uploads.values() for path in dests.values()}
+            others = {path for (path,) in self.db.execute("SELECT path FROM hashes")}
+            others.update(self.dir_snapshots)
+            others.update(self.item_files)
+        stale = {path for path in paths | others if not exists(path)}
+        for path in stale:
+            self.forget(path)
+        return len(stale & paths)
+
+    def load_manifest(self, max_age):
+        """Load the cached bucket listing if it is younger than max_age seconds.
+
+        Returns True if self.manifest is now populated.
+        """
+        fetched_at = self.get_meta("manifest_fetched_at")
+        if fetched_at is None or time.time() - float(fetched_at) > max_age:
+            return False
+        with self.lock:
+            self.manifest = {
+                path: (size, mtime_ns, sha1)
+                for path, size, mtime_ns, sha1 in self.db.execute(
+                    "SELECT path, size, mtime_ns, sha1 FROM b2_objects"
+                )
+            }
+            self._index_contents()
+        return True
+
+    def _index_contents(self):
+        contents = {}
+        # Sorted so the same object is picked as copy source every time
+        for path, (size, _, sha1) in sorted(self.manifest.items()):
+            if sha1:
+                contents.setdefault(size, {}).setdefault(sha1, path)
+        self.contents = contents
+
+    def has_object_size(self, size):
+        """Check whether any object in the listing has exactly size bytes."""
+        return size in self.contents
+
+    def find_object(self, size, sha1):
+        """Return the path of an object with this content, or None."""
+        return self.contents.get(size, {}).get(sha1)
+
+    def remove_object(self, path):
+        """Drop an object upload.py deleted from the cached listing."""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM b2_objects WHERE path = ?", (path,))
+            if self.manifest is None:
+                return
+            entry = self.manifest.pop(path, None)
+            if entry is None:
+                return
+            size, _, sha1 = entry
+            if self.contents.get(size, {}).get(sha1) == path:
+                # Point the index at another object with the same content
+                del self.contents[size][sha1]
+                for other, (other_size, _, other_sha1) in sorted(self.manifest.items()):
+                    if (other_size, other_sha1) == (size, sha1):
+                        self.contents[size][sha1] = other
+                        break
+                if not self.contents[size]:
+                    del self.contents[size]
+
+    def add_object(self, path, size, mtime_ns, sha1):
+        """Add an object created by upload.py to the cached listing."""
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO b2_objects (path, size, mtime_ns, sha1)"
+                " VALUES (?, ?, ?, ?)",
+                (path, size, mtime_ns, sha1),
+            )
+            if self.manifest is not None:
+                self.manifest[path] = (size, mtime_ns, sha1)
+            if sha1:
+                self.contents.setdefault(size, {}).setdefault(sha1, path)
+
+    def replace_manifest(self, objects):
+        """Replace the cached bucket listing with objects.
+
+        objects maps bucket-relative path -> (size, mtime_ns, sha1).
+        """
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM b2_objects")
+            self.db.executemany(
+                "INSERT INTO b2_objects (path, size, mtime_ns, sha1)"
+                " VALUES (?, ?, ?, ?)",
+                ((path, *entry) for path, entry in objects.items()),
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                ("manifest_fetched_at", str(time.time())),
+            )
+        with self.lock:
+            self.manifest = dict(objects)
+            self._index_contents()
+
+    def import_markers(self, completed_dir, import_base, subdirs):
+        """Import legacy `.uploaded` marker files, once per database.
+
+        Markers exist in three places:
+          - anywhere under <import_base>/<subdir>/ → B2 <subdir>/<relpath>
+          - top level of completed/<subdir>/ → propagated marker (dest "")
+          - top level of completed/ → B2 downloads/<name>
+
+        Each imported marker is deleted. Returns the number imported.
+        """
+        if self.get_meta("markers_imported"):
+            return 0
+
+        sources = []
+        for subdir in subdirs:
+            root = Path(import_base) / subdir
+            if root.exists():
+                for marker in root.rglob("*.uploaded"):
+                    rel = marker.relative_to(root).with_suffix("")
+                    sources.append((marker, f"{subdir}/{rel}"))
+            root = Path(completed_dir) / subdir
+            if root.exists():
+                for marker in root.glob("*.uploaded"):
+                    sources.append((marker, ""))
+        root = Path(completed_dir)
+        if root.exists():
+            for marker in root.glob("*.uploaded"):
+                sources.append((marker, f"downloads/{marker.stem}"))
+
+        imported = []
+        for marker, dest in sources:
+            try:
+                self.mark(marker.with_suffix(""), dest)
+            except OSError:
+                # Orphaned marker — nothing to record, just remove it
+                pass
+            imported.append(marker)
+
+        self.set_meta("markers_imported", int(time.time()))
+        for marker in imported:
+            marker.unlink(missing_ok=True)
+        return len(imported)
+
+
+def open_state(db_path, completed_dir, import_base, subdirs, import_markers=True):
+    """Open the state database, importing legacy markers on first use.
+
+    Without import_markers the markers are left alone (and unrecorded).
+    """
+    state = UploadState(db_path)
+    if not import_markers:
+        return state
+    imported = state.import_markers(completed_dir, import_base, subdirs)
+    if imported:
+        print(f"Imported {imported} .uploaded markers into {db_path}")
+    return state
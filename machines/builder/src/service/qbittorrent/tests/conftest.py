@@ -3,6 +3,21 @@
 import sys
 from pathlib import Path
 
+import pytest
+
 # Add the parent directory (qbittorrent/) to sys.path so tests can
 # import the scripts directly: `from upload import process_item`
 sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from state import UploadState  # noqa: E402
+
+
+@pytest.fixture
+def state(tmp_path_factory):
+    """Fresh upload state database, outside the test's tmp_path.
+
+    Kept out of tmp_path so scans over tmp_path don't pick it up as an item.
+    """
+    s = UploadState(tmp_path_factory.mktemp("state") / "upload-state.db")
+    yield s
+    s.close()
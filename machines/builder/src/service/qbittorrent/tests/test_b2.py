@@ -0,0 +1,211 @@
+"""Tests for b2.py — resumable large-file uploads."""
+
+import hashlib
+import io
+import json
+import threading
+import time
+import urllib.error
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from b2 import B2, B2Error, cancel_abandoned, upload_large_file
+from upload import TransferBudget
+
+
+def _response(data):
+    resp = MagicMock()
+    resp.read.return_value = json.dumps(data).encode()
+    resp.__enter__.return_value = resp
+    return resp
+
+
+def _http_error(status, code):
+    body = io.BytesIO(json.dumps({"status": status, "code": code}).encode())
+    return urllib.error.HTTPError("https://api", status, code, {}, body)
+
+
+AUTH = {
+    "accountId": "acct",
+    "apiUrl": "https://api",
+    "authorizationToken": "token",
+    "allowed": {"bucketId": "bucket-id", "bucketName": "media"},
+}
+
+
+class FakeB2:
+    """In-memory stand-in for the B2 large-file API."""
+
+    bucket_id = "bucket-id"
+
+    def __init__(self, fail_part=None):
+        self.fail_part = fail_part
+        self.started = []
+        self.parts = {}
+        self.uploaded = []
+        self.finished = []
+        self.cancelled = []
+        self.unfinished = []
+
+    def call(self, api, params):
+        if api == "b2_start_large_file":
+            self.started.append(params)
+            file_id = f"file-{len(self.started)}"
+            self.parts[file_id] = {}
+            return {"fileId": file_id}
+        if api == "b2_get_upload_part_url":
+            return {"uploadUrl": params["fileId"], "authorizationToken": "t"}
+        if api == "b2_finish_large_file":
+            self.finished.append(params)
+            return {}
+        if api == "b2_cancel_large_file":
+            self.cancelled.append(params["fileId"])
+            return {}
+        raise AssertionError(api)
+
+    def upload_part(self, upload, part_number, data, sha1):
+        if part_number == self.fail_part:
+            raise B2Error("part failed", 503)
+        assert hashlib.sha1(data).hexdigest() == sha1
+        self.uploaded.append(part_number)
+        self.parts[upload["uploadUrl"]][part_number] = sha1
+
+    def list_parts(self, file_id):
+        if file_id not in self.parts:
+            raise B2Error("bad fileId", 400, "bad_request")
+        return dict(self.parts[file_id])
+
+    def list_unfinished(self):
+        return self.unfinished
+
+
+class TestB2Client:
+    @patch("b2.urllib.request.urlopen")
+    def test_reauthorizes_expired_token(self, mock_urlopen):
+        mock_urlopen.side_effect = [
+            _response(AUTH),
+            _http_error(401, "expired_auth_token"),
+            _response(AUTH),
+            _response({"fileId": "f"}),
+        ]
+        client = B2("acct", "key", "media")
+        assert client.call("b2_start_large_file", {}) == {"fileId": "f"}
+        assert client.bucket_id == "bucket-id"
+        req = mock_urlopen.call_args[0][0]
+        assert req.full_url == "https://api/b2api/v2/b2_start_large_file"
+        assert req.get_header("Authorization") == "token"
+
+    @patch("b2.urllib.request.urlopen")
+    def test_error_reply(self, mock_urlopen):
+        mock_urlopen.side_effect = [_response(AUTH), _http_error(400, "bad_request")]
+        with pytest.raises(B2Error) as e:
+            B2("acct", "key", "media").call("b2_list_parts", {})
+        assert e.value.status == 400
+        assert e.value.code == "bad_request"
+
+    @patch("b2.urllib.request.urlopen")
+    def test_looks_up_bucket(self, mock_urlopen):
+        mock_urlopen.side_effect = [
+            _response({**AUTH, "allowed": {}}),
+            _response({"buckets": [{"bucketId": "other-id"}]}),
+        ]
+        client = B2("acct", "key", "media")
+        client.authorize()
+        assert client.bucket_id == "other-id"
+
+
+@patch("b2.PART_SIZE", 4)
+class TestUploadLargeFile:
+    def test_uploads_parts(self, tmp_path, state):
+        f = tmp_path / "movie.mkv"
+        f.write_bytes(b"0123456789")
+        client = FakeB2()
+
+        assert upload_large_file(client, state, f, "movies/movie.mkv", 2)
+        assert sorted(client.uploaded) == [1, 2, 3]
+        info = client.started[0]["fileInfo"]
+        assert info["large_file_sha1"] == hashlib.sha1(b"0123456789").hexdigest()
+        assert info["src_last_modified_millis"] == str(
+            f.stat().st_mtime_ns // 1_000_000
+        )
+        assert client.finished[0]["partSha1Array"] == [
+            hashlib.sha1(part).hexdigest() for part in (b"0123", b"4567", b"89")
+        ]
+        # The finished session is no longer recorded
+        assert state.large_files() == []
+
+    def test_resumes_after_failure(self, tmp_path, state):
+        f = tmp_path / "movie.mkv"
+        f.write_bytes(b"0123456789")
+        client = FakeB2(fail_part=3)
+
+        with patch("b2.time.sleep"):
+            assert not upload_large_file(client, state, f, "movies/movie.mkv", 1)
+        assert state.large_file(f, "movies/movie.mkv")[2].keys() == {1, 2}
+
+        client.fail_part = None
+        client.uploaded.clear()
+        assert upload_large_file(client, state, f, "movies/movie.mkv", 1)
+        # Same session, only the missing part uploaded
+        assert len(client.started) == 1
+        assert client.uploaded == [3]
+        assert len(client.finished[0]["partSha1Array"]) == 3
+
+    def test_parts_hold_budget_transfers(self, tmp_path, state):
+        f = tmp_path / "movie.mkv"
+        f.write_bytes(b"0123456789")
+        client = FakeB2()
+        budget = TransferBudget(1)
+        lock = threading.Lock()
+        sending = [0, 0]
+        upload_part = client.upload_part
+
+        def slow_upload_part(*args):
+            with lock:
+                sending[0] += 1
+                sending[1] = max(sending)
+            time.sleep(0.01)
+            with lock:
+                sending[0] -= 1
+            return upload_part(*args)
+
+        client.upload_part = slow_upload_part
+        assert upload_large_file(client, state, f, "movies/movie.mkv", 3, budget=budget)
+        assert sorted(client.uploaded) == [1, 2, 3]
+        # Three threads, but one transfer in the budget
+        assert sending[1] == 1
+        assert budget.available == 1
+
+    def test_restarts_cancelled_session(self, tmp_path, state):
+        f = tmp_path / "movie.mkv"
+        f.write_bytes(b"0123456789")
+        state.start_large_file(f, "movies/movie.mkv", "gone", 4)
+        client = FakeB2()
+
+        assert upload_large_file(client, state, f, "movies/movie.mkv")
+        assert len(client.started) == 1
+        assert sorted(client.uploaded) == [1, 2, 3]
+
+
+class TestCancelAbandoned:
+    def test_cancels_stale_and_old_sessions(self, tmp_path, state):
+        f = tmp_path / "movie.mkv"
+        f.write_bytes(b"data")
+        changed = tmp_path / "changed.mkv"
+        changed.write_bytes(b"data")
+        state.start_large_file(f, "movies/movie.mkv", "live", 4)
+        state.start_large_file(changed, "movies/changed.mkv", "stale", 4)
+        changed.write_bytes(b"rewritten")
+        now_ms = int(time.time() * 1000)
+        client = FakeB2()
+        client.unfinished = [
+            {"fileId": "live", "fileName": "movie.mkv", "uploadTimestamp": 0},
+            {"fileId": "stale", "fileName": "changed.mkv", "uploadTimestamp": now_ms},
+            {"fileId": "old", "fileName": "old.mkv", "uploadTimestamp": 0},
+            {"fileId": "recent", "fileName": "rclone.mkv", "uploadTimestamp": now_ms},
+        ]
+
+        assert cancel_abandoned(client, state) == 2
+        assert sorted(client.cancelled) == ["old", "stale"]
+        assert [file_id for file_id, _, _ in state.large_files()] == ["live"]
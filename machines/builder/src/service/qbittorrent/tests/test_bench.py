@@ -0,0 +1,79 @@
+"""Tests for the synthetic-library benchmark (bench/bench.py)."""
+
+import json
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bench"))
+
+from bench import (  # noqa: E402
+    SCALES,
+    build_library,
+    count_fs_calls,
+    last_result,
+    run_benchmarks,
+)
+
+
+class TestCountFsCalls:
+    def test_counts_and_restores(self, tmp_path):
+        stat = os.stat
+        with count_fs_calls() as calls:
+            os.stat(tmp_path)
+            os.listdir(tmp_path)
+            os.stat(tmp_path)
+        os.stat(tmp_path)
+        assert calls["stat"] == 2
+        assert calls["listdir"] == 1
+        assert os.stat is stat
+
+
+class TestBuildLibrary:
+    def test_links_completed_into_arr(self, tmp_path):
+        torrents, uploaded, markers = build_library(tmp_path, **SCALES["tiny"])
+        episodes = list((tmp_path / "arr" / "tv").rglob("*.mkv"))
+        assert episodes
+        assert all(f.stat().st_nlink >= 2 for f in episodes)
+        assert list((tmp_path / "completed" / "tv").glob("Manual.*"))
+        assert all(Path(f"{m}.uploaded").exists() for m in markers)
+        assert uploaded
+        # Orphans: completed items no torrent points at
+        paths = {t["content_path"] for t in torrents}
+        items = list((tmp_path / "completed" / "tv").iterdir())
+        assert any(str(item) not in paths for item in items)
+
+
+class TestRunBenchmarks:
+    def test_tiny_scale(self, tmp_path):
+        results = run_benchmarks(tmp_path, SCALES["tiny"], repeat=1)
+        assert results["rclone_calls"] == 0
+        assert results["cleanup"]["cleaned"] > 0
+        steps = results["steps"]
+        assert set(steps) >= {
+            "scan_import_dir",
+            "propagate_markers",
+            "cleanup.scan_dir",
+            "cleanup_orphaned_records",
+        }
+        assert steps["cleanup.scan_dir"]["fs_calls"]["unlink"] > 0
+        assert "cleanup.hardlinks" in steps["cleanup.scan_dir"]["phases"]
+        json.dumps(results)
+
+
+class TestLastResult:
+    def test_last_of_scale(self, tmp_path):
+        path = tmp_path / "results.jsonl"
+        path.write_text(
+            json.dumps({"scale": "small", "commit": "a"})
+            + "\nnot json\n"
+            + json.dumps({"scale": "small", "commit": "b"})
+            + "\n"
+            + json.dumps({"scale": "full", "commit": "c"})
+            + "\n"
+        )
+        assert last_result(path, "small")["commit"] == "b"
+        assert last_result(path, "tiny") is None
+
+    def test_missing_file(self, tmp_path):
+        assert last_result(tmp_path / "missing.jsonl", "small") is None
@@ -0,0 +1,190 @@
+"""Tests for bwlimit.py — upload bandwidth control."""
+
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from bwlimit import (
+    BandwidthController,
+    Throttle,
+    format_rate,
+    parse_rate,
+    parse_timetable,
+    scheduled_rate,
+)
+from rc import RcError
+
+M = 1024**2
+
+
+def _controller(**kwargs):
+    args = {
+        "timetable": parse_timetable("18:00,4M 23:30,off"),
+        "uplink": 10 * M,
+        "floor": 1 * M,
+        "mount_rate": 2 * M,
+        "qbt_api_url": None,
+        "mount_rc_url": None,
+    }
+    args.update(kwargs)
+    return BandwidthController(**args)
+
+
+class TestRates:
+    def test_parse_rate(self):
+        assert parse_rate("4M") == 4 * M
+        assert parse_rate("512k") == 512 * 1024
+        assert parse_rate("100") == 100 * 1024
+        assert parse_rate("1.5G") == int(1.5 * 1024**3)
+        assert parse_rate("off") is None
+        assert parse_rate("0") is None
+        with pytest.raises(ValueError):
+            parse_rate("4X")
+
+    def test_format_rate(self):
+        assert format_rate(4 * M) == "4096K"
+        assert format_rate(None) == "off"
+
+    def test_timetable(self):
+        table = parse_timetable("23:30,off 18:00,4M")
+        assert table == [(18 * 60, 4 * M), (23 * 60 + 30, None)]
+        assert scheduled_rate(table, 19 * 60) == 4 * M
+        assert scheduled_rate(table, 23 * 60 + 45) is None
+        # Early morning is still covered by the previous evening's entry
+        assert scheduled_rate(table, 60) is None
+        assert scheduled_rate(parse_timetable("8M"), 60) == 8 * M
+        assert scheduled_rate([], 60) is None
+
+
+class TestThrottle:
+    @patch("bwlimit.time.sleep")
+    @patch("bwlimit.time.monotonic", return_value=100.0)
+    def test_paces_bytes(self, mock_monotonic, mock_sleep):
+        throttle = Throttle()
+        throttle.wait(10 * M)
+        mock_sleep.assert_not_called()
+
+        throttle.rate = 1 * M
+        throttle.wait(2 * M)
+        throttle.wait(2 * M)
+        # The second call waits for the first one's two seconds
+        mock_sleep.assert_called_once_with(2.0)
+
+
+class TestBandwidthController:
+    def test_target(self):
+        controller = _controller()
+        # Daytime: only the uplink left over by seeding
+        assert controller.target(12 * 60, 3 * M, False) == 7 * M
+        assert controller.target(12 * 60, 10 * M, False) == 1 * M
+        # Evening timetable entry
+        assert controller.target(19 * 60, 0, False) == 4 * M
+        # Mount transferring
+        assert controller.target(12 * 60, 0, True) == 2 * M
+
+    def test_unlimited(self):
+        controller = _controller(timetable=[], uplink=None, mount_rate=None)
+        assert controller.target(12 * 60, 5 * M, True) is None
+
+    @patch("bwlimit.rc_call")
+    def test_poll_applies_changes(self, mock_call):
+        controller = _controller(rc_url="http://rc", uplink=None, timetable=[])
+        controller.mount_busy = lambda: True
+        controller.poll()
+        mock_call.assert_called_once_with(
+            "http://rc", "core/bwlimit", {"rate": "2048K"}
+        )
+        assert controller.throttle.rate == 2 * M
+        assert controller.rate == 2 * M
+
+        # Unchanged limit isn't sent again
+        controller.poll()
+        mock_call.assert_called_once()
+
+    @patch("bwlimit.rc_call", side_effect=RcError("refused"))
+    def test_poll_retries_failed_apply(self, mock_call):
+        controller = _controller(rc_url="http://rc")
+        controller.poll()
+        assert controller.rate is False
+        assert controller.throttle.rate is None
+
+    @patch("bwlimit.rc_call")
+    def test_consumers_split_the_limit(self, mock_call):
+        controller = _controller(
+            rc_url="http://rc", timetable=parse_timetable("8M"), uplink=None
+        )
+        controller.poll()
+        with controller.consumer("rcd"):
+            # Alone on the rcd: all of it
+            assert controller.rcd_rate == 8 * M
+            with controller.consumer("throttle"), controller.consumer("throttle"):
+                assert controller.rcd_rate == 8 * M // 3
+                assert controller.throttle.rate == 2 * 8 * M // 3
+                with controller.consumer("process") as limit:
+                    # A process gets an equal part and holds it
+                    assert limit == "2048K"
+                    assert controller.rcd_rate == 2 * M
+                    assert controller.throttle.rate == 4 * M
+                    assert mock_call.call_args[0][2] == {"rate": "2048K"}
+        assert controller.active == {"rcd": 0, "throttle": 0, "process": 0}
+        assert controller.reserved == 0
+        assert mock_call.call_args[0][2] == {"rate": "8192K"}
+
+    @patch("bwlimit.rc_call")
+    def test_concurrent_consumers_stay_under_limit(self, mock_call):
+        limit = 8 * M
+        chunk = 64 * 1024
+        controller = _controller(
+            rc_url="http://rc", timetable=parse_timetable("8M"), uplink=None
+        )
+        controller.poll()
+        sent = []
+        start = threading.Barrier(4)
+
+        def stream():
+            with controller.consumer("throttle"):
+                start.wait()
+                for _ in range(8):
+                    controller.throttle.wait(chunk)
+                    sent.append(chunk)
+                start.wait()
+
+        with controller.consumer("rcd"), controller.consumer("process") as held:
+            threads = [threading.Thread(target=stream) for _ in range(3)]
+            for t in threads:
+                t.start()
+            start.wait()
+            began = time.monotonic()
+            rcd_rate = controller.rcd_rate
+            # The parts add up to the limit
+            assert rcd_rate + controller.throttle.rate + parse_rate(held) <= limit
+            start.wait()
+            elapsed = time.monotonic() - began
+            for t in threads:
+                t.join()
+        # Measured: the streams' bytes (but the first chunk, sent at once)
+        # next to the rcd's and the process's parts
+        streamed = (sum(sent) - chunk) / elapsed
+        assert streamed + rcd_rate + parse_rate(held) <= limit * 1.05
+
+    @patch("bwlimit.urllib.request.urlopen")
+    def test_seeding_rate(self, mock_urlopen):
+        mock_urlopen.return_value.read.return_value = b'{"up_info_speed": 1234}'
+        controller = _controller(qbt_api_url="http://qbt/api/v2")
+        assert controller.seeding_rate() == 1234
+        assert mock_urlopen.call_args[0][0] == "http://qbt/api/v2/transfer/info"
+
+        mock_urlopen.side_effect = OSError("refused")
+        assert controller.seeding_rate() == 0
+
+    @patch("bwlimit.rc_call")
+    def test_mount_busy(self, mock_call):
+        controller = _controller(mount_rc_url="http://mount")
+        mock_call.return_value = {"transferring": [{"name": "tv/ep.mkv"}]}
+        assert controller.mount_busy()
+        mock_call.return_value = {"speed": 0}
+        assert not controller.mount_busy()
+        mock_call.side_effect = RcError("refused")
+        assert not controller.mount_busy()
@@ -8,7 +8,7 @@ from pathlib import Path
 from unittest.mock import MagicMock, patch
 
 from cleanup import (
-    cleanup_orphaned_markers,
+    cleanup_orphaned_records,
     collect_inodes,
     fetch_torrents,
     find_torrent_by_path,
@@ -19,6 +19,7 @@ from cleanup import (
     scan_dir,
     should_keep_seeding,
 )
+from walk import Tree
 
 
 class TestFetchTorrents:
@@ -126,7 +127,7 @@ class TestCollectInodes:
 
 
 class TestRemoveHardlinks:
-    def test_removes_by_inode(self, tmp_path):
+    def test_removes_by_inode(self, tmp_path, state):
         """Hard links in import dirs sharing an inode with the source get deleted."""
         completed = tmp_path / "completed"
         completed.mkdir()
@@ -142,14 +143,36 @@ class TestRemoveHardlinks:
         # Verify they share an inode
         assert os.stat(source).st_ino == os.stat(hardlink).st_ino
 
-        remove_hardlinks(source, [str(import_dir)])
+        remove_hardlinks(source, [str(import_dir)], state)
 
         # Hard link should be removed
         assert not hardlink.exists()
         # Source should still exist (we only remove from import dirs)
         assert source.exists()
 
-    def test_removes_directory_hardlinks(self, tmp_path):
+    def test_shared_tree_across_items(self, tmp_path, state):
+        """One listing serves every item of a run and tracks deletions."""
+        completed = tmp_path / "completed"
+        completed.mkdir()
+        season = tmp_path / "import" / "Show" / "Season 1"
+        season.mkdir(parents=True)
+        for name in ("ep1.mkv", "ep2.mkv"):
+            (completed / name).write_bytes(name.encode())
+            os.link(completed / name, season / name)
+        import_dirs = [str(tmp_path / "import")]
+        tree = Tree([completed] + import_dirs)
+
+        remove_hardlinks(completed / "ep1.mkv", import_dirs, state, tree)
+        assert not (season / "ep1.mkv").exists()
+        # Season 1 still has ep2.mkv — not pruned
+        assert season.exists()
+
+        with patch("walk.os.scandir", side_effect=AssertionError):
+            remove_hardlinks(completed / "ep2.mkv", import_dirs, state, tree)
+        assert not (tmp_path / "import" / "Show").exists()
+        assert (tmp_path / "import").exists()
+
+    def test_removes_directory_hardlinks(self, tmp_path, state):
         """Hard links from files inside a directory are found and removed."""
         completed = tmp_path / "completed"
         show_completed = completed / "show"
@@ -162,10 +185,10 @@ class TestRemoveHardlinks:
         hardlink = import_dir / "Show - S01E01.mkv"
         os.link(source, hardlink)
 
-        remove_hardlinks(show_completed, [str(tmp_path / "import")])
+        remove_hardlinks(show_completed, [str(tmp_path / "import")], state)
         assert not hardlink.exists()
 
-    def test_prunes_empty_dirs_after(self, tmp_path):
+    def test_prunes_empty_dirs_after(self, tmp_path, state):
         """Empty directories are pruned after hardlink removal."""
         completed = tmp_path / "completed"
         completed.mkdir()
@@ -176,7 +199,7 @@ class TestRemoveHardlinks:
         source.write_bytes(b"data")
         os.link(source, import_dir / "ep.mkv")
 
-        remove_hardlinks(source, [str(tmp_path / "import")])
+        remove_hardlinks(source, [str(tmp_path / "import")], state)
 
         # Season 1/ and Show/ should be pruned (empty after deletion)
         assert not (tmp_path / "import" / "Show" / "Season 1").exists()
@@ -184,7 +207,7 @@ class TestRemoveHardlinks:
         # import/ root still exists
         assert (tmp_path / "import").exists()
 
-    def test_cleans_sibling_subtitles(self, tmp_path):
+    def test_cleans_sibling_subtitles(self, tmp_path, state):
         """Non-hard-linked sibling files (e.g. Radarr-copied subs) are cleaned up."""
         completed = tmp_path / "completed"
         completed.mkdir()
@@ -198,22 +221,24 @@ class TestRemoveHardlinks:
 
         # Simulate Radarr copying the subtitle (different inode, not a hard link)
         (import_dir / "release.spa.srt").write_bytes(b"subtitle data")
-        (import_dir / "release.spa.srt.uploaded").touch()
+        state.mark(import_dir / "release.spa.srt", "movies/release.spa.srt")
+        state.mark(import_dir / "release.mkv", "movies/release.mkv")
+        # Leftover marker from before the state database
         (import_dir / "release.mkv.uploaded").touch()
 
-        remove_hardlinks(source_mkv, [str(tmp_path / "import")])
+        remove_hardlinks(source_mkv, [str(tmp_path / "import")], state)
 
         # Hard-linked .mkv is removed
         assert not (import_dir / "release.mkv").exists()
         # Sibling subtitle (shares stem "release") is also removed
         assert not (import_dir / "release.spa.srt").exists()
-        # Markers are also removed
-        assert not (import_dir / "release.spa.srt.uploaded").exists()
+        # Leftover markers and upload records are also removed
         assert not (import_dir / "release.mkv.uploaded").exists()
+        assert state.uploads == {}
         # Directory pruned since now empty
         assert not import_dir.exists()
 
-    def test_sibling_cleanup_preserves_unrelated(self, tmp_path):
+    def test_sibling_cleanup_preserves_unrelated(self, tmp_path, state):
         """Sibling cleanup only removes files matching the deleted file's stem."""
         completed = tmp_path / "completed"
         completed.mkdir()
@@ -229,17 +254,17 @@ class TestRemoveHardlinks:
         (import_dir / "ep2.mkv").write_bytes(b"episode 2")
         (import_dir / "ep2.srt").write_bytes(b"sub 2")
 
-        remove_hardlinks(ep1_source, [str(tmp_path / "import")])
+        remove_hardlinks(ep1_source, [str(tmp_path / "import")], state)
 
         assert not (import_dir / "ep1.mkv").exists()
         assert (import_dir / "ep2.mkv").exists()
         assert (import_dir / "ep2.srt").exists()
 
-    def test_no_import_dirs(self, tmp_path):
+    def test_no_import_dirs(self, tmp_path, state):
         """No crash when import dirs don't exist."""
         f = tmp_path / "file.mkv"
         f.write_bytes(b"data")
-        remove_hardlinks(f, ["/nonexistent/dir"])
+        remove_hardlinks(f, ["/nonexistent/dir"], state)
 
 
 class TestPruneEmptyDirs:
@@ -317,32 +342,28 @@ class TestShouldKeepSeeding:
         assert keep is True  # >= threshold
 
 
-class TestCleanupOrphanedMarkers:
-    def test_removes_orphaned(self, tmp_path):
-        # Marker with no corresponding file
-        (tmp_path / "episode.mkv.uploaded").touch()
-        cleanup_orphaned_markers([str(tmp_path)])
-        assert not (tmp_path / "episode.mkv.uploaded").exists()
-
-    def test_keeps_valid(self, tmp_path):
-        (tmp_path / "episode.mkv").write_bytes(b"data")
-        (tmp_path / "episode.mkv.uploaded").touch()
-        cleanup_orphaned_markers([str(tmp_path)])
-        assert (tmp_path / "episode.mkv.uploaded").exists()
+class TestCleanupOrphanedRecords:
+    def test_drops_missing(self, tmp_path, state):
+        f = tmp_path / "episode.mkv"
+        f.write_bytes(b"data")
+        state.mark(f, "tv/episode.mkv")
+        f.unlink()
+        assert cleanup_orphaned_records(state) == 1
+        assert state.uploads == {}
 
-    def test_nested_markers(self, tmp_path):
-        show_dir = tmp_path / "Show" / "Season 1"
-        show_dir.mkdir(parents=True)
-        (show_dir / "ep.mkv.uploaded").touch()  # orphaned
-        cleanup_orphaned_markers([str(tmp_path)])
-        assert not (show_dir / "ep.mkv.uploaded").exists()
+    def test_keeps_valid(self, tmp_path, state):
+        f = tmp_path / "episode.mkv"
+        f.write_bytes(b"data")
+        state.mark(f, "tv/episode.mkv")
+        assert cleanup_orphaned_records(state) == 0
+        assert state.is_uploaded(f, "tv/episode.mkv")
 
 
 class TestScanDir:
     def _make_stats(self):
         return {"cleaned": 0, "seeding": 0, "skipped": 0}
 
-    def test_skips_not_uploaded(self, tmp_path):
+    def test_skips_not_uploaded(self, tmp_path, state):
         (tmp_path / "file.mkv").write_bytes(b"data")
         stats = self._make_stats()
         scan_dir(
@@ -355,11 +376,12 @@ class TestScanDir:
             [],
             set(),
             stats,
+            state,
         )
         assert stats["skipped"] == 1
         assert (tmp_path / "file.mkv").exists()  # not deleted
 
-    def test_skips_category_dirs(self, tmp_path):
+    def test_skips_category_dirs(self, tmp_path, state):
         tv_dir = tmp_path / "tv"
         tv_dir.mkdir()
         stats = self._make_stats()
@@ -373,17 +395,18 @@ class TestScanDir:
             [],
             {str(tv_dir)},
             stats,
+            state,
         )
         assert stats == self._make_stats()  # Nothing processed
         assert tv_dir.exists()
 
     @patch("cleanup.remove_torrent", return_value=True)
     @patch("cleanup.remove_hardlinks")
-    def test_cleans_orphan(self, mock_hardlinks, mock_remove, tmp_path):
+    def test_cleans_orphan(self, mock_hardlinks, mock_remove, tmp_path, state):
         """Items not tracked by qBittorrent (orphans) are cleaned immediately."""
         f = tmp_path / "movie.mkv"
         f.write_bytes(b"data")
-        (tmp_path / "movie.mkv.uploaded").touch()
+        state.mark(f, "downloads/movie.mkv")
 
         stats = self._make_stats()
         scan_dir(
@@ -396,20 +419,21 @@ class TestScanDir:
             ["/import"],
             set(),
             stats,
+            state,
         )
         assert stats["cleaned"] == 1
         assert not f.exists()
-        assert not (tmp_path / "movie.mkv.uploaded").exists()
+        assert state.uploads == {}
         mock_hardlinks.assert_called_once()
         mock_remove.assert_not_called()  # Not tracked, no torrent to remove
 
     @patch("cleanup.remove_torrent", return_value=True)
     @patch("cleanup.remove_hardlinks")
-    def test_removes_stale_torrent(self, mock_hardlinks, mock_remove, tmp_path):
+    def test_removes_stale_torrent(self, mock_hardlinks, mock_remove, tmp_path, state):
         """Stale torrents (old + slow) are removed via API and cleaned up."""
         f = tmp_path / "movie.mkv"
         f.write_bytes(b"data")
-        (tmp_path / "movie.mkv.uploaded").touch()
+        state.mark(f, "downloads/movie.mkv")
 
         now = 1_000_000
         torrents = [
@@ -433,16 +457,17 @@ class TestScanDir:
             ["/import"],
             set(),
             stats,
+            state,
         )
         assert stats["cleaned"] == 1
         mock_remove.assert_called_once_with("http://api", "abc123")
         assert not f.exists()
 
-    def test_keeps_seeding(self, tmp_path):
+    def test_keeps_seeding(self, tmp_path, state):
         """Torrents within seeding period are kept."""
         f = tmp_path / "movie.mkv"
         f.write_bytes(b"data")
-        (tmp_path / "movie.mkv.uploaded").touch()
+        state.mark(f, "downloads/movie.mkv")
 
         now = 1_000_000
         torrents = [
@@ -466,15 +491,16 @@ class TestScanDir:
             [],
             set(),
             stats,
+            state,
         )
         assert stats["seeding"] == 1
         assert f.exists()  # Not deleted
 
-    def test_keeps_active_upload(self, tmp_path):
+    def test_keeps_active_upload(self, tmp_path, state):
         """Torrents past min age but actively uploading are kept."""
         f = tmp_path / "movie.mkv"
         f.write_bytes(b"data")
-        (tmp_path / "movie.mkv.uploaded").touch()
+        state.mark(f, "downloads/movie.mkv")
 
         now = 1_000_000
         age = 15 * 86400
@@ -499,18 +525,19 @@ class TestScanDir:
             [],
             set(),
             stats,
+            state,
         )
         assert stats["seeding"] == 1
         assert f.exists()
 
     @patch("cleanup.remove_torrent", return_value=True)
     @patch("cleanup.remove_hardlinks")
-    def test_cleans_directory(self, mock_hardlinks, mock_remove, tmp_path):
+    def test_cleans_directory(self, mock_hardlinks, mock_remove, tmp_path, state):
         """Directory items are cleaned up with shutil.rmtree."""
         d = tmp_path / "show-dir"
         d.mkdir()
         (d / "ep1.mkv").write_bytes(b"data")
-        (tmp_path / "show-dir.uploaded").touch()
+        state.mark(d, "downloads/show-dir")
 
         stats = self._make_stats()
         scan_dir(
@@ -523,6 +550,7 @@ class TestScanDir:
             ["/import"],
             set(),
             stats,
+            state,
         )
         assert stats["cleaned"] == 1
         assert not d.exists()
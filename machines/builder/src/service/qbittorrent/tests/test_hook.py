@@ -0,0 +1,68 @@
+"""Tests for hook.py — qBittorrent completion hook."""
+
+import select
+import socket
+import time
+
+from hook import HookListener, send_completion
+
+
+def _receive(listener, count):
+    """Wait for count completions from the listener's thread."""
+    completions = []
+    deadline = time.monotonic() + 5
+    while len(completions) < count and time.monotonic() < deadline:
+        select.select([listener], [], [], 0.1)
+        completions += listener.receive()
+    return completions
+
+
+class TestHook:
+    def test_round_trip(self, tmp_path):
+        path = str(tmp_path / "hook.sock")
+        listener = HookListener(path)
+        assert send_completion(path, "abc123", "tv", "/completed/tv/Show.S01E01")
+        assert send_completion(path, "def456", "", "/completed/film.mkv")
+        assert _receive(listener, 2) == [
+            ("abc123", "tv", "/completed/tv/Show.S01E01"),
+            ("def456", "", "/completed/film.mkv"),
+        ]
+        assert listener.receive() == []
+        listener.close()
+
+    def test_no_listener(self, tmp_path, capsys):
+        assert not send_completion(str(tmp_path / "hook.sock"), "abc", "", "/x")
+        assert "not listening" in capsys.readouterr().out
+
+    def test_full_queue_drops_message(self, tmp_path, capsys):
+        path = str(tmp_path / "hook.sock")
+        # A daemon that never reads: sending must not block
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.bind(path)
+            for _ in range(100_000):
+                if not send_completion(path, "abc", "", "/x"):
+                    break
+            else:
+                raise AssertionError("the socket queue never filled up")
+        assert "busy, dropping" in capsys.readouterr().out
+
+    def test_replaces_stale_socket(self, tmp_path):
+        path = str(tmp_path / "hook.sock")
+        # Left behind by a daemon that was killed
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as stale:
+            stale.bind(path)
+        listener = HookListener(path)
+        assert send_completion(path, "abc", "", "/x")
+        assert len(_receive(listener, 1)) == 1
+        listener.close()
+
+    def test_bad_message_dropped(self, tmp_path, capsys):
+        path = str(tmp_path / "hook.sock")
+        listener = HookListener(path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b"not json", path)
+            sock.sendto(b'{"hash": "abc"}', path)
+        assert send_completion(path, "abc", "", "/x")
+        assert _receive(listener, 1) == [("abc", "", "/x")]
+        assert "Ignoring bad completion message" in capsys.readouterr().out
+        listener.close()
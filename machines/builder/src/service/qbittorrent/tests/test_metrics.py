@@ -0,0 +1,63 @@
+"""Tests for metrics.py — Prometheus textfile output."""
+
+import os
+
+from metrics import Metrics
+
+DEFINITIONS = {
+    "items_total": ("counter", "Items uploaded.", None),
+    "pending": ("gauge", "Items waiting.", None),
+    "seconds": ("histogram", "Job duration.", (1, 10)),
+}
+
+
+class TestMetrics:
+    def test_render(self):
+        metrics = Metrics(None, DEFINITIONS)
+        metrics.inc("items_total", category="tv")
+        metrics.inc("items_total", 2, category="tv")
+        metrics.inc("items_total", category='we"ird')
+        metrics.set("pending", 4)
+        metrics.observe("seconds", 0.5, category="tv")
+        metrics.observe("seconds", 30, category="tv")
+
+        assert metrics.render() == (
+            "# HELP items_total Items uploaded.\n"
+            "# TYPE items_total counter\n"
+            'items_total{category="tv"} 3\n'
+            'items_total{category="we\\"ird"} 1\n'
+            "# HELP pending Items waiting.\n"
+            "# TYPE pending gauge\n"
+            "pending 4\n"
+            "# HELP seconds Job duration.\n"
+            "# TYPE seconds histogram\n"
+            'seconds_bucket{category="tv",le="1"} 1\n'
+            'seconds_bucket{category="tv",le="10"} 1\n'
+            'seconds_bucket{category="tv",le="+Inf"} 2\n'
+            'seconds_sum{category="tv"} 30.5\n'
+            'seconds_count{category="tv"} 2\n'
+        )
+
+    def test_total(self):
+        metrics = Metrics(None, DEFINITIONS)
+        assert metrics.total("items_total") == 0
+        metrics.inc("items_total", 3, category="tv")
+        metrics.inc("items_total", 2, category="movies")
+        assert metrics.total("items_total") == 5
+
+    def test_write_replaces_file(self, tmp_path):
+        path = tmp_path / "qbt-upload.prom"
+        metrics = Metrics(str(path), DEFINITIONS)
+        metrics.set("pending", 1)
+        metrics.write()
+        metrics.set("pending", 0)
+        metrics.write()
+        assert "pending 0\n" in path.read_text()
+        assert os.listdir(tmp_path) == ["qbt-upload.prom"]
+        assert path.stat().st_mode & 0o777 == 0o644
+
+    def test_write_without_path(self, tmp_path):
+        Metrics(None, DEFINITIONS).write()
+
+    def test_unwritable_directory(self, tmp_path):
+        Metrics(str(tmp_path / "missing" / "x.prom"), DEFINITIONS).write()
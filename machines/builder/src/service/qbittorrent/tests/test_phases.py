@@ -0,0 +1,64 @@
+"""Tests for phases.py — per-phase timing and profiling."""
+
+import pstats
+from unittest.mock import patch
+
+from phases import Phases, profiled
+
+
+class TestPhases:
+    def test_summary(self):
+        phases = Phases()
+        with patch("phases.time.monotonic", side_effect=[10.0, 12.5, 13.0, 13.5, 20.0]):
+            with phases.phase("list"):
+                pass
+            with phases.phase("upload"):
+                pass
+            phases.count("list", entries=4000)
+            phases.count("upload", nbytes=2_500_000)
+            phases.add("upload", 1.0)
+            assert phases.summary() == (
+                "10.0s: list 2.5s (4000 entries), upload 1.5s x2 (2.5 MB)"
+            )
+
+    def test_timed(self):
+        phases = Phases()
+
+        @phases.timed("check")
+        def check(value):
+            return value * 2
+
+        assert check(2) == 4
+        assert check(3) == 6
+        assert phases.totals["check"][1] == 2
+
+    def test_report_resets(self, capsys):
+        phases = Phases()
+        with phases.phase("scan"):
+            pass
+        phases.report("Upload run")
+        assert capsys.readouterr().out.startswith("Upload run ")
+        assert phases.totals == {}
+        assert phases.summary() == "0.0s: nothing done"
+
+    def test_failed_call_still_timed(self):
+        phases = Phases()
+        try:
+            with phases.phase("extract"):
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        assert phases.totals["extract"][1] == 1
+
+
+class TestProfiled:
+    def test_writes_stats(self, tmp_path):
+        path = tmp_path / "run.prof"
+        with profiled(str(path)):
+            sorted(range(1000))
+        assert pstats.Stats(str(path)).total_calls > 0
+
+    def test_disabled(self, tmp_path):
+        with profiled(None):
+            pass
+        assert list(tmp_path.iterdir()) == []
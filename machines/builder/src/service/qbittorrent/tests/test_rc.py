@@ -0,0 +1,75 @@
+"""Tests for rc.py — rclone remote control client."""
+
+import io
+import json
+import urllib.error
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from rc import RcError, rc_call, rc_job
+
+
+def _response(data):
+    resp = MagicMock()
+    resp.read.return_value = json.dumps(data).encode()
+    resp.__enter__.return_value = resp
+    return resp
+
+
+class TestRcCall:
+    @patch("rc.urllib.request.urlopen")
+    def test_posts_json(self, mock_urlopen):
+        mock_urlopen.return_value = _response({"jobid": 7})
+        assert rc_call("http://rc/", "sync/copy", {"srcFs": "/a"}) == {"jobid": 7}
+        req = mock_urlopen.call_args[0][0]
+        assert req.full_url == "http://rc/sync/copy"
+        assert req.get_method() == "POST"
+        assert json.loads(req.data) == {"srcFs": "/a"}
+
+    @patch("rc.urllib.request.urlopen")
+    def test_error_reply(self, mock_urlopen):
+        body = io.BytesIO(json.dumps({"error": "directory not found"}).encode())
+        mock_urlopen.side_effect = urllib.error.HTTPError(
+            "http://rc/operations/list", 404, "Not Found", {}, body
+        )
+        with pytest.raises(RcError, match="directory not found"):
+            rc_call("http://rc", "operations/list")
+
+    @patch("rc.urllib.request.urlopen")
+    def test_unreachable(self, mock_urlopen):
+        mock_urlopen.side_effect = urllib.error.URLError("refused")
+        with pytest.raises(RcError):
+            rc_call("http://rc", "core/stats")
+
+
+class TestRcJob:
+    @patch("rc.time.sleep")
+    @patch("rc.rc_call")
+    def test_waits_for_job(self, mock_call, mock_sleep):
+        mock_call.side_effect = [
+            {"jobid": 3},
+            {"finished": False},
+            {"finished": True, "success": True},
+            {"transferred": [{"name": "a.mkv", "error": ""}]},
+            {},
+        ]
+        error, transferred = rc_job("http://rc", "sync/copy", {"srcFs": "/a"})
+        assert error is None
+        assert transferred == {"a.mkv": ""}
+        assert mock_call.call_args_list[0][0][2] == {"srcFs": "/a", "_async": True}
+        assert mock_call.call_args_list[3][0][2] == {"group": "job/3"}
+        assert mock_call.call_args_list[4][0][1] == "core/stats-delete"
+        mock_sleep.assert_called_once()
+
+    @patch("rc.rc_call")
+    def test_failed_job(self, mock_call):
+        mock_call.side_effect = [
+            {"jobid": 3},
+            {"finished": True, "success": False, "error": "1 error"},
+            {"transferred": [{"name": "b.mkv", "error": "timeout"}]},
+            {},
+        ]
+        error, transferred = rc_job("http://rc", "sync/copy", {})
+        assert error == "1 error"
+        assert transferred == {"b.mkv": "timeout"}
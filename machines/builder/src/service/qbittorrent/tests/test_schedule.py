@@ -0,0 +1,125 @@
+"""Tests for schedule.py — upload queue ordering."""
+
+import os
+import time
+from unittest.mock import patch
+
+import pytest
+
+from schedule import Scheduler, item_info
+
+
+def _file(path, size, mtime):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+class TestItemInfo:
+    def test_directory(self, tmp_path):
+        release = tmp_path / "release"
+        _file(release / "a.mkv", 3, 100)
+        _file(release / "sub" / "b.nfo", 2, 200)
+        assert item_info(release, "tv/") == (5, 200 * 10**9, False)
+
+    def test_seeding(self, tmp_path):
+        ep = _file(tmp_path / "ep.mkv", 1, 100)
+        # A copy: no seeding copy waits for the upload
+        assert not item_info(ep, "tv/")[2]
+        # Uncategorized downloads seed from the item itself
+        assert item_info(ep, "downloads/")[2]
+        # Hard linked from completed/: the seeding copy waits for the upload
+        os.link(ep, tmp_path / "seeding.mkv")
+        assert item_info(ep, "tv/")[2]
+
+
+class TestScheduler:
+    def test_rejects_unknown_policy(self):
+        with pytest.raises(ValueError):
+            Scheduler("largest")
+
+    def test_oldest_first(self, tmp_path):
+        new = _file(tmp_path / "new.mkv", 1, 300)
+        old = _file(tmp_path / "old.mkv", 1, 100)
+        pending = [(new, "tv/"), (old, "tv/")]
+        assert Scheduler("oldest").order(pending) == [(old, "tv/"), (new, "tv/")]
+
+    def test_smallest_first(self, tmp_path):
+        big = _file(tmp_path / "big.mkv", 10, 100)
+        small = _file(tmp_path / "small.mkv", 1, 300)
+        pending = [(big, "tv/"), (small, "tv/")]
+        assert Scheduler("smallest").order(pending) == [
+            (small, "tv/"),
+            (big, "tv/"),
+        ]
+
+    def test_pressure_blocking_first(self, tmp_path):
+        old = _file(tmp_path / "old.mkv", 1, 100)
+        linked = _file(tmp_path / "linked.mkv", 1, 300)
+        os.link(linked, tmp_path / "seeding.mkv")
+        pending = [(old, "tv/"), (linked, "tv/")]
+        assert Scheduler("pressure").order(pending) == [
+            (linked, "tv/"),
+            (old, "tv/"),
+        ]
+
+    def test_pressure_waits_for_seeding_period(self, tmp_path):
+        hour = 3600
+        now = time.time()
+        copy = _file(tmp_path / "copy.mkv", 1, now - 1000 * hour)
+        linked = _file(tmp_path / "linked.mkv", 1, now - 500 * hour)
+        (tmp_path / "seeding").mkdir()
+        os.link(linked, tmp_path / "seeding" / "linked.mkv")
+        fresh = _file(tmp_path / "fresh.mkv", 1, now - 10 * hour)
+        os.link(fresh, tmp_path / "seeding" / "fresh.mkv")
+        pending = [(fresh, "tv/"), (linked, "tv/"), (copy, "tv/")]
+
+        def order(policy):
+            scheduler = Scheduler(policy, min_seeding=340 * hour)
+            return [item for item, _ in scheduler.order(pending)]
+
+        assert order("oldest") == [copy, linked, fresh]
+        # Only linked.mkv's seeding copy is due for cleanup
+        assert order("pressure") == [linked, copy, fresh]
+
+    def test_keeps_item_info(self, tmp_path):
+        ep = _file(tmp_path / "ep.mkv", 3, 100)
+        info = {}
+        Scheduler().order([(ep, "tv/")], info)
+        assert info == {ep: (3, 100 * 10**9, False)}
+        with patch("schedule.item_info") as mock_info:
+            Scheduler().order([(ep, "tv/")], info)
+        mock_info.assert_not_called()
+
+    def test_switches_to_pressure_when_disk_full(self, tmp_path):
+        scheduler = Scheduler("smallest", min_free=0.1)
+        with patch("schedule.os.statvfs") as mock_statvfs:
+            mock_statvfs.return_value.f_blocks = 100
+            mock_statvfs.return_value.f_bavail = 50
+            assert scheduler.current_policy(tmp_path) == "smallest"
+            mock_statvfs.return_value.f_bavail = 5
+            assert scheduler.current_policy(tmp_path) == "pressure"
+
+    def test_categories_share_by_bytes(self, tmp_path):
+        movie = _file(tmp_path / "movie.mkv", 100, 100)
+        eps = [_file(tmp_path / f"ep{i}.mkv", 30, 200 + i) for i in range(4)]
+        pending = [(movie, "movies/")] + [(ep, "tv/") for ep in eps]
+
+        order = [item for item, _ in Scheduler("oldest").order(pending)]
+        # The movie goes first (oldest), then tv/ catches up on bytes
+        assert order == [movie, eps[0], eps[1], eps[2], eps[3]]
+
+        pending.append((_file(tmp_path / "movie2.mkv", 10, 50), "movies/"))
+        order = [item for item, _ in Scheduler("oldest").order(pending)]
+        assert order == [
+            tmp_path / "movie2.mkv",
+            eps[0],
+            movie,
+            eps[1],
+            eps[2],
+            eps[3],
+        ]
+
+    def test_empty(self):
+        assert Scheduler().order([]) == []
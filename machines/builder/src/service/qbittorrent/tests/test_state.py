@@ -0,0 +1,302 @@
+"""Tests for state.py — persistent upload state."""
+
+import os
+from unittest.mock import patch
+
+from state import UploadState, file_key, open_state
+
+
+class TestUploadState:
+    def test_mark_and_lookup(self, tmp_path, state):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        assert not state.is_uploaded(f)
+        state.mark(f, "tv/ep.mkv")
+        assert state.is_uploaded(f)
+        assert state.is_uploaded(f, "tv/ep.mkv")
+        assert not state.is_uploaded(f, "tv/other.mkv")
+
+    def test_persists_across_runs(self, tmp_path):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        db = tmp_path / "state.db"
+        first = UploadState(db)
+        first.mark(f, "tv/ep.mkv")
+        first.close()
+
+        second = UploadState(db)
+        assert second.is_uploaded(f, "tv/ep.mkv")
+        second.close()
+
+    def test_hardlinks_share_record(self, tmp_path, state):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        link = tmp_path / "Show - S01E01.mkv"
+        os.link(f, link)
+        state.mark(link, "tv/Show - S01E01.mkv")
+        assert state.is_uploaded(f)
+
+    def test_rewritten_file_not_uploaded(self, tmp_path, state):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        state.mark(f, "tv/ep.mkv")
+        f.write_bytes(b"new and longer data")
+        assert not state.is_uploaded(f)
+
+    def test_directory_ignores_contents(self, tmp_path, state):
+        """Adding a file inside a directory item doesn't invalidate it."""
+        d = tmp_path / "release"
+        d.mkdir()
+        state.mark(d, "downloads/release")
+        (d / "extra.nfo").write_bytes(b"nfo")
+        assert state.is_uploaded(d)
+
+    def test_forget_subtree(self, tmp_path, state):
+        d = tmp_path / "release"
+        d.mkdir()
+        f = d / "ep.mkv"
+        f.write_bytes(b"data")
+        sibling = tmp_path / "release-2"
+        sibling.mkdir()
+        state.mark(d, "downloads/release")
+        state.mark(f, "tv/ep.mkv")
+        state.mark(sibling, "downloads/release-2")
+
+        assert state.forget(d) == 2
+        assert not state.is_uploaded(d)
+        assert not state.is_uploaded(f)
+        # Prefix match only applies to real subpaths
+        assert state.is_uploaded(sibling)
+
+    def test_manifest_round_trip(self, tmp_path):
+        db = tmp_path / "state.db"
+        first = UploadState(db)
+        assert first.load_manifest(3600) is False
+        first.replace_manifest({"tv/ep.mkv": (4, 123, "abc")})
+        first.close()
+
+        second = UploadState(db)
+        assert second.manifest is None
+        assert second.load_manifest(3600) is True
+        assert second.manifest == {"tv/ep.mkv": (4, 123, "abc")}
+        # Every listing is stale with a negative max age
+        second.manifest = None
+        assert second.load_manifest(-1) is False
+        assert second.manifest is None
+        second.close()
+
+    def test_content_index(self, tmp_path):
+        db = tmp_path / "state.db"
+        first = UploadState(db)
+        first.replace_manifest(
+            {
+                "downloads/b.mkv": (4, 1, "abc"),
+                "downloads/a.mkv": (4, 2, "abc"),
+                "tv/nohash.mkv": (9, 3, None),
+            }
+        )
+        assert first.find_object(4, "abc") == "downloads/a.mkv"
+        assert first.find_object(4, "def") is None
+        assert not first.has_object_size(9)
+        first.add_object("tv/ep.mkv", 5, 4, "def")
+        assert first.find_object(5, "def") == "tv/ep.mkv"
+        assert first.manifest["tv/ep.mkv"] == (5, 4, "def")
+        first.close()
+
+        second = UploadState(db)
+        assert second.load_manifest(3600)
+        assert second.find_object(5, "def") == "tv/ep.mkv"
+        # Removing the indexed object falls back to another with that content
+        second.remove_object("downloads/a.mkv")
+        assert "downloads/a.mkv" not in second.manifest
+        assert second.find_object(4, "abc") == "downloads/b.mkv"
+        second.remove_object("downloads/b.mkv")
+        assert not second.has_object_size(4)
+        second.close()
+
+    def test_destinations(self, tmp_path, state):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        assert state.destinations(f.stat()) == {}
+        state.mark(f, "tv/ep.mkv")
+        state.mark(f, "")
+        assert state.destinations(f.stat()) == {"tv/ep.mkv": str(f), "": str(f)}
+
+    def test_reload_sees_other_writers(self, tmp_path, state):
+        """A long-running upload daemon picks up records cleanup removed."""
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        state.mark(f, "tv/ep.mkv")
+        other = UploadState(state.db_path)
+        other.forget(f)
+        other.close()
+
+        assert state.is_uploaded(f)
+        state.reload()
+        assert not state.is_uploaded(f)
+
+    def test_sha1_cached_per_inode(self, tmp_path, state):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        link = tmp_path / "Show - S01E01.mkv"
+        os.link(f, link)
+        assert state.sha1(f) == "a17c9aaa61e80a1bf71d0d850af4e5baa9800bbd"
+
+        # The hard link is served from the cache without reading the file
+        with patch("builtins.open", side_effect=AssertionError):
+            assert state.sha1(link) == "a17c9aaa61e80a1bf71d0d850af4e5baa9800bbd"
+
+    def test_sha1_rehashes_modified_file(self, tmp_path, state):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        first = state.sha1(f)
+        f.write_bytes(b"other")
+        assert state.sha1(f) != first
+        assert state.sha1(tmp_path / "missing") is None
+
+    def test_cached_sha1_never_hashes(self, tmp_path, state):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        assert state.cached_sha1(f.stat()) is None
+        state.sha1(f)
+        assert state.cached_sha1(f.stat()) == "a17c9aaa61e80a1bf71d0d850af4e5baa9800bbd"
+
+    def test_forget_drops_hashes(self, tmp_path, state):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        state.sha1(f)
+        state.forget(f)
+        assert state.db.execute("SELECT COUNT(*) FROM hashes").fetchone() == (0,)
+
+    def test_dir_snapshots(self, tmp_path):
+        d = tmp_path / "Season 1"
+        d.mkdir()
+        db = tmp_path / "state.db"
+        first = UploadState(db)
+        assert not first.dir_unchanged(d, d.stat(), 0)
+        first.save_dir_snapshot(d, d.stat(), 0)
+        first.close()
+
+        second = UploadState(db)
+        assert second.dir_unchanged(d, d.stat(), 0)
+        assert not second.dir_unchanged(d, d.stat(), 1)
+        second.forget(tmp_path)
+        assert not second.dir_unchanged(d, d.stat(), 0)
+        second.close()
+
+    def test_files_uploaded(self, tmp_path, state):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        key = file_key(f.stat())
+        assert not state.files_uploaded({key})
+        state.mark(f, "tv/ep.mkv")
+        state.mark(f, "downloads/ep.mkv")
+        assert state.files_uploaded({key})
+
+        # Still uploaded while one destination is left
+        link = tmp_path / "Show - S01E01.mkv"
+        os.link(f, link)
+        state.mark(link, "tv/Show - S01E01.mkv")
+        state.forget(f)
+        assert state.files_uploaded({key})
+        state.forget(link)
+        assert not state.files_uploaded({key})
+
+    def test_files_uploaded_needs_same_content(self, tmp_path, state):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        state.mark(f, "tv/ep.mkv")
+        # Same inode, other content (or a reused inode)
+        dev, ino, size, mtime_ns = file_key(f.stat())
+        assert not state.files_uploaded({(dev, ino, size + 1, mtime_ns)})
+
+    def test_item_keys(self, tmp_path):
+        d = tmp_path / "release"
+        d.mkdir()
+        db = tmp_path / "state.db"
+        first = UploadState(db)
+        assert first.item_keys(d, d.stat()) is None
+        first.save_item_keys(d, d.stat(), {(1, 2, 10, 5), (1, 3, 20, 6)})
+        first.close()
+
+        second = UploadState(db)
+        assert second.item_keys(d, d.stat()) == {(1, 2, 10, 5), (1, 3, 20, 6)}
+        (d / "extra.nfo").touch()
+        assert second.item_keys(d, d.stat()) is None
+        second.forget(d)
+        assert second.item_files == {}
+        second.close()
+
+    def test_large_file_sessions(self, tmp_path, state):
+        f = tmp_path / "movie.mkv"
+        f.write_bytes(b"data")
+        assert state.large_file(f, "movies/movie.mkv") is None
+        state.start_large_file(f, "movies/movie.mkv", "file-1", 100)
+        state.save_large_file_part("file-1", 1, "abc")
+        assert state.large_file(f, "movies/movie.mkv") == ("file-1", 100, {1: "abc"})
+        assert state.large_file(f, "movies/other.mkv") is None
+
+        f.write_bytes(b"rewritten")
+        assert state.large_file(f, "movies/movie.mkv") is None
+        state.drop_large_file("file-1")
+        assert state.large_files() == []
+
+    def test_meta(self, state):
+        assert state.get_meta("missing") is None
+        state.set_meta("k", 5)
+        assert state.get_meta("k") == "5"
+
+
+class TestImportMarkers:
+    def _layout(self, tmp_path):
+        completed = tmp_path / "completed"
+        (completed / "tv").mkdir(parents=True)
+        season = tmp_path / "arr" / "tv" / "Show" / "Season 1"
+        season.mkdir(parents=True)
+        return completed, season
+
+    def test_imports_and_removes_markers(self, tmp_path):
+        completed, season = self._layout(tmp_path)
+        ep = season / "S01E01.mkv"
+        ep.write_bytes(b"ep")
+        (season / "S01E01.mkv.uploaded").touch()
+        torrent = completed / "tv" / "show-torrent"
+        torrent.mkdir()
+        (completed / "tv" / "show-torrent.uploaded").touch()
+        loose = completed / "loose.mkv"
+        loose.write_bytes(b"loose")
+        (completed / "loose.mkv.uploaded").touch()
+
+        state = open_state(
+            tmp_path / "state.db", str(completed), str(tmp_path / "arr"), ["tv"]
+        )
+        assert state.is_uploaded(ep, "tv/Show/Season 1/S01E01.mkv")
+        assert state.is_uploaded(torrent, "")
+        assert state.is_uploaded(loose, "downloads/loose.mkv")
+        assert list(tmp_path.rglob("*.uploaded")) == []
+        state.close()
+
+    def test_orphaned_marker_removed(self, tmp_path):
+        completed, season = self._layout(tmp_path)
+        (season / "gone.mkv.uploaded").touch()
+
+        state = open_state(
+            tmp_path / "state.db", str(completed), str(tmp_path / "arr"), ["tv"]
+        )
+        assert state.uploads == {}
+        assert not (season / "gone.mkv.uploaded").exists()
+        state.close()
+
+    def test_imports_only_once(self, tmp_path):
+        completed, season = self._layout(tmp_path)
+        args = (str(completed), str(tmp_path / "arr"), ["tv"])
+        open_state(tmp_path / "state.db", *args).close()
+
+        # A marker appearing later (e.g. restored from backup) is left alone
+        ep = season / "S01E01.mkv"
+        ep.write_bytes(b"ep")
+        (season / "S01E01.mkv.uploaded").touch()
+        state = open_state(tmp_path / "state.db", *args)
+        assert not state.is_uploaded(ep)
+        assert (season / "S01E01.mkv.uploaded").exists()
+        state.close()
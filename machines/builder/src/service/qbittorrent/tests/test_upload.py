@@ -1,21 +1,63 @@
 """Tests for upload.py — B2 upload logic."""
 
+import hashlib
+import json
 import os
+import sqlite3
+import subprocess
+import threading
+import time
+import zipfile
 from pathlib import Path
 from unittest.mock import MagicMock, call, patch
 
+import pytest
+
+from metrics import Metrics
+from rc import RcError
+from schedule import Scheduler
+from state import open_state
 from upload import (
+    METRICS,
+    JobPool,
+    TransferBudget,
+    archive_volumes,
+    clear_extracted_dir,
+    collect_changed,
+    daemon_round,
+    files_size,
+    find_archives,
     link_to_import_dir,
+    manifest_has,
     mark_uploaded,
+    mount_dirs,
     needs_linking,
+    parse_archive_policy,
     parse_categories,
     process_item,
+    parse_modtime,
+    plan_run,
     propagate_markers,
+    queue_upload,
     rclone_check,
     rclone_copy,
+    rclone_copy_batch,
+    rclone_lsjson,
+    record_throughput,
+    run_completed,
+    run_webhook,
+    refresh_manifest,
+    refresh_mount,
+    retire_objects,
+    run_changed,
     scan_completed_dir,
     scan_import_dir,
+    server_copy,
+    stream_archive,
+    upload_batch,
+    upload_pending,
 )
+from walk import Tree
 
 
 class TestRcloneCopy:
@@ -34,73 +76,379 @@ class TestRcloneCopy:
         mock_run.return_value = MagicMock(returncode=1)
         assert rclone_copy("/src/file.mkv", "b2:bucket/dest/") is False
 
+    @patch("upload.BANDWIDTH")
+    @patch("upload.subprocess.run")
+    def test_bandwidth_share(self, mock_run, mock_bandwidth):
+        mock_run.return_value = MagicMock(returncode=0)
+        mock_bandwidth.consumer.return_value.__enter__.return_value = "2048K"
+        assert rclone_copy("/src/file.mkv", "b2:bucket/dest/") is True
+        mock_bandwidth.consumer.assert_called_once_with("process")
+        assert mock_run.call_args[0][0][-2:] == ["--bwlimit", "2048K"]
+
+    @patch("upload.RC_URL", "http://rc")
+    @patch("upload.BANDWIDTH")
+    @patch("upload.rc_copy", return_value=True)
+    def test_rcd_share(self, mock_rc_copy, mock_bandwidth):
+        assert rclone_copy("/src/file.mkv", "b2:bucket/dest/") is True
+        # The rcd's limit is split when the job starts, not passed to it
+        mock_bandwidth.consumer.assert_called_once_with("rcd")
+        mock_rc_copy.assert_called_once_with("/src/file.mkv", "b2:bucket/dest/", 4)
+
+
+class TestRcloneCopyBatch:
+    def _popen(self, returncode, log_lines):
+        proc = MagicMock()
+        proc.stderr = iter(log_lines)
+        proc.wait.return_value = returncode
+        return proc
+
+    @patch("upload.subprocess.Popen")
+    def test_single_call_with_file_list(self, mock_popen):
+        listed = []
+
+        def fake_popen(args, **kwargs):
+            files_from = args[args.index("--files-from-raw") + 1]
+            listed.extend(Path(files_from).read_text().splitlines())
+            return self._popen(0, [])
+
+        mock_popen.side_effect = fake_popen
+        failed = rclone_copy_batch(
+            "/media/arr/tv", "b2:bucket/tv/", ["a.mkv", "S/b.mkv"]
+        )
+        assert failed == set()
+        mock_popen.assert_called_once()
+        args = mock_popen.call_args[0][0]
+        assert args[:4] == ["rclone", "copy", "/media/arr/tv", "b2:bucket/tv/"]
+        assert "--checksum" in args
+        assert listed == ["a.mkv", "S/b.mkv"]
+
+    @patch("upload.subprocess.Popen")
+    def test_per_file_failures(self, mock_popen):
+        error = {"level": "error", "msg": "Failed to copy", "object": "S/b.mkv"}
+        copied = {"level": "info", "msg": "Copied (new)", "object": "a.mkv"}
+        mock_popen.return_value = self._popen(
+            1, [json.dumps(copied) + "\n", json.dumps(error) + "\n"]
+        )
+        failed = rclone_copy_batch("/src", "b2:bucket/tv/", ["a.mkv", "S/b.mkv"])
+        assert failed == {"S/b.mkv"}
+
+    @patch("upload.subprocess.Popen")
+    def test_failure_without_objects(self, mock_popen):
+        """A failure rclone doesn't attribute to a file fails the whole batch."""
+        mock_popen.return_value = self._popen(1, ["not json\n"])
+        failed = rclone_copy_batch("/src", "b2:bucket/tv/", ["a.mkv", "b.mkv"])
+        assert failed == {"a.mkv", "b.mkv"}
+
+
+class TestRcDaemon:
+    """With RCLONE_RC_URL set, copies and listings go through rclone rcd."""
+
+    @patch("upload.rc_job", return_value=(None, {}))
+    @patch("upload.RC_URL", "http://rc")
+    def test_copy_file(self, mock_job, tmp_path):
+        f = tmp_path / "ep.mkv"
+        f.touch()
+        assert rclone_copy(f, "b2:bucket/tv/", 3) is True
+        url, command, params = mock_job.call_args[0]
+        assert (url, command) == ("http://rc", "operations/copyfile")
+        assert params["srcFs"] == str(tmp_path)
+        assert params["srcRemote"] == params["dstRemote"] == "ep.mkv"
+        assert params["_config"] == {"Transfers": 3, "CheckSum": True}
+
+    @patch("upload.rc_job", return_value=("auth failed", {}))
+    @patch("upload.RC_URL", "http://rc")
+    def test_copy_directory_failure(self, mock_job, tmp_path):
+        assert rclone_copy(tmp_path, "b2:bucket/downloads/x") is False
+        assert mock_job.call_args[0][1] == "sync/copy"
+
+    @patch("upload.RC_URL", "http://rc")
+    def test_batch_reads_file_list(self, tmp_path):
+        def job(url, command, params):
+            with open(params["_filter"]["FilesFromRaw"][0]) as f:
+                assert f.read() == "a.mkv\nb.mkv\n"
+            return None, {"a.mkv": "", "b.mkv": ""}
+
+        with patch("upload.rc_job", side_effect=job):
+            assert (
+                rclone_copy_batch("/src", "b2:bucket/tv/", ["a.mkv", "b.mkv"]) == set()
+            )
+
+    @patch("upload.RC_URL", "http://rc")
+    def test_batch_failure_keeps_unconfirmed_files(self):
+        with patch("upload.rc_job", return_value=("1 error", {"a.mkv": ""})):
+            failed = rclone_copy_batch(
+                "/src", "b2:bucket/tv/", ["a.mkv", "b.mkv", "c.mkv"]
+            )
+        assert failed == {"b.mkv", "c.mkv"}
+
+    @patch("upload.RC_URL", "http://rc")
+    def test_batch_daemon_unreachable(self):
+        with patch("upload.rc_job", side_effect=RcError("refused")):
+            failed = rclone_copy_batch("/src", "b2:bucket/tv/", ["a.mkv"])
+        assert failed == {"a.mkv"}
+
+    @patch("upload.rc_call")
+    @patch("upload.RC_URL", "http://rc")
+    def test_listing(self, mock_call):
+        mock_call.return_value = {
+            "list": [
+                {
+                    "Path": "tv/ep.mkv",
+                    "Size": 4,
+                    "ModTime": "2024-05-01T12:00:00Z",
+                    "Hashes": {"sha1": "abc"},
+                }
+            ]
+        }
+        assert rclone_lsjson("b2:bucket") == {
+            "tv/ep.mkv": (4, 1714564800_000000000, "abc")
+        }
+        assert mock_call.call_args[0][1] == "operations/list"
+
+    @patch("upload.rc_call", side_effect=RcError("not found"))
+    @patch("upload.RC_URL", "http://rc")
+    def test_listing_failure(self, mock_call):
+        assert rclone_lsjson("b2:bucket/tv/ep.mkv", quiet=True) is None
+
 
 class TestRcloneCheck:
+    SHA1_DATA = "a17c9aaa61e80a1bf71d0d850af4e5baa9800bbd"  # sha1(b"data")
+
+    @patch("upload.rclone_lsjson")
+    def test_exists(self, mock_ls, tmp_path, state):
+        f = tmp_path / "file.mkv"
+        f.write_bytes(b"data")
+        mock_ls.return_value = {"file.mkv": (4, 0, self.SHA1_DATA)}
+        assert rclone_check(f, "b2:bucket/dest/", state) is True
+        mock_ls.assert_called_once_with("b2:bucket/dest/file.mkv", quiet=True)
+
+    @patch("upload.rclone_lsjson", return_value=None)
+    def test_not_exists(self, mock_ls, tmp_path, state):
+        f = tmp_path / "file.mkv"
+        f.write_bytes(b"data")
+        assert rclone_check(f, "b2:bucket/dest/", state) is False
+
+    @patch("upload.rclone_lsjson")
+    def test_hash_mismatch(self, mock_ls, tmp_path, state):
+        f = tmp_path / "file.mkv"
+        f.write_bytes(b"data")
+        mock_ls.return_value = {"file.mkv": (4, 0, "0" * 40)}
+        assert rclone_check(f, "b2:bucket/dest/", state) is False
+
+    @patch("upload.rclone_lsjson")
+    def test_directory_uses_cached_hashes(self, mock_ls, tmp_path, state):
+        d = tmp_path / "release"
+        (d / "sub").mkdir(parents=True)
+        (d / "sub" / "a.mkv").write_bytes(b"data")
+        mock_ls.return_value = {"sub/a.mkv": (4, 0, self.SHA1_DATA)}
+        with patch.object(state, "sha1", wraps=state.sha1) as mock_sha1:
+            assert rclone_check(d, "b2:bucket/downloads/release", state) is True
+        mock_sha1.assert_called_once_with(d / "sub" / "a.mkv")
+        mock_ls.assert_called_once_with("b2:bucket/downloads/release", quiet=True)
+
+    @patch("upload.rclone_lsjson")
+    def test_missing_remote_hash(self, mock_ls, tmp_path, state):
+        f = tmp_path / "file.mkv"
+        f.write_bytes(b"data")
+        mock_ls.return_value = {"file.mkv": (4, 0, None)}
+        assert rclone_check(f, "b2:bucket/dest/", state) is False
+
+
+class TestRcloneLsjson:
     @patch("upload.subprocess.run")
-    def test_exists(self, mock_run):
-        mock_run.return_value = MagicMock(returncode=0)
-        assert rclone_check("/src/file.mkv", "b2:bucket/dest/") is True
+    def test_parses_listing(self, mock_run):
+        listing = [
+            {
+                "Path": "tv/Show/ep.mkv",
+                "Size": 4,
+                "ModTime": "2024-05-01T12:00:00.123456789Z",
+                "Hashes": {"sha1": "abc"},
+            },
+            {"Path": "movies/m.mkv", "Size": 9, "ModTime": "2024-05-01T12:00:00Z"},
+        ]
+        mock_run.return_value = MagicMock(returncode=0, stdout=json.dumps(listing))
+        objects = rclone_lsjson("b2:bucket")
+        args = mock_run.call_args[0][0]
+        assert args[:3] == ["rclone", "lsjson", "-R"]
+        assert "--hash" in args
+        assert objects == {
+            "tv/Show/ep.mkv": (4, 1714564800_123456000, "abc"),
+            "movies/m.mkv": (9, 1714564800_000000000, None),
+        }
 
     @patch("upload.subprocess.run")
-    def test_not_exists(self, mock_run):
-        mock_run.return_value = MagicMock(returncode=1)
-        assert rclone_check("/src/file.mkv", "b2:bucket/dest/") is False
+    def test_failure(self, mock_run):
+        mock_run.return_value = MagicMock(returncode=1, stdout="", stderr="auth")
+        assert rclone_lsjson("b2:bucket") is None
+
+    @patch("upload.subprocess.run")
+    def test_garbage_output(self, mock_run):
+        mock_run.return_value = MagicMock(returncode=0, stdout="not json")
+        assert rclone_lsjson("b2:bucket") is None
+
+
+class TestParseModtime:
+    def test_offset(self):
+        assert parse_modtime("2024-05-01T14:00:00.5+02:00") == 1714564800_500000000
+
+
+class TestRefreshManifest:
+    @patch("upload.rclone_lsjson")
+    def test_fetches_when_missing(self, mock_ls, state):
+        mock_ls.return_value = {"tv/ep.mkv": (1, 2, None)}
+        assert refresh_manifest(state, "b2:bucket", 3600) is True
+        assert state.manifest == {"tv/ep.mkv": (1, 2, None)}
+
+    @patch("upload.rclone_lsjson")
+    def test_uses_fresh_cache(self, mock_ls, state):
+        state.replace_manifest({"tv/ep.mkv": (1, 2, None)})
+        state.manifest = None
+        assert refresh_manifest(state, "b2:bucket", 3600) is True
+        mock_ls.assert_not_called()
+        assert state.manifest == {"tv/ep.mkv": (1, 2, None)}
+
+    @patch("upload.rclone_lsjson", return_value=None)
+    def test_listing_failure(self, mock_ls, state):
+        assert refresh_manifest(state, "b2:bucket", 3600) is False
+        assert state.manifest is None
+
+
+class TestManifestHas:
+    def test_file_match(self, tmp_path):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        st = f.stat()
+        manifest = {"tv/ep.mkv": (4, st.st_mtime_ns // 1_000_000 * 1_000_000, None)}
+        assert manifest_has(manifest, f, "tv/ep.mkv") is True
+
+    def test_size_mismatch(self, tmp_path):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        manifest = {"tv/ep.mkv": (5, f.stat().st_mtime_ns, None)}
+        assert manifest_has(manifest, f, "tv/ep.mkv") is False
+
+    def test_modtime_mismatch(self, tmp_path):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        manifest = {"tv/ep.mkv": (4, f.stat().st_mtime_ns - 5_000_000_000, None)}
+        assert manifest_has(manifest, f, "tv/ep.mkv") is False
+
+    def test_modtime_mismatch_same_hash(self, tmp_path, state):
+        """A touched file still matches if its SHA1 is the one on B2."""
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        stale = f.stat().st_mtime_ns - 5_000_000_000
+        sha1 = TestRcloneCheck.SHA1_DATA
+        assert manifest_has({"tv/ep.mkv": (4, stale, sha1)}, f, "tv/ep.mkv", state)
+        assert not manifest_has(
+            {"tv/ep.mkv": (4, stale, "0" * 40)}, f, "tv/ep.mkv", state
+        )
+
+    def test_directory_needs_every_file(self, tmp_path):
+        d = tmp_path / "release"
+        d.mkdir()
+        (d / "a.mkv").write_bytes(b"a")
+        (d / "b.srt").write_bytes(b"bb")
+        manifest = {
+            "downloads/release/a.mkv": (1, (d / "a.mkv").stat().st_mtime_ns, None)
+        }
+        assert manifest_has(manifest, d, "downloads/release") is False
+        manifest["downloads/release/b.srt"] = (
+            2,
+            (d / "b.srt").stat().st_mtime_ns,
+            None,
+        )
+        assert manifest_has(manifest, d, "downloads/release") is True
 
 
 class TestMarkUploaded:
-    def test_creates_marker(self, tmp_path):
+    def test_records_upload(self, tmp_path, state):
         item = tmp_path / "file.mkv"
         item.touch()
-        assert mark_uploaded(item) is True
-        assert (tmp_path / "file.mkv.uploaded").exists()
+        assert mark_uploaded(item, "movies/file.mkv", state) is True
+        assert state.is_uploaded(item, "movies/file.mkv")
+        # No marker file clutter next to the item
+        assert not (tmp_path / "file.mkv.uploaded").exists()
+
+    def test_missing_item(self, tmp_path, state):
+        assert mark_uploaded(tmp_path / "gone.mkv", "movies/gone.mkv", state) is False
 
-    def test_permission_error(self, tmp_path):
+    def test_database_error(self, tmp_path, state):
         item = tmp_path / "file.mkv"
         item.touch()
-        with patch.object(Path, "touch", side_effect=PermissionError):
-            assert mark_uploaded(item) is False
+        with patch.object(state, "mark", side_effect=sqlite3.OperationalError):
+            assert mark_uploaded(item, "movies/file.mkv", state) is False
 
 
 class TestProcessItem:
     @patch("upload.rclone_copy", return_value=True)
     @patch("upload.rclone_check", return_value=False)
-    def test_simple_file(self, mock_check, mock_copy, tmp_path):
+    def test_simple_file(self, mock_check, mock_copy, tmp_path, state):
         item = tmp_path / "movie.mkv"
         item.write_bytes(b"data")
         extracted = tmp_path / "extracted"
         extracted.mkdir()
 
-        result = process_item(item, "movies/", "b2:bucket", str(extracted))
+        result = process_item(item, "movies/", "b2:bucket", str(extracted), state)
         assert result is True
-        assert Path(f"{item}.uploaded").exists()
+        assert state.is_uploaded(item)
         # rclone_copy called once for the original file
         assert mock_copy.call_count == 1
 
+    @patch.dict(
+        "upload.os.environ",
+        {"RCLONE_CONFIG_B2_ACCOUNT": "acct", "RCLONE_CONFIG_B2_KEY": "key"},
+    )
+    @patch("upload.LARGE_FILE_MIN", 3)
+    @patch("upload.subprocess.run")  # unar
+    @patch("upload.upload_large_file", return_value=True)
+    @patch("upload.rclone_copy_batch", return_value=set())
+    @patch("upload.rclone_copy", return_value=True)
+    @patch("upload.rclone_check", return_value=False)
+    def test_archive_item_large_files_use_b2_api(
+        self, mock_check, mock_copy, mock_batch, mock_large, mock_run, tmp_path, state
+    ):
+        item = tmp_path / "release"
+        item.mkdir()
+        (item / "movie.mkv").write_bytes(b"large")
+        (item / "subs.rar").write_bytes(b"r")
+
+        assert process_item(
+            item, "downloads/", "b2:bucket", str(tmp_path / "extracted"), state
+        )
+        _, _, path, name, _, _ = mock_large.call_args[0]
+        assert (path, name) == (item / "movie.mkv", "downloads/release/movie.mkv")
+        mock_batch.assert_called_once_with(
+            item, "b2:bucket/downloads/release/", ["subs.rar"], 4
+        )
+        assert state.is_uploaded(item)
+
     @patch("upload.rclone_copy", return_value=True)
     @patch("upload.rclone_check", return_value=True)
-    def test_already_on_b2(self, mock_check, mock_copy, tmp_path):
+    def test_already_on_b2(self, mock_check, mock_copy, tmp_path, state):
         item = tmp_path / "movie.mkv"
         item.write_bytes(b"data")
         extracted = tmp_path / "extracted"
         extracted.mkdir()
 
-        result = process_item(item, "movies/", "b2:bucket", str(extracted))
+        result = process_item(item, "movies/", "b2:bucket", str(extracted), state)
         assert result is True
-        assert Path(f"{item}.uploaded").exists()
+        assert state.is_uploaded(item)
         # Should not upload — already on B2
         mock_copy.assert_not_called()
 
     @patch("upload.subprocess.run")  # unar
     @patch("upload.rclone_copy", return_value=True)
     @patch("upload.rclone_check", return_value=False)
-    def test_archive_file(self, mock_check, mock_copy, mock_run, tmp_path):
+    def test_archive_file(self, mock_check, mock_copy, mock_run, tmp_path, state):
+        """A zip that can't be streamed (here: not a real zip) is staged."""
         mock_run.return_value = MagicMock(returncode=0)
         item = tmp_path / "release.zip"
         item.write_bytes(b"zipdata")
         extracted = tmp_path / "extracted"
         extracted.mkdir()
 
-        result = process_item(item, "downloads/", "b2:bucket", str(extracted))
+        result = process_item(item, "downloads/", "b2:bucket", str(extracted), state)
         assert result is True
         # unar called for extraction
         mock_run.assert_called_once()
@@ -112,7 +460,9 @@ class TestProcessItem:
     @patch("upload.subprocess.run")  # unar
     @patch("upload.rclone_copy", return_value=True)
     @patch("upload.rclone_check", return_value=False)
-    def test_directory_with_archive(self, mock_check, mock_copy, mock_run, tmp_path):
+    def test_directory_with_archive(
+        self, mock_check, mock_copy, mock_run, tmp_path, state
+    ):
         mock_run.return_value = MagicMock(returncode=0)
         item = tmp_path / "release-dir"
         item.mkdir()
@@ -121,28 +471,73 @@ class TestProcessItem:
         extracted = tmp_path / "extracted"
         extracted.mkdir()
 
-        result = process_item(item, "downloads/", "b2:bucket", str(extracted))
+        result = process_item(item, "downloads/", "b2:bucket", str(extracted), state)
         assert result is True
         # unar called for the .rar inside the directory
         assert mock_run.call_count == 1
         # rclone_copy: once for extracted, once for original directory
         assert mock_copy.call_count == 2
 
+    @patch("upload.subprocess.run")  # unar
+    @patch("upload.rclone_copy", return_value=True)
+    @patch("upload.rclone_check", return_value=False)
+    def test_volume_sets_extracted_once(
+        self, mock_check, mock_copy, mock_run, tmp_path, state
+    ):
+        mock_run.return_value = MagicMock(returncode=0)
+        item = tmp_path / "release-dir"
+        (item / "Subs").mkdir(parents=True)
+        for i in range(1, 5):
+            (item / f"release.part{i}.rar").write_bytes(b"rardata")
+        (item / "Subs" / "subs.rar").write_bytes(b"rardata")
+        (item / "Subs" / "subs.r00").write_bytes(b"rardata")
+        extracted = tmp_path / "extracted"
+
+        assert process_item(item, "downloads/", "b2:bucket", str(extracted), state)
+        # One unar per set, each into the set's directory within the item
+        calls = [c[0][0] for c in mock_run.call_args_list]
+        assert [Path(args[-1]).name for args in calls] == [
+            "subs.rar",
+            "release.part1.rar",
+        ]
+        work_dir = Path(calls[1][3])
+        assert Path(calls[0][3]) == work_dir / "Subs"
+        assert mock_copy.call_args_list[0][0][1] == "b2:bucket/downloads/release-dir"
+
+    @patch("upload.subprocess.run")  # unar
+    @patch("upload.stream_archive", return_value=True)
+    @patch("upload.rclone_copy", return_value=True)
+    @patch("upload.rclone_check", return_value=False)
+    def test_streamed_archive_not_staged(
+        self, mock_check, mock_copy, mock_stream, mock_run, tmp_path, state
+    ):
+        item = tmp_path / "release.zip"
+        item.write_bytes(b"zipdata")
+        extracted = tmp_path / "extracted"
+
+        result = process_item(item, "downloads/", "b2:bucket", str(extracted), state)
+        assert result is True
+        mock_stream.assert_called_once_with(item, "b2:bucket/downloads/release.zip", 4)
+        mock_run.assert_not_called()
+        # Only the original archive is copied; nothing was extracted to disk
+        mock_copy.assert_called_once()
+        assert not extracted.exists()
+
     @patch("upload.rclone_copy", return_value=False)
     @patch("upload.rclone_check", return_value=False)
-    def test_upload_failure(self, mock_check, mock_copy, tmp_path):
+    def test_upload_failure(self, mock_check, mock_copy, tmp_path, state):
         item = tmp_path / "movie.mkv"
         item.write_bytes(b"data")
         extracted = tmp_path / "extracted"
         extracted.mkdir()
 
-        result = process_item(item, "movies/", "b2:bucket", str(extracted))
+        result = process_item(item, "movies/", "b2:bucket", str(extracted), state)
         assert result is False
-        assert not Path(f"{item}.uploaded").exists()
+        assert not state.is_uploaded(item)
 
     @patch("upload.rclone_copy", return_value=True)
     @patch("upload.rclone_check", return_value=False)
-    def test_directory_destination(self, mock_check, mock_copy, tmp_path):
+    def test_directory_destination(self, mock_check, mock_copy, tmp_path, state):
         """Directories get a named subfolder on B2."""
         item = tmp_path / "My Show"
         item.mkdir()
@@ -150,79 +545,1091 @@ class TestProcessItem:
         extracted = tmp_path / "extracted"
         extracted.mkdir()
 
-        process_item(item, "tv/", "b2:bucket", str(extracted))
+        process_item(item, "tv/", "b2:bucket", str(extracted), state)
         # Check the dest passed to rclone_copy includes the dir name
         dest = mock_copy.call_args[0][1]
         assert dest == "b2:bucket/tv/My Show"
 
     @patch("upload.rclone_copy", return_value=True)
     @patch("upload.rclone_check", return_value=False)
-    def test_file_destination(self, mock_check, mock_copy, tmp_path):
+    def test_file_destination(self, mock_check, mock_copy, tmp_path, state):
         """Files go directly into the base path (no name subfolder)."""
         item = tmp_path / "movie.mkv"
         item.write_bytes(b"data")
         extracted = tmp_path / "extracted"
         extracted.mkdir()
 
-        process_item(item, "movies/", "b2:bucket", str(extracted))
+        process_item(item, "movies/", "b2:bucket", str(extracted), state)
         dest = mock_copy.call_args[0][1]
         assert dest == "b2:bucket/movies/"
 
     @patch("upload.rclone_copy", return_value=True)
     @patch("upload.rclone_check", return_value=False)
-    def test_cleanup_extracted_dir(self, mock_check, mock_copy, tmp_path):
+    def test_cleanup_extracted_dir(self, mock_check, mock_copy, tmp_path, state):
         """Extraction work dir is always cleaned up, even for non-archives."""
         item = tmp_path / "movie.mkv"
         item.write_bytes(b"data")
         extracted = tmp_path / "extracted"
         extracted.mkdir()
 
-        process_item(item, "movies/", "b2:bucket", str(extracted))
+        process_item(item, "movies/", "b2:bucket", str(extracted), state)
         # Work dir (extracted/movie.mkv) should not exist after processing
         assert not (extracted / "movie.mkv").exists()
 
 
+class TestParseArchivePolicy:
+    def test_basic(self):
+        assert parse_archive_policy("tv:extracted, downloads:both") == {
+            "tv": "extracted",
+            "downloads": "both",
+        }
+        assert parse_archive_policy("") == {}
+
+    def test_unknown_policy(self):
+        with pytest.raises(ValueError):
+            parse_archive_policy("tv:volumes")
+
+
+@patch("upload.ARCHIVE_POLICY", {"downloads": "extracted"})
+class TestProcessItemExtractedOnly:
+    def _release(self, tmp_path):
+        item = tmp_path / "release-dir"
+        item.mkdir()
+        for i in range(1, 4):
+            (item / f"release.part{i}.rar").write_bytes(b"rardata")
+        (item / "release.nfo").write_bytes(b"nfo")
+        extracted = tmp_path / "extracted"
+        return item, extracted
+
+    @patch("upload.subprocess.run")  # unar
+    @patch("upload.rclone_copy_batch", return_value=set())
+    @patch("upload.rclone_copy", return_value=True)
+    @patch("upload.rclone_check", return_value=False)
+    def test_volumes_not_uploaded(
+        self, mock_check, mock_copy, mock_batch, mock_run, tmp_path, state
+    ):
+        item, extracted = self._release(tmp_path)
+
+        assert process_item(item, "downloads/", "b2:bucket", str(extracted), state)
+        # Only the extracted contents, then the files outside the set
+        mock_copy.assert_called_once()
+        assert mock_copy.call_args[0][1] == "b2:bucket/downloads/release-dir"
+        mock_batch.assert_called_once_with(
+            item, "b2:bucket/downloads/release-dir/", ["release.nfo"], 4
+        )
+        assert state.is_uploaded(item, "downloads/release-dir")
+
+    @patch("upload.subprocess.run")  # unar
+    @patch("upload.rclone_copy_batch", return_value=set())
+    @patch("upload.rclone_copy", return_value=False)
+    @patch("upload.rclone_check", return_value=False)
+    def test_contents_must_upload(
+        self, mock_check, mock_copy, mock_batch, mock_run, tmp_path, state
+    ):
+        item, extracted = self._release(tmp_path)
+
+        assert not process_item(item, "downloads/", "b2:bucket", str(extracted), state)
+        assert not state.is_uploaded(item)
+
+    @patch("upload.rclone_copy")
+    def test_later_volume_recorded(self, mock_copy, tmp_path, state):
+        volume = tmp_path / "release.part2.rar"
+        volume.write_bytes(b"rardata")
+        batch = {}
+
+        assert process_item(volume, "downloads/", "b2:bucket", "/x", state, batch)
+        mock_copy.assert_not_called()
+        assert batch == {}
+        # Counts as uploaded for cleanup and marker propagation
+        assert state.is_uploaded(volume, "downloads/release.part2.rar")
+
+    @patch("upload.rclone_copy")
+    def test_other_categories_keep_volumes(self, mock_copy, tmp_path, state):
+        volume = tmp_path / "tv" / "release.r00"
+        volume.parent.mkdir()
+        volume.write_bytes(b"rardata")
+        batch = {}
+
+        assert process_item(volume, "tv/", "b2:bucket", "/x", state, batch)
+        assert list(batch) == [(str(tmp_path / "tv"), "b2:bucket/tv/")]
+
+
+class TestProcessItemManifest:
+    @patch("upload.rclone_copy")
+    @patch("upload.rclone_check")
+    def test_listing_match_skips_b2(self, mock_check, mock_copy, tmp_path, state):
+        item = tmp_path / "movie.mkv"
+        item.write_bytes(b"data")
+        state.manifest = {"movies/movie.mkv": (4, item.stat().st_mtime_ns, None)}
+
+        assert process_item(item, "movies/", "b2:bucket", "/x", state) is True
+        mock_check.assert_not_called()
+        mock_copy.assert_not_called()
+        assert state.is_uploaded(item, "movies/movie.mkv")
+
+    @patch("upload.rclone_copy", return_value=True)
+    @patch("upload.rclone_check")
+    def test_listing_miss_uploads(self, mock_check, mock_copy, tmp_path, state):
+        item = tmp_path / "movie.mkv"
+        item.write_bytes(b"data")
+        extracted = tmp_path / "extracted"
+        extracted.mkdir()
+        state.manifest = {}
+
+        assert process_item(item, "movies/", "b2:bucket", str(extracted), state)
+        # A fresh listing is authoritative — no per-item rclone check
+        mock_check.assert_not_called()
+        mock_copy.assert_called_once()
+
+
+class TestServerSideCopy:
+    def _listing(self, state, item, path):
+        st = item.stat()
+        sha1 = hashlib.sha1(item.read_bytes()).hexdigest()
+        state.replace_manifest({path: (st.st_size, st.st_mtime_ns - 10**9, sha1)})
+
+    @patch("upload.SERVER_COPY_MIN", 1)
+    @patch("upload.server_copy", return_value=True)
+    @patch("upload.rclone_copy")
+    def test_copies_instead_of_uploading(
+        self, mock_copy, mock_server_copy, tmp_path, state
+    ):
+        item = tmp_path / "tv" / "Show" / "ep.mkv"
+        item.parent.mkdir(parents=True)
+        item.write_bytes(b"data")
+        # Uploaded under downloads/ before it was categorized
+        self._listing(state, item, "downloads/ep.mkv")
+        batch = {}
+
+        assert process_item(item, "tv/Show/", "b2:bucket", "/x", state, batch)
+        mock_server_copy.assert_called_once_with(
+            "b2:bucket", "downloads/ep.mkv", "tv/Show/ep.mkv"
+        )
+        mock_copy.assert_not_called()
+        assert batch == {}
+        assert state.is_uploaded(item, "tv/Show/ep.mkv")
+        assert "tv/Show/ep.mkv" in state.manifest
+
+    @patch("upload.SERVER_COPY_MIN", 1)
+    @patch("upload.server_copy", return_value=False)
+    def test_failed_copy_uploads(self, mock_server_copy, tmp_path, state):
+        item = tmp_path / "tv" / "ep.mkv"
+        item.parent.mkdir()
+        item.write_bytes(b"data")
+        self._listing(state, item, "downloads/ep.mkv")
+        batch = {}
+
+        assert process_item(item, "tv/", "b2:bucket", "/x", state, batch)
+        assert list(batch) == [(str(tmp_path / "tv"), "b2:bucket/tv/")]
+        assert not state.is_uploaded(item)
+
+    @patch("upload.server_copy")
+    def test_small_files_not_hashed(self, mock_server_copy, tmp_path, state):
+        item = tmp_path / "tv" / "ep.nfo"
+        item.parent.mkdir()
+        item.write_bytes(b"data")
+        self._listing(state, item, "downloads/ep.nfo")
+
+        with patch.object(state, "sha1") as mock_sha1:
+            process_item(item, "tv/", "b2:bucket", "/x", state, {})
+        mock_sha1.assert_not_called()
+        mock_server_copy.assert_not_called()
+
+    @patch("upload.RC_URL", "http://rcd")
+    @patch("upload.rc_job", return_value=(None, {}))
+    def test_server_copy_through_rcd(self, mock_job):
+        assert server_copy("b2:bucket", "downloads/ep.mkv", "tv/ep.mkv")
+        mock_job.assert_called_once_with(
+            "http://rcd",
+            "operations/copyfile",
+            {
+                "srcFs": "b2:bucket",
+                "srcRemote": "downloads/ep.mkv",
+                "dstFs": "b2:bucket",
+                "dstRemote": "tv/ep.mkv",
+            },
+        )
+
+
+class TestServerSideMove:
+    def _renamed(self, tmp_path, state):
+        show = tmp_path / "tv" / "Show"
+        show.mkdir(parents=True)
+        old = show / "Show - S01E01.mkv"
+        old.write_bytes(b"data")
+        st = old.stat()
+        state.mark(old, "tv/Show/Show - S01E01.mkv")
+        state.replace_manifest(
+            {"tv/Show/Show - S01E01.mkv": (4, st.st_mtime_ns, "sha1")}
+        )
+        new = show / "Show - S01E01 - Pilot.mkv"
+        return old, new
+
+    @patch("upload.server_copy", return_value=True)
+    @patch("upload.rclone_copy")
+    def test_moves_renamed_file(self, mock_copy, mock_server_copy, tmp_path, state):
+        old, new = self._renamed(tmp_path, state)
+        old.rename(new)
+        batch = {}
+
+        assert process_item(new, "tv/Show/", "b2:bucket", "/x", state, batch)
+        mock_server_copy.assert_called_once_with(
+            "b2:bucket",
+            "tv/Show/Show - S01E01.mkv",
+            "tv/Show/Show - S01E01 - Pilot.mkv",
+            move=True,
+        )
+        mock_copy.assert_not_called()
+        assert batch == {}
+        assert state.destinations(new.stat()) == {
+            "tv/Show/Show - S01E01 - Pilot.mkv": str(new)
+        }
+        assert list(state.manifest) == ["tv/Show/Show - S01E01 - Pilot.mkv"]
+
+    @patch("upload.server_copy")
+    def test_second_link_is_not_a_rename(self, mock_server_copy, tmp_path, state):
+        old, new = self._renamed(tmp_path, state)
+        os.link(old, new)
+        batch = {}
+
+        assert process_item(new, "tv/Show/", "b2:bucket", "/x", state, batch)
+        mock_server_copy.assert_not_called()
+        assert list(batch) == [(str(tmp_path / "tv"), "b2:bucket/tv/")]
+
+    @patch("upload.server_copy", return_value=False)
+    def test_failed_move_uploads(self, mock_server_copy, tmp_path, state):
+        old, new = self._renamed(tmp_path, state)
+        old.rename(new)
+        batch = {}
+
+        assert process_item(new, "tv/Show/", "b2:bucket", "/x", state, batch)
+        assert list(batch) == [(str(tmp_path / "tv"), "b2:bucket/tv/")]
+        assert "tv/Show/Show - S01E01.mkv" in state.manifest
+
+    @patch("upload.refresh_mount")
+    @patch("upload.server_copy", return_value=True)
+    @patch("upload.rclone_copy_batch", return_value=set())
+    def test_rename_after_upload(
+        self, mock_batch, mock_server_copy, mock_refresh, tmp_path, state
+    ):
+        show = tmp_path / "tv" / "Show"
+        show.mkdir(parents=True)
+        old = show / "Show - S01E01.mkv"
+        old.write_bytes(b"data")
+        # Listing fetched before the upload
+        state.replace_manifest({})
+        batch = {}
+        assert process_item(old, "tv/Show/", "b2:bucket", "/x", state, batch)
+        assert upload_batch(batch, state)
+        assert state.manifest["tv/Show/Show - S01E01.mkv"][0] == 4
+
+        # Sonarr renames it before the listing is fetched again
+        new = show / "Show - S01E01 - Pilot.mkv"
+        old.rename(new)
+        assert process_item(new, "tv/Show/", "b2:bucket", "/x", state, batch)
+        mock_server_copy.assert_called_once_with(
+            "b2:bucket",
+            "tv/Show/Show - S01E01.mkv",
+            "tv/Show/Show - S01E01 - Pilot.mkv",
+            move=True,
+        )
+        assert batch == {}
+        assert mock_batch.call_count == 1
+
+
+class TestProcessItemBatch:
+    @patch("upload.rclone_copy")
+    @patch("upload.rclone_check")
+    def test_plain_file_is_queued(self, mock_check, mock_copy, tmp_path, state):
+        item = tmp_path / "tv" / "Show" / "ep.mkv"
+        item.parent.mkdir(parents=True)
+        item.write_bytes(b"data")
+        batch = {}
+
+        assert process_item(item, "tv/Show/", "b2:bucket", "/x", state, batch)
+        mock_check.assert_not_called()
+        mock_copy.assert_not_called()
+        assert batch == {
+            (str(tmp_path / "tv"), "b2:bucket/tv/"): [
+                (item, "tv/Show/ep.mkv", ["Show/ep.mkv"])
+            ]
+        }
+        # Not recorded until the batch is uploaded
+        assert not state.is_uploaded(item)
+
+    @patch("upload.subprocess.run")  # unar
+    @patch("upload.rclone_copy", return_value=True)
+    @patch("upload.rclone_check", return_value=False)
+    def test_archive_processed_immediately(
+        self, mock_check, mock_copy, mock_run, tmp_path, state
+    ):
+        item = tmp_path / "release.zip"
+        item.write_bytes(b"zipdata")
+        extracted = tmp_path / "extracted"
+        extracted.mkdir()
+        batch = {}
+
+        assert process_item(
+            item, "downloads/", "b2:bucket", str(extracted), state, batch
+        )
+        assert batch == {}
+        assert mock_copy.call_count == 2
+
+    @patch("upload.subprocess.run")
+    @patch("upload.rclone_copy", return_value=True)
+    @patch("upload.rclone_check", return_value=False)
+    def test_failed_extraction(self, mock_check, mock_copy, mock_run, tmp_path, state):
+        mock_run.side_effect = subprocess.CalledProcessError(1, "unar")
+        item = tmp_path / "release.rar"
+        item.write_bytes(b"corrupt")
+        extracted = tmp_path / "extracted"
+
+        assert not process_item(item, "downloads/", "b2:bucket", str(extracted), state)
+        mock_copy.assert_not_called()
+        assert not state.is_uploaded(item)
+        # The work dir is removed
+        assert list(extracted.iterdir()) == []
+
+
+class TestStreamArchive:
+    def _zip(self, path, members):
+        with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+            for name, data in members.items():
+                zf.writestr(name, data)
+        return path
+
+    def _popen(self, uploads, returncode=0):
+        """Fake Popen recording the bytes piped into each rclone rcat."""
+
+        def popen(args, stdin):
+            proc = MagicMock()
+            buf = MagicMock()
+            uploads[args[2]] = b""
+
+            def write(data):
+                uploads[args[2]] += bytes(data)
+
+            buf.write.side_effect = write
+            proc.stdin = buf
+            proc.wait.return_value = returncode
+            return proc
+
+        return popen
+
+    @patch("upload.subprocess.Popen")
+    def test_single_top_level_entry(self, mock_popen, tmp_path):
+        archive = self._zip(
+            tmp_path / "release.zip", {"Movie/movie.mkv": b"movie", "Movie/a.srt": b"s"}
+        )
+        uploads = {}
+        mock_popen.side_effect = self._popen(uploads)
+
+        assert stream_archive(archive, "b2:bucket/downloads/release.zip")
+        assert uploads == {
+            "b2:bucket/downloads/release.zip/Movie/movie.mkv": b"movie",
+            "b2:bucket/downloads/release.zip/Movie/a.srt": b"s",
+        }
+        args = mock_popen.call_args_list[0][0][0]
+        assert args[:2] == ["rclone", "rcat"]
+        assert args[3:5] == ["--size", "5"]
+
+    @patch("upload.BANDWIDTH")
+    @patch("upload.subprocess.Popen")
+    def test_transfers_and_paced_stream(self, mock_popen, mock_bandwidth, tmp_path):
+        archive = self._zip(tmp_path / "release.zip", {"a.mkv": b"a", "b.mkv": b"bb"})
+        mock_popen.side_effect = self._popen({})
+
+        assert stream_archive(archive, "b2:bucket/tv/release.zip", transfers=2)
+        for c in mock_popen.call_args_list:
+            assert c[0][0][-2:] == ["--b2-upload-concurrency", "2"]
+        # Paced by the shared Throttle instead of a --bwlimit of its own
+        assert mock_bandwidth.consumer.call_args_list == [call("throttle")] * 2
+        assert mock_bandwidth.throttle.wait.call_args_list == [call(1), call(2)]
+
+    @patch("upload.subprocess.Popen")
+    def test_several_top_level_entries_get_directory(self, mock_popen, tmp_path):
+        """Same layout as unar: wrapped in a directory named after the archive."""
+        archive = self._zip(
+            tmp_path / "release.zip", {"a.mkv": b"a", "b.mkv": b"b", "../evil": b"x"}
+        )
+        uploads = {}
+        mock_popen.side_effect = self._popen(uploads)
+
+        assert stream_archive(archive, "b2:bucket/tv/release.zip")
+        assert sorted(uploads) == [
+            "b2:bucket/tv/release.zip/release/a.mkv",
+            "b2:bucket/tv/release.zip/release/b.mkv",
+        ]
+
+    @patch("upload.subprocess.Popen")
+    def test_rar_not_streamed(self, mock_popen, tmp_path):
+        archive = tmp_path / "release.rar"
+        archive.write_bytes(b"rar")
+        assert not stream_archive(archive, "b2:bucket/tv/release.rar")
+        mock_popen.assert_not_called()
+
+    @patch("upload.subprocess.Popen")
+    def test_split_zip_not_streamed(self, mock_popen, tmp_path):
+        archive = tmp_path / "release.zip"
+        self._zip(archive, {"a.txt": b"a"})
+        (tmp_path / "release.z01").write_bytes(b"volume")
+        assert not stream_archive(archive, "b2:bucket/tv/release.zip")
+        mock_popen.assert_not_called()
+
+    @patch("upload.subprocess.Popen")
+    def test_corrupt_zip(self, mock_popen, tmp_path):
+        archive = tmp_path / "release.zip"
+        archive.write_bytes(b"not a zip")
+        assert not stream_archive(archive, "b2:bucket/tv/release.zip")
+        mock_popen.assert_not_called()
+
+    @patch("upload.subprocess.Popen")
+    def test_upload_failure(self, mock_popen, tmp_path):
+        archive = self._zip(tmp_path / "release.zip", {"a.mkv": b"a"})
+        mock_popen.side_effect = self._popen({}, returncode=1)
+        assert not stream_archive(archive, "b2:bucket/tv/release.zip")
+
+
+class TestFindArchives:
+    def test_archive_file(self, tmp_path):
+        f = tmp_path / "release.RAR"
+        f.write_bytes(b"rar")
+        assert find_archives(f) == [f]
+
+    def test_plain_file(self, tmp_path):
+        f = tmp_path / "movie.mkv"
+        f.write_bytes(b"data")
+        assert find_archives(f) == []
+
+    def test_directory_includes_nested(self, tmp_path):
+        d = tmp_path / "release"
+        (d / "nested").mkdir(parents=True)
+        (d / "a.rar").write_bytes(b"rar")
+        (d / "nested" / "b.zip").write_bytes(b"zip")
+        assert find_archives(d) == [d / "a.rar", d / "nested" / "b.zip"]
+
+    def test_one_per_volume_set(self, tmp_path):
+        d = tmp_path / "release"
+        (d / "Subs").mkdir(parents=True)
+        for i in range(1, 12):
+            (d / f"release.part{i:02d}.rar").write_bytes(b"rar")
+        (d / "Subs" / "subs.rar").write_bytes(b"rar")
+        for i in range(3):
+            (d / "Subs" / f"subs.r{i:02d}").write_bytes(b"rar")
+        (d / "extras.zip").write_bytes(b"zip")
+        (d / "extras.z01").write_bytes(b"zip")
+        assert find_archives(d) == [
+            d / "Subs" / "subs.rar",
+            d / "extras.zip",
+            d / "release.part01.rar",
+        ]
+
+    def test_missing_first_volume(self, tmp_path):
+        d = tmp_path / "release"
+        d.mkdir()
+        (d / "release.part02.rar").write_bytes(b"rar")
+        assert find_archives(d) == []
+
+
+class TestArchiveVolumes:
+    def test_part_set(self, tmp_path):
+        parts = [tmp_path / f"Release.part{i}.rar" for i in (1, 2, 3)]
+        for p in parts:
+            p.write_bytes(b"rar")
+        (tmp_path / "other.part1.rar").write_bytes(b"rar")
+        assert archive_volumes(parts[0]) == parts
+
+    def test_old_style_rar(self, tmp_path):
+        first = tmp_path / "release.rar"
+        first.write_bytes(b"rar")
+        (tmp_path / "release.r00").write_bytes(b"rar")
+        (tmp_path / "release.r01").write_bytes(b"rar")
+        (tmp_path / "release.nfo").write_bytes(b"nfo")
+        assert archive_volumes(first) == [
+            first,
+            tmp_path / "release.r00",
+            tmp_path / "release.r01",
+        ]
+
+    def test_single_volume(self, tmp_path):
+        f = tmp_path / "release.zip"
+        f.write_bytes(b"zip")
+        assert archive_volumes(f) == [f]
+
+
+class TestQueueUpload:
+    def test_directory_item(self, tmp_path):
+        item = tmp_path / "completed" / "Some.Release"
+        (item / "Subs").mkdir(parents=True)
+        (item / "movie.mkv").write_bytes(b"video")
+        (item / "Subs" / "en.srt").write_bytes(b"subs")
+        batch = {}
+
+        queue_upload(batch, item, "downloads/", "b2:bucket")
+        key = (str(tmp_path / "completed"), "b2:bucket/downloads/")
+        assert batch[key] == [
+            (
+                item,
+                "downloads/Some.Release",
+                ["Some.Release/Subs/en.srt", "Some.Release/movie.mkv"],
+            )
+        ]
+
+    def test_same_root_shares_entry_list(self, tmp_path):
+        season = tmp_path / "tv" / "Show" / "Season 1"
+        season.mkdir(parents=True)
+        other = tmp_path / "tv" / "Other"
+        other.mkdir(parents=True)
+        (season / "e1.mkv").write_bytes(b"1")
+        (other / "e2.mkv").write_bytes(b"2")
+        batch = {}
+
+        queue_upload(batch, season / "e1.mkv", "tv/Show/Season 1/", "b2:bucket")
+        queue_upload(batch, other / "e2.mkv", "tv/Other/", "b2:bucket")
+        assert list(batch) == [(str(tmp_path / "tv"), "b2:bucket/tv/")]
+        rels = [rels for _, _, rels in batch[(str(tmp_path / "tv"), "b2:bucket/tv/")]]
+        assert rels == [["Show/Season 1/e1.mkv"], ["Other/e2.mkv"]]
+
+
+class TestRefreshMount:
+    def test_mount_dirs_parents_first(self):
+        assert mount_dirs(["tv/Show/Season 1", "tv/Other", "tv/Show/Season 1"]) == [
+            "tv",
+            "tv/Other",
+            "tv/Show",
+            "tv/Show/Season 1",
+        ]
+
+    @patch("upload.MOUNT_RC_URL", "http://mount")
+    @patch("upload.rc_call", return_value={"result": {}})
+    def test_refreshes_each_dir(self, mock_rc):
+        refresh_mount(["movies/Film (2020)", "."])
+        assert mock_rc.call_args_list == [
+            call("http://mount", "vfs/refresh", {"dir": "movies"}, timeout=30),
+            call(
+                "http://mount", "vfs/refresh", {"dir": "movies/Film (2020)"}, timeout=30
+            ),
+        ]
+
+    @patch("upload.MOUNT_RC_URL", "http://mount")
+    @patch("upload.rc_call", side_effect=RcError("connection refused"))
+    def test_error_only_logged(self, mock_rc, capsys):
+        refresh_mount(["tv/Show"])
+        assert mock_rc.call_count == 1
+        assert "Cannot refresh B2 mount" in capsys.readouterr().out
+
+    @patch("upload.MOUNT_RC_URL", None)
+    @patch("upload.rc_call")
+    def test_no_mount(self, mock_rc):
+        refresh_mount(["tv/Show"])
+        mock_rc.assert_not_called()
+
+
+class TestUploadBatch:
+    def _batch(self, tmp_path):
+        a = tmp_path / "a.mkv"
+        b = tmp_path / "b.mkv"
+        a.write_bytes(b"a")
+        b.write_bytes(b"b")
+        key = (str(tmp_path), "b2:bucket/tv/")
+        return a, b, {key: [(a, "tv/a.mkv", ["a.mkv"]), (b, "tv/b.mkv", ["b.mkv"])]}
+
+    @patch("upload.rclone_copy_batch", return_value=set())
+    def test_marks_every_item(self, mock_batch, tmp_path, state):
+        a, b, batch = self._batch(tmp_path)
+        assert upload_batch(batch, state) is True
+        mock_batch.assert_called_once_with(
+            str(tmp_path), "b2:bucket/tv/", ["a.mkv", "b.mkv"], 4
+        )
+        assert state.is_uploaded(a, "tv/a.mkv")
+        assert state.is_uploaded(b, "tv/b.mkv")
+        assert batch == {}
+
+    @patch("upload.refresh_mount")
+    @patch("upload.rclone_copy_batch", return_value=set())
+    def test_refreshes_mount(self, mock_batch, mock_refresh, tmp_path, state):
+        d = tmp_path / "Show"
+        (d / "Season 1").mkdir(parents=True)
+        (d / "Season 1" / "ep.mkv").write_bytes(b"e")
+        a, b, batch = self._batch(tmp_path)
+        batch[(str(tmp_path), "b2:bucket/tv/")].append(
+            (d, "tv/Show", ["Show/Season 1/ep.mkv"])
+        )
+        upload_batch(batch, state)
+        mock_refresh.assert_called_once_with(["tv", "tv", "tv/Show"])
+
+    @patch("upload.rclone_copy_batch", return_value={"b.mkv"})
+    def test_marks_only_successful(self, mock_batch, tmp_path, state):
+        a, b, batch = self._batch(tmp_path)
+        assert upload_batch(batch, state) is False
+        assert state.is_uploaded(a)
+        assert not state.is_uploaded(b)
+
+    @patch("upload.rclone_copy_batch", return_value={"b.mkv"})
+    def test_records_metrics(self, mock_batch, tmp_path, state):
+        metrics = Metrics(None, METRICS.definitions)
+        a, b, batch = self._batch(tmp_path)
+        with patch("upload.METRICS", metrics):
+            upload_batch(batch, state)
+        assert metrics.values["qbt_upload_items_total"] == {(("category", "tv"),): 1}
+        assert metrics.values["qbt_upload_bytes_total"] == {(("category", "tv"),): 1}
+        assert metrics.values["qbt_upload_failures_total"] == {(("category", "tv"),): 1}
+        assert metrics.values["qbt_upload_job_seconds"][(("category", "tv"),)][2] == 1
+
+    @patch("upload.rclone_copy_batch")
+    def test_empty_directory_item(self, mock_batch, tmp_path, state):
+        d = tmp_path / "empty"
+        d.mkdir()
+        batch = {(str(tmp_path), "b2:bucket/downloads/"): [(d, "downloads/empty", [])]}
+        assert upload_batch(batch, state) is True
+        mock_batch.assert_not_called()
+        assert state.is_uploaded(d)
+
+    @patch.dict(
+        "upload.os.environ",
+        {"RCLONE_CONFIG_B2_ACCOUNT": "acct", "RCLONE_CONFIG_B2_KEY": "key"},
+    )
+    @patch("upload.LARGE_FILE_MIN", 2)
+    @patch("upload.rclone_check", return_value=False)
+    @patch("upload.upload_large_file", return_value=False)
+    @patch("upload.rclone_copy_batch", return_value=set())
+    def test_large_files_use_b2_api(
+        self, mock_batch, mock_large, mock_check, tmp_path, state
+    ):
+        a, b, batch = self._batch(tmp_path)
+        b.write_bytes(b"large")
+        assert upload_batch(batch, state) is False
+        mock_batch.assert_called_once_with(str(tmp_path), "b2:bucket/tv/", ["a.mkv"], 4)
+        client, _, path, name, _, _ = mock_large.call_args[0]
+        assert client.bucket == "bucket"
+        assert (path, name) == (b, "tv/b.mkv")
+        assert state.is_uploaded(a)
+        assert not state.is_uploaded(b)
+
+    @patch.dict(
+        "upload.os.environ",
+        {"RCLONE_CONFIG_B2_ACCOUNT": "acct", "RCLONE_CONFIG_B2_KEY": "key"},
+    )
+    @patch("upload.LARGE_FILE_MIN", 2)
+    @patch("upload.upload_large_file")
+    @patch("upload.rclone_copy_batch", return_value=set())
+    def test_large_file_already_copied(self, mock_batch, mock_large, tmp_path, state):
+        a, b, batch = self._batch(tmp_path)
+        b.write_bytes(b"large")
+        # Copied server-side before the batch ran (copy_within_bucket)
+        state.manifest = {"tv/b.mkv": (5, b.stat().st_mtime_ns, None)}
+        assert upload_batch(batch, state) is True
+        mock_large.assert_not_called()
+        assert state.is_uploaded(b)
+
+    @patch.dict(
+        "upload.os.environ",
+        {"RCLONE_CONFIG_B2_ACCOUNT": "acct", "RCLONE_CONFIG_B2_KEY": "key"},
+    )
+    @patch("upload.LARGE_FILE_MIN", 2)
+    @patch("upload.rclone_check", return_value=True)
+    @patch("upload.upload_large_file")
+    @patch("upload.rclone_copy_batch", return_value=set())
+    def test_large_file_on_b2_without_listing(
+        self, mock_batch, mock_large, mock_check, tmp_path, state
+    ):
+        a, b, batch = self._batch(tmp_path)
+        b.write_bytes(b"large")
+        # Uploaded by a run that ended before recording it
+        assert upload_batch(batch, state) is True
+        mock_check.assert_called_once_with(b, "b2:bucket/tv", state)
+        mock_large.assert_not_called()
+        assert state.is_uploaded(b)
+
+
+class TestTransferBudget:
+    def test_caps_total(self):
+        budget = TransferBudget(4)
+        with budget.take(3) as n:
+            assert n == 3
+            assert budget.available == 1
+        assert budget.available == 4
+
+    def test_request_clamped_to_total(self):
+        budget = TransferBudget(2)
+        with budget.take(8) as n:
+            assert n == 2
+
+    def test_blocks_until_released(self):
+        budget = TransferBudget(4)
+        order = []
+
+        def second():
+            with budget.take(2):
+                order.append("second")
+
+        with budget.take(4):
+            t = threading.Thread(target=second)
+            t.start()
+            time.sleep(0.05)
+            order.append("first done")
+        t.join()
+        assert order == ["first done", "second"]
+
+    def test_takes_what_is_free(self):
+        budget = TransferBudget(4)
+        with budget.take(3):
+            with budget.take(3) as n:
+                assert n == 1
+                assert budget.available == 0
+
+    def test_share_follows_running_jobs(self):
+        budget = TransferBudget(8, workers=3)
+        with budget.job():
+            # Alone: everything but one transfer per idle worker
+            assert budget.share() == 6
+            with budget.take(budget.share()) as first:
+                assert first == 6
+                with budget.job():
+                    # The second job gets the transfer kept for it...
+                    with budget.take(budget.share()) as second:
+                        assert second == 1
+                        with budget.job():
+                            # ...and so does the third, without waiting
+                            with budget.take(budget.share()) as third:
+                                assert third == 1
+                    assert budget.share() == 3
+        assert budget.available == 8
+
+    def test_never_exceeds_total(self):
+        budget = TransferBudget(5, workers=3)
+        lock = threading.Lock()
+        held = [0, 0]
+
+        def job():
+            with budget.job():
+                for _ in range(20):
+                    with budget.take(budget.share()) as n:
+                        with lock:
+                            held[0] += n
+                            held[1] = max(held[1], held[0])
+                        time.sleep(0.001)
+                        with lock:
+                            held[0] -= n
+
+        threads = [threading.Thread(target=job) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert 1 <= held[1] <= 5
+        assert budget.available == 5
+
+
+class TestJobPool:
+    def test_runs_by_priority(self):
+        pool = JobPool(1)
+        started = threading.Event()
+        release = threading.Event()
+        order = []
+
+        def block():
+            started.set()
+            release.wait()
+
+        first = pool.submit(0, block)
+        started.wait()
+        futures = [
+            pool.submit(1, order.append, "full scan"),
+            pool.submit(0, order.append, "hook"),
+            pool.submit(0, order.append, "webhook"),
+        ]
+        release.set()
+        for future in [first, *futures]:
+            future.result()
+        pool.shutdown()
+        assert order == ["hook", "webhook", "full scan"]
+
+    def test_returns_errors(self):
+        pool = JobPool(1)
+        future = pool.submit(0, int, "not a number")
+        with pytest.raises(ValueError):
+            future.result()
+        pool.shutdown()
+
+    def test_claims_once(self):
+        pool = JobPool(1)
+        assert pool.claim(["a", "b"]) == ["a", "b"]
+        assert pool.claim(["b", "c"]) == ["c"]
+        pool.release(["a", "b"])
+        assert pool.claim(["a", "b", "c"]) == ["a", "b"]
+        pool.shutdown()
+
+
+class TestClearExtractedDir:
+    def test_removes_leftovers(self, tmp_path):
+        (tmp_path / "release.zip.abc123").mkdir()
+        (tmp_path / "release.zip.abc123" / "movie.mkv").write_bytes(b"data")
+        (tmp_path / "stray").write_bytes(b"x")
+        clear_extracted_dir(tmp_path)
+        assert list(tmp_path.iterdir()) == []
+
+    def test_missing_dir(self, tmp_path):
+        clear_extracted_dir(tmp_path / "missing")
+
+
+class TestUploadPending:
+    @patch("upload.upload_batch", return_value=True)
+    def test_batches_plain_items(self, mock_batch, tmp_path, state):
+        tv = tmp_path / "tv"
+        tv.mkdir()
+        (tv / "a.mkv").write_bytes(b"a")
+        (tv / "b.mkv").write_bytes(b"b")
+        pending = [(tv / "a.mkv", "tv/"), (tv / "b.mkv", "tv/")]
+
+        budget = TransferBudget(8, workers=2)
+        assert upload_pending(pending, "b2:bucket", "/x", state, 2, budget)
+        # One batch job for the tv/ root, sharing the transfer budget
+        mock_batch.assert_called_once()
+        batch, _, job_budget = mock_batch.call_args[0]
+        assert list(batch) == [(str(tv), "b2:bucket/tv/")]
+        assert job_budget is budget
+        # Sizes from the scheduler's walk, for the records
+        assert mock_batch.call_args[1]["sizes"] == {tv / "a.mkv": 1, tv / "b.mkv": 1}
+
+    @patch("upload.BATCH_ITEMS", 2)
+    @patch("upload.upload_batch", return_value=True)
+    def test_jobs_follow_schedule(self, mock_batch, tmp_path, state):
+        tv = tmp_path / "tv"
+        tv.mkdir()
+        movies = tmp_path / "movies"
+        movies.mkdir()
+        pending = []
+        for i in range(3):
+            (tv / f"ep{i}.mkv").write_bytes(b"ep")
+            pending.append((tv / f"ep{i}.mkv", "tv/"))
+        (movies / "movie.mkv").write_bytes(b"movie")
+        pending.append((movies / "movie.mkv", "movies/"))
+
+        assert upload_pending(
+            pending, "b2:bucket", "/x", state, 1, TransferBudget(4), Scheduler()
+        )
+        # Full batches are split, and categories take turns
+        jobs = [
+            [item.name for entries in c[0][0].values() for item, _, _ in entries]
+            for c in mock_batch.call_args_list
+        ]
+        assert jobs == [["movie.mkv"], ["ep0.mkv", "ep1.mkv"], ["ep2.mkv"]]
+
+    @patch("upload.process_item", return_value=True)
+    @patch("upload.upload_batch")
+    def test_archive_items_are_separate_jobs(
+        self, mock_batch, mock_process, tmp_path, state
+    ):
+        a = tmp_path / "a.rar"
+        b = tmp_path / "b.zip"
+        a.write_bytes(b"rar")
+        b.write_bytes(b"zip")
+        pending = [(a, "downloads/"), (b, "downloads/")]
+
+        budget = TransferBudget(6, workers=3)
+        assert upload_pending(pending, "b2:bucket", "/x", state, 3, budget)
+        mock_batch.assert_not_called()
+        assert sorted(c[0][0].name for c in mock_process.call_args_list) == [
+            "a.rar",
+            "b.zip",
+        ]
+        assert all(c[1]["budget"] is budget for c in mock_process.call_args_list)
+
+    @patch("upload.process_item")
+    @patch("upload.upload_batch")
+    def test_failed_job_does_not_stop_others(
+        self, mock_batch, mock_process, tmp_path, state
+    ):
+        mock_process.side_effect = [RuntimeError("boom"), True]
+        a = tmp_path / "a.rar"
+        b = tmp_path / "b.rar"
+        a.write_bytes(b"rar")
+        b.write_bytes(b"rar")
+        pending = [(a, "downloads/"), (b, "downloads/")]
+
+        assert not upload_pending(
+            pending, "b2:bucket", "/x", state, 1, TransferBudget(4)
+        )
+        assert mock_process.call_count == 2
+
+    @patch("upload.upload_batch", return_value=True)
+    def test_publishes_backlog(self, mock_batch, tmp_path, state):
+        metrics = Metrics(None, METRICS.definitions)
+        seen = []
+
+        def run(batch, state, budget, sizes):
+            seen.append(dict(metrics.values["qbt_upload_pending_bytes"]))
+            return True
+
+        mock_batch.side_effect = run
+        (tmp_path / "a.mkv").write_bytes(b"aaa")
+        (tmp_path / "b.mkv").write_bytes(b"bb")
+        pending = [(tmp_path / "a.mkv", "tv/"), (tmp_path / "b.mkv", "tv/")]
+        with patch("upload.METRICS", metrics):
+            upload_pending(pending, "b2:bucket", "/x", state, 1, TransferBudget(4))
+        assert seen == [{(): 5}]
+        assert metrics.values["qbt_upload_pending_items"] == {(): 0}
+        assert metrics.values["qbt_upload_pending_bytes"] == {(): 0}
+
+    @patch("upload.upload_batch", return_value=True)
+    def test_leaves_claimed_items_to_their_round(self, mock_batch, tmp_path, state):
+        (tmp_path / "a.mkv").write_bytes(b"a")
+        (tmp_path / "b.mkv").write_bytes(b"b")
+        pending = [(tmp_path / "a.mkv", "tv/"), (tmp_path / "b.mkv", "tv/")]
+        pool = JobPool(1)
+        # Another round is uploading a.mkv
+        pool.claim([tmp_path / "a.mkv"])
+
+        assert upload_pending(
+            pending, "b2:bucket", "/x", state, 1, TransferBudget(4), pool=pool
+        )
+        (entries,) = mock_batch.call_args[0][0].values()
+        assert [item for item, _, _ in entries] == [tmp_path / "b.mkv"]
+        # b.mkv is free again, a.mkv still belongs to the other round
+        assert pool.claim([item for item, _ in pending]) == [tmp_path / "b.mkv"]
+        pool.shutdown()
+
+    @patch("upload.process_item", return_value=False)
+    def test_reports_failure(self, mock_process, tmp_path, state):
+        a = tmp_path / "a.rar"
+        a.write_bytes(b"rar")
+        assert not upload_pending(
+            [(a, "downloads/")], "b2:bucket", "/x", state, 2, TransferBudget(4)
+        )
+
+    @patch("upload.rclone_copy", return_value=True)
+    @patch("upload.rclone_check", return_value=False)
+    @patch("upload.subprocess.run")  # unar
+    def test_same_name_archives_get_own_work_dirs(
+        self, mock_run, mock_check, mock_copy, tmp_path, state
+    ):
+        work_dirs = []
+        mock_run.side_effect = lambda args, **kw: work_dirs.append(args[3])
+        extracted = tmp_path / "extracted"
+        for sub in ("one", "two"):
+            (tmp_path / sub).mkdir()
+            (tmp_path / sub / "release.zip").write_bytes(b"zip")
+        pending = [
+            (tmp_path / "one" / "release.zip", "downloads/"),
+            (tmp_path / "two" / "release.zip", "tv/"),
+        ]
+
+        assert upload_pending(
+            pending, "b2:bucket", str(extracted), state, 2, TransferBudget(4)
+        )
+        assert len(set(work_dirs)) == 2
+        assert list(extracted.iterdir()) == []
+
+
 class TestScanImportDir:
     @patch("upload.process_item", return_value=True)
-    def test_skips_uploaded(self, mock_process, tmp_path):
+    def test_skips_uploaded(self, mock_process, tmp_path, state):
         (tmp_path / "episode.mkv").write_bytes(b"data")
-        (tmp_path / "episode.mkv.uploaded").touch()
+        state.mark(tmp_path / "episode.mkv", "tv/episode.mkv")
         (tmp_path / "new.mkv").write_bytes(b"data")
 
-        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted")
+        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted", state)
         # Only new.mkv should be processed
         assert mock_process.call_count == 1
         assert mock_process.call_args[0][0].name == "new.mkv"
 
     @patch("upload.process_item", return_value=True)
-    def test_skips_marker_files(self, mock_process, tmp_path):
+    def test_uploaded_elsewhere_is_pending(self, mock_process, tmp_path, state):
+        """Same inode recorded under a different B2 path (e.g. a rename)."""
         (tmp_path / "episode.mkv").write_bytes(b"data")
-        (tmp_path / "episode.mkv.uploaded").touch()
+        state.mark(tmp_path / "episode.mkv", "tv/Old Name/episode.mkv")
 
-        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted")
-        mock_process.assert_not_called()
+        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted", state)
+        assert mock_process.call_count == 1
 
     @patch("upload.process_item", return_value=True)
-    def test_recurses_into_directories(self, mock_process, tmp_path):
+    def test_modified_file_is_pending(self, mock_process, tmp_path, state):
+        """A file rewritten in place (new mtime) is no longer uploaded."""
+        f = tmp_path / "episode.mkv"
+        f.write_bytes(b"data")
+        state.mark(f, "tv/episode.mkv")
+        os.utime(f, ns=(0, 12345))
+
+        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted", state)
+        assert mock_process.call_count == 1
+
+    @patch("upload.process_item", return_value=True)
+    def test_recurses_into_directories(self, mock_process, tmp_path, state):
         show_dir = tmp_path / "Show Name"
         season_dir = show_dir / "Season 1"
         season_dir.mkdir(parents=True)
         (season_dir / "episode.mkv").write_bytes(b"data")
 
-        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted")
+        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted", state)
         assert mock_process.call_count == 1
         # B2 base should include the full path hierarchy
         assert mock_process.call_args[0][1] == "tv/Show Name/Season 1/"
 
     @patch("upload.process_item", return_value=True)
-    def test_nonexistent_directory(self, mock_process, tmp_path):
-        scan_import_dir(tmp_path / "nonexistent", "tv/", "b2:bucket", "/tmp/extracted")
+    def test_collects_pending(self, mock_process, tmp_path, state):
+        season = tmp_path / "Show" / "Season 1"
+        season.mkdir(parents=True)
+        (season / "ep.mkv").write_bytes(b"data")
+        pending = []
+
+        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted", state, pending)
+        mock_process.assert_not_called()
+        assert pending == [(season / "ep.mkv", "tv/Show/Season 1/")]
+
+    def test_skips_files_of_unchanged_directory(self, tmp_path, state):
+        season = tmp_path / "Show" / "Season 1"
+        season.mkdir(parents=True)
+        ep = season / "ep.mkv"
+        ep.write_bytes(b"data")
+        state.mark(ep, "tv/Show/Season 1/ep.mkv")
+
+        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted", state, [])
+        assert state.dir_unchanged(season, season.stat(), 1)
+
+        # Files of a snapshotted directory aren't looked at again
+        with patch.object(state, "is_uploaded_stat") as mock_uploaded:
+            pending = []
+            scan_import_dir(
+                tmp_path, "tv/", "b2:bucket", "/tmp/extracted", state, pending
+            )
+        mock_uploaded.assert_not_called()
+        assert pending == []
+
+    def test_new_file_invalidates_snapshot(self, tmp_path, state):
+        """A new episode changes the season's mtime, not the show's."""
+        season = tmp_path / "Show" / "Season 1"
+        season.mkdir(parents=True)
+        ep = season / "ep1.mkv"
+        ep.write_bytes(b"data")
+        state.mark(ep, "tv/Show/Season 1/ep1.mkv")
+        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted", state, [])
+
+        (season / "ep2.mkv").write_bytes(b"data")
+        pending = []
+        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted", state, pending)
+        assert pending == [(season / "ep2.mkv", "tv/Show/Season 1/")]
+
+    def test_no_snapshot_with_pending_files(self, tmp_path, state):
+        (tmp_path / "ep.mkv").write_bytes(b"data")
+        pending = []
+        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted", state, pending)
+        scan_import_dir(tmp_path, "tv/", "b2:bucket", "/tmp/extracted", state, pending)
+        # Still pending on the second scan — not yet uploaded
+        assert len(pending) == 2
+        assert state.dir_snapshots == {}
+
+    @patch("upload.process_item", return_value=True)
+    def test_nonexistent_directory(self, mock_process, tmp_path, state):
+        scan_import_dir(
+            tmp_path / "nonexistent", "tv/", "b2:bucket", "/tmp/extracted", state
+        )
         mock_process.assert_not_called()
 
 
 class TestScanCompletedDir:
     @patch("upload.process_item", return_value=True)
-    def test_skips_category_dirs(self, mock_process, tmp_path):
+    def test_skips_category_dirs(self, mock_process, tmp_path, state):
         # Create a category subdir and a regular file
         tv_dir = tmp_path / "tv"
         tv_dir.mkdir()
@@ -230,25 +1637,29 @@ class TestScanCompletedDir:
 
         category_dirs = {str(tv_dir)}
         scan_completed_dir(
-            tmp_path, "downloads/", "b2:bucket", "/tmp/extracted", category_dirs
+            tmp_path, "downloads/", "b2:bucket", "/tmp/extracted", category_dirs, state
         )
         assert mock_process.call_count == 1
         assert mock_process.call_args[0][0].name == "uncategorized.mkv"
 
     @patch("upload.process_item", return_value=True)
-    def test_skips_uploaded(self, mock_process, tmp_path):
+    def test_skips_uploaded(self, mock_process, tmp_path, state):
         (tmp_path / "file.mkv").write_bytes(b"data")
-        (tmp_path / "file.mkv.uploaded").touch()
+        state.mark(tmp_path / "file.mkv", "downloads/file.mkv")
 
-        scan_completed_dir(tmp_path, "downloads/", "b2:bucket", "/tmp/extracted", set())
+        scan_completed_dir(
+            tmp_path, "downloads/", "b2:bucket", "/tmp/extracted", set(), state
+        )
         mock_process.assert_not_called()
 
     @patch("upload.process_item", return_value=True)
-    def test_processes_uncategorized(self, mock_process, tmp_path):
+    def test_processes_uncategorized(self, mock_process, tmp_path, state):
         (tmp_path / "random-download").mkdir()
         (tmp_path / "file.mkv").write_bytes(b"data")
 
-        scan_completed_dir(tmp_path, "downloads/", "b2:bucket", "/tmp/extracted", set())
+        scan_completed_dir(
+            tmp_path, "downloads/", "b2:bucket", "/tmp/extracted", set(), state
+        )
         assert mock_process.call_count == 2
 
 
@@ -293,7 +1704,7 @@ class TestNeedsLinking:
 
 
 class TestLinkToImportDir:
-    def test_links_manual_file(self, tmp_path):
+    def test_links_manual_file(self, tmp_path, state):
         """Manual file (nlink == 1) gets hard linked to import dir."""
         completed = tmp_path / "completed" / "movies"
         completed.mkdir(parents=True)
@@ -304,14 +1715,34 @@ class TestLinkToImportDir:
         src.write_bytes(b"data")
 
         link_to_import_dir(
-            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"]
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state
         )
 
         dst = import_dir / "movie.mkv"
         assert dst.exists()
         assert os.stat(src).st_ino == os.stat(dst).st_ino
 
-    def test_links_manual_directory(self, tmp_path):
+    def test_links_visible_to_later_steps(self, tmp_path, state):
+        """Links made during a run show up in the run's shared listing."""
+        completed = tmp_path / "completed" / "movies"
+        completed.mkdir(parents=True)
+        import_dir = tmp_path / "arr" / "movies"
+        import_dir.mkdir(parents=True)
+        release = completed / "Movie (2024)"
+        release.mkdir()
+        (release / "movie.mkv").write_bytes(b"data")
+        tree = Tree([tmp_path / "completed", import_dir])
+
+        link_to_import_dir(
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state, tree
+        )
+        pending = []
+        scan_import_dir(import_dir, "movies/", "b2:bucket", "/x", state, pending, tree)
+        assert pending == [
+            (import_dir / "Movie (2024)" / "movie.mkv", "movies/Movie (2024)/")
+        ]
+
+    def test_links_manual_directory(self, tmp_path, state):
         """Manual directory (all nlink == 1) gets hard linked preserving structure."""
         completed = tmp_path / "completed" / "movies"
         completed.mkdir(parents=True)
@@ -328,7 +1759,7 @@ class TestLinkToImportDir:
         f2.write_bytes(b"subs")
 
         link_to_import_dir(
-            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"]
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state
         )
 
         dst_movie = import_dir / "My.Movie.2024" / "movie.mkv"
@@ -338,7 +1769,7 @@ class TestLinkToImportDir:
         assert os.stat(f1).st_ino == os.stat(dst_movie).st_ino
         assert os.stat(f2).st_ino == os.stat(dst_subs).st_ino
 
-    def test_skips_arr_managed(self, tmp_path):
+    def test_skips_arr_managed(self, tmp_path, state):
         """Items with nlink > 1 (arr-managed) are not re-linked."""
         completed = tmp_path / "completed" / "movies"
         completed.mkdir(parents=True)
@@ -352,7 +1783,7 @@ class TestLinkToImportDir:
         os.link(src, arr_link)
 
         link_to_import_dir(
-            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"]
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state
         )
 
         # Should NOT create a second link with the torrent name
@@ -360,8 +1791,8 @@ class TestLinkToImportDir:
         # Original arr link still exists
         assert arr_link.exists()
 
-    def test_skips_already_uploaded(self, tmp_path):
-        """Items with .uploaded marker are skipped."""
+    def test_skips_already_uploaded(self, tmp_path, state):
+        """Items recorded as uploaded are skipped."""
         completed = tmp_path / "completed" / "movies"
         completed.mkdir(parents=True)
         import_dir = tmp_path / "arr" / "movies"
@@ -369,15 +1800,15 @@ class TestLinkToImportDir:
 
         src = completed / "movie.mkv"
         src.write_bytes(b"data")
-        (completed / "movie.mkv.uploaded").touch()
+        state.mark(src, "downloads/movie.mkv")
 
         link_to_import_dir(
-            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"]
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state
         )
 
         assert not (import_dir / "movie.mkv").exists()
 
-    def test_skips_existing_destination(self, tmp_path):
+    def test_skips_existing_destination(self, tmp_path, state):
         """Does not overwrite existing files in import dir."""
         completed = tmp_path / "completed" / "movies"
         completed.mkdir(parents=True)
@@ -391,19 +1822,19 @@ class TestLinkToImportDir:
         existing.write_bytes(b"old data")
 
         link_to_import_dir(
-            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"]
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state
         )
 
         # Existing file should not be overwritten
         assert existing.read_bytes() == b"old data"
 
-    def test_nonexistent_subdir(self, tmp_path):
+    def test_nonexistent_subdir(self, tmp_path, state):
         """No crash when completed subdir doesn't exist."""
         link_to_import_dir(
-            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"]
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state
         )
 
-    def test_multiple_subdirs(self, tmp_path):
+    def test_multiple_subdirs(self, tmp_path, state):
         """Links items across multiple subdirs."""
         for subdir in ("tv", "movies"):
             (tmp_path / "completed" / subdir).mkdir(parents=True)
@@ -413,7 +1844,7 @@ class TestLinkToImportDir:
         (tmp_path / "completed" / "movies" / "film.mkv").write_bytes(b"film")
 
         link_to_import_dir(
-            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies", "tv"]
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies", "tv"], state
         )
 
         assert (tmp_path / "arr" / "tv" / "show.mkv").exists()
@@ -421,7 +1852,7 @@ class TestLinkToImportDir:
 
 
 class TestPropagateMarkers:
-    def test_propagates_for_manual_item(self, tmp_path):
+    def test_propagates_for_manual_item(self, tmp_path, state):
         """Marker propagated when import dir file (same inode) is marked uploaded."""
         completed = tmp_path / "completed" / "movies"
         completed.mkdir(parents=True)
@@ -433,15 +1864,15 @@ class TestPropagateMarkers:
         dst = import_dir / "movie.mkv"
         os.link(src, dst)
         # Mark import dir version as uploaded
-        (import_dir / "movie.mkv.uploaded").touch()
+        state.mark(dst, "movies/movie.mkv")
 
         propagate_markers(
-            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"]
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state
         )
 
-        assert (completed / "movie.mkv.uploaded").exists()
+        assert state.is_uploaded(src)
 
-    def test_propagates_for_arr_managed(self, tmp_path):
+    def test_propagates_for_arr_managed(self, tmp_path, state):
         """Marker propagated for arr items (different names, same inodes)."""
         completed = tmp_path / "completed" / "movies"
         completed.mkdir(parents=True)
@@ -453,15 +1884,15 @@ class TestPropagateMarkers:
         # Sonarr/Radarr hard link with a different name
         dst = import_dir / "Movie Name.mkv"
         os.link(src, dst)
-        (import_dir / "Movie Name.mkv.uploaded").touch()
+        state.mark(dst, "movies/Movie Name (2024)/Movie Name.mkv")
 
         propagate_markers(
-            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"]
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state
         )
 
-        assert (completed / "torrent.x264.mkv.uploaded").exists()
+        assert state.is_uploaded(src)
 
-    def test_propagates_for_directory(self, tmp_path):
+    def test_propagates_for_directory(self, tmp_path, state):
         """Marker propagated for directory items when all file inodes match."""
         completed = tmp_path / "completed" / "tv"
         completed.mkdir(parents=True)
@@ -480,15 +1911,42 @@ class TestPropagateMarkers:
         dst_dir.mkdir()
         os.link(f1, dst_dir / "ep1.mkv")
         os.link(f2, dst_dir / "ep2.mkv")
-        (dst_dir / "ep1.mkv.uploaded").touch()
-        (dst_dir / "ep2.mkv.uploaded").touch()
+        state.mark(dst_dir / "ep1.mkv", "tv/show-torrent/ep1.mkv")
+        state.mark(dst_dir / "ep2.mkv", "tv/show-torrent/ep2.mkv")
 
-        propagate_markers(str(tmp_path / "completed"), str(tmp_path / "arr"), ["tv"])
+        propagate_markers(
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["tv"], state
+        )
 
-        assert (completed / "show-torrent.uploaded").exists()
+        # The directory itself is recorded (propagated, no own B2 path)
+        assert state.is_uploaded(torrent, "")
 
-    def test_no_propagation_if_not_all_uploaded(self, tmp_path):
-        """No marker if some files in import dir are not yet uploaded."""
+    def test_item_walked_once(self, tmp_path, state):
+        """Item inodes are cached until the rest of its content is uploaded."""
+        completed = tmp_path / "completed" / "tv"
+        completed.mkdir(parents=True)
+        import_dir = tmp_path / "arr" / "tv"
+        import_dir.mkdir(parents=True)
+
+        torrent = completed / "show-torrent"
+        torrent.mkdir()
+        (torrent / "ep1.mkv").write_bytes(b"ep1")
+        (torrent / "ep2.mkv").write_bytes(b"ep2")
+        os.link(torrent / "ep1.mkv", import_dir / "ep1.mkv")
+        os.link(torrent / "ep2.mkv", import_dir / "ep2.mkv")
+        state.mark(import_dir / "ep1.mkv", "tv/ep1.mkv")
+        args = (str(tmp_path / "completed"), str(tmp_path / "arr"), ["tv"], state)
+
+        propagate_markers(*args)
+        assert not state.is_uploaded(torrent)
+
+        state.mark(import_dir / "ep2.mkv", "tv/ep2.mkv")
+        with patch("upload.Tree.files", side_effect=AssertionError):
+            propagate_markers(*args)
+        assert state.is_uploaded(torrent, "")
+
+    def test_no_propagation_if_not_all_uploaded(self, tmp_path, state):
+        """Not propagated if some files in import dir are not yet uploaded."""
         completed = tmp_path / "completed" / "tv"
         completed.mkdir(parents=True)
         import_dir = tmp_path / "arr" / "tv"
@@ -506,13 +1964,15 @@ class TestPropagateMarkers:
         os.link(f1, dst_dir / "ep1.mkv")
         os.link(f2, dst_dir / "ep2.mkv")
         # Only one of two files marked as uploaded
-        (dst_dir / "ep1.mkv.uploaded").touch()
+        state.mark(dst_dir / "ep1.mkv", "tv/show-torrent/ep1.mkv")
 
-        propagate_markers(str(tmp_path / "completed"), str(tmp_path / "arr"), ["tv"])
+        propagate_markers(
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["tv"], state
+        )
 
-        assert not (completed / "show-torrent.uploaded").exists()
+        assert not state.is_uploaded(torrent)
 
-    def test_skips_already_marked(self, tmp_path):
+    def test_skips_already_marked(self, tmp_path, state):
         """Items already marked as uploaded are skipped."""
         completed = tmp_path / "completed" / "movies"
         completed.mkdir(parents=True)
@@ -521,17 +1981,18 @@ class TestPropagateMarkers:
 
         src = completed / "movie.mkv"
         src.write_bytes(b"data")
-        (completed / "movie.mkv.uploaded").touch()
+        state.mark(src, "downloads/movie.mkv")
 
         propagate_markers(
-            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"]
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state
         )
 
         # Should not crash or change anything
-        assert (completed / "movie.mkv.uploaded").exists()
+        assert state.is_uploaded(src, "downloads/movie.mkv")
+        assert not state.is_uploaded(src, "")
 
-    def test_no_propagation_if_no_match(self, tmp_path):
-        """No marker if file inodes don't exist in import dir."""
+    def test_no_propagation_if_no_match(self, tmp_path, state):
+        """Not propagated if file inodes don't exist in import dir."""
         completed = tmp_path / "completed" / "movies"
         completed.mkdir(parents=True)
         import_dir = tmp_path / "arr" / "movies"
@@ -542,13 +2003,520 @@ class TestPropagateMarkers:
         # No hard link in import dir — inode won't match anything
 
         propagate_markers(
-            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"]
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state
         )
 
-        assert not (completed / "movie.mkv.uploaded").exists()
+        assert not state.is_uploaded(src)
 
-    def test_nonexistent_dirs(self, tmp_path):
+    def test_no_propagation_for_other_content(self, tmp_path, state):
+        """A record of the same inode with other content doesn't count."""
+        completed = tmp_path / "completed" / "movies"
+        completed.mkdir(parents=True)
+        import_dir = tmp_path / "arr" / "movies"
+        import_dir.mkdir(parents=True)
+
+        src = completed / "movie.mkv"
+        src.write_bytes(b"data")
+        os.link(src, import_dir / "movie.mkv")
+        state.mark(import_dir / "movie.mkv", "movies/movie.mkv")
+        # Rewritten (or the inode reused) since it was uploaded
+        src.write_bytes(b"other content")
+
+        propagate_markers(
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state
+        )
+
+        assert not state.is_uploaded(src, "")
+
+    def test_nonexistent_dirs(self, tmp_path, state):
         """No crash when directories don't exist."""
         propagate_markers(
-            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"]
+            str(tmp_path / "completed"), str(tmp_path / "arr"), ["movies"], state
+        )
+
+
+class TestCollectChanged:
+    def _layout(self, tmp_path):
+        completed = tmp_path / "completed"
+        (completed / "tv").mkdir(parents=True)
+        arr = tmp_path / "arr"
+        (arr / "tv").mkdir(parents=True)
+        return completed, arr
+
+    def test_import_file(self, tmp_path, state):
+        completed, arr = self._layout(tmp_path)
+        season = arr / "tv" / "Show" / "Season 1"
+        season.mkdir(parents=True)
+        ep = season / "ep.mkv"
+        ep.write_bytes(b"data")
+        pending = []
+
+        link = collect_changed([ep], completed, arr, ["tv"], state, pending)
+        assert not link
+        assert pending == [(ep, "tv/Show/Season 1/")]
+
+    def test_import_directory(self, tmp_path, state):
+        """A new season directory contributes every file inside it."""
+        completed, arr = self._layout(tmp_path)
+        season = arr / "tv" / "Show" / "Season 1"
+        season.mkdir(parents=True)
+        (season / "ep1.mkv").write_bytes(b"data")
+        (season / "ep2.mkv").write_bytes(b"data")
+        pending = []
+
+        collect_changed(
+            [arr / "tv" / "Show", season / "ep1.mkv"],
+            completed,
+            arr,
+            ["tv"],
+            state,
+            pending,
+        )
+        assert pending == [
+            (season / "ep1.mkv", "tv/Show/Season 1/"),
+            (season / "ep2.mkv", "tv/Show/Season 1/"),
+        ]
+
+    def test_skips_uploaded_and_missing(self, tmp_path, state):
+        completed, arr = self._layout(tmp_path)
+        ep = arr / "tv" / "ep.mkv"
+        ep.write_bytes(b"data")
+        state.mark(ep, "tv/ep.mkv")
+        pending = []
+
+        collect_changed(
+            [ep, arr / "tv" / "gone.mkv"], completed, arr, ["tv"], state, pending
+        )
+        assert pending == []
+
+    def test_uncategorized_maps_to_top_level_item(self, tmp_path, state):
+        completed, arr = self._layout(tmp_path)
+        release = completed / "release"
+        release.mkdir()
+        (release / "a.mkv").write_bytes(b"a")
+        (release / "b.nfo").write_bytes(b"b")
+        pending = []
+
+        collect_changed(
+            [release / "a.mkv", release / "b.nfo"],
+            completed,
+            arr,
+            ["tv"],
+            state,
+            pending,
+        )
+        assert pending == [(release, "downloads/")]
+
+    def test_category_item_needs_linking(self, tmp_path, state):
+        completed, arr = self._layout(tmp_path)
+        item = completed / "tv" / "show-torrent"
+        item.mkdir()
+        pending = []
+
+        assert collect_changed([item], completed, arr, ["tv"], state, pending)
+        assert pending == []
+
+
+class TestRunChanged:
+    @patch("upload.propagate_markers")
+    @patch("upload.upload_pending", return_value=True)
+    @patch("upload.link_to_import_dir")
+    def test_uploads_changed_items(
+        self, mock_link, mock_upload, mock_propagate, tmp_path, state
+    ):
+        (tmp_path / "arr" / "tv").mkdir(parents=True)
+        ep = tmp_path / "arr" / "tv" / "ep.mkv"
+        ep.write_bytes(b"data")
+        budget = TransferBudget(4)
+        pool = MagicMock()
+
+        assert run_changed(
+            [str(ep)],
+            str(tmp_path / "completed"),
+            str(tmp_path / "arr"),
+            ["tv"],
+            "b2:bucket",
+            "/tmp/extracted",
+            state,
+            2,
+            budget,
+            pool=pool,
+        )
+        mock_link.assert_not_called()
+        mock_upload.assert_called_once_with(
+            [(ep, "tv/")], "b2:bucket", "/tmp/extracted", state, 2, budget, None, pool
+        )
+        mock_propagate.assert_called_once()
+
+    @patch("upload.propagate_markers")
+    @patch("upload.upload_pending")
+    @patch("upload.link_to_import_dir")
+    def test_links_category_items(
+        self, mock_link, mock_upload, mock_propagate, tmp_path, state
+    ):
+        item = tmp_path / "completed" / "tv" / "show-torrent"
+        item.mkdir(parents=True)
+
+        run_changed(
+            [str(item)],
+            str(tmp_path / "completed"),
+            str(tmp_path / "arr"),
+            ["tv"],
+            "b2:bucket",
+            "/tmp/extracted",
+            state,
+            2,
+            TransferBudget(4),
+        )
+        mock_link.assert_called_once()
+        # The new links are uploaded when their own events come in
+        mock_upload.assert_not_called()
+        mock_propagate.assert_called_once()
+
+    @patch("upload.propagate_markers")
+    @patch("upload.upload_pending")
+    @patch("upload.link_to_import_dir")
+    def test_nothing_to_do(
+        self, mock_link, mock_upload, mock_propagate, tmp_path, state
+    ):
+        assert run_changed(
+            [str(tmp_path / "completed" / "gone.mkv")],
+            str(tmp_path / "completed"),
+            str(tmp_path / "arr"),
+            ["tv"],
+            "b2:bucket",
+            "/tmp/extracted",
+            state,
+            2,
+            TransferBudget(4),
         )
+        mock_link.assert_not_called()
+        mock_upload.assert_not_called()
+        mock_propagate.assert_not_called()
+
+
+class TestRunCompleted:
+    def _run(self, tmp_path, state, completions):
+        return run_completed(
+            completions,
+            str(tmp_path / "completed"),
+            str(tmp_path / "arr"),
+            ["tv"],
+            "b2:bucket",
+            "/tmp/extracted",
+            state,
+            2,
+            TransferBudget(4),
+        )
+
+    @patch("upload.MANUAL_CATEGORIES", {"tv"})
+    @patch("upload.run_changed", return_value=True)
+    def test_links_and_uploads_category_item(self, mock_changed, tmp_path, state):
+        item = tmp_path / "completed" / "tv" / "Show.S01"
+        item.mkdir(parents=True)
+        (item / "ep1.mkv").write_bytes(b"1")
+        (item / "ep2.mkv").write_bytes(b"2")
+
+        assert self._run(tmp_path, state, [("abc", "tv", str(item))])
+        links = [
+            tmp_path / "arr" / "tv" / "Show.S01" / "ep1.mkv",
+            tmp_path / "arr" / "tv" / "Show.S01" / "ep2.mkv",
+        ]
+        assert all(link.stat().st_nlink == 2 for link in links)
+        # The links go straight to upload, without waiting for inotify
+        assert mock_changed.call_args[0][0] == links
+
+    @patch("upload.MANUAL_CATEGORIES", {"tv"})
+    @patch("upload.run_changed", return_value=True)
+    def test_arr_category_not_linked(self, mock_changed, tmp_path, state):
+        item = tmp_path / "completed" / "tv" / "Show.S01.1080p-GRP"
+        item.mkdir(parents=True)
+        (item / "ep1.mkv").write_bytes(b"1")
+
+        assert self._run(tmp_path, state, [("abc", "tv-sonarr", str(item))])
+        # Sonarr imports it under its own name; linking it too would upload
+        # a second copy
+        assert not (tmp_path / "arr" / "tv").exists()
+        assert (item / "ep1.mkv").stat().st_nlink == 1
+        mock_changed.assert_not_called()
+
+    @patch("upload.MANUAL_CATEGORIES", {"tv"})
+    @patch("upload.run_changed", return_value=True)
+    def test_already_linked(self, mock_changed, tmp_path, state):
+        (tmp_path / "completed" / "tv").mkdir(parents=True)
+        (tmp_path / "arr" / "tv").mkdir(parents=True)
+        ep = tmp_path / "completed" / "tv" / "ep.mkv"
+        ep.write_bytes(b"data")
+        # Sonarr got there first
+        os.link(ep, tmp_path / "arr" / "tv" / "Show - S01E01.mkv")
+
+        assert self._run(tmp_path, state, [("abc", "tv-sonarr", str(ep))])
+        assert not (tmp_path / "arr" / "tv" / "ep.mkv").exists()
+        mock_changed.assert_not_called()
+
+    @patch("upload.run_changed", return_value=False)
+    def test_uncategorized(self, mock_changed, tmp_path, state):
+        film = tmp_path / "completed" / "film.mkv"
+        film.parent.mkdir()
+        film.write_bytes(b"data")
+
+        assert not self._run(tmp_path, state, [("abc", "", str(film))])
+        assert mock_changed.call_args[0][0] == [film]
+
+    @patch("upload.run_changed")
+    def test_outside_completed(self, mock_changed, tmp_path, state):
+        assert self._run(tmp_path, state, [("abc", "", "/elsewhere/film.mkv")])
+        mock_changed.assert_not_called()
+
+
+class TestDaemonRound:
+    def test_logs_and_continues(self, capsys):
+        with daemon_round("Full rescan"):
+            raise subprocess.CalledProcessError(1, "unar")
+        out = capsys.readouterr()
+        assert "Full rescan failed, continuing" in out.out
+        assert "CalledProcessError" in out.err
+
+    def test_lets_exit_through(self):
+        with pytest.raises(SystemExit):
+            with daemon_round("Full rescan"):
+                raise SystemExit(0)
+
+
+class TestRunWebhook:
+    def _run(self, tmp_path, state, events):
+        return run_webhook(
+            events,
+            str(tmp_path / "completed"),
+            str(tmp_path / "arr"),
+            ["tv"],
+            "b2:bucket",
+            "/tmp/extracted",
+            state,
+            2,
+            TransferBudget(4),
+        )
+
+    @patch("upload.refresh_mount")
+    @patch("upload.server_delete", return_value=True)
+    @patch("upload.run_changed", return_value=True)
+    def test_upgrade(self, mock_changed, mock_delete, mock_refresh, tmp_path, state):
+        season = tmp_path / "arr" / "tv" / "Show" / "Season 1"
+        season.mkdir(parents=True)
+        new = season / "ep - Bluray.mkv"
+        new.write_bytes(b"new")
+        old = season / "ep - HDTV.mkv"
+        state.manifest = {"tv/Show/Season 1/ep - HDTV.mkv": (3, 0, None)}
+
+        assert self._run(tmp_path, state, [("Download", [str(new)], [str(old)])])
+        mock_delete.assert_called_once_with(
+            "b2:bucket", "tv/Show/Season 1/ep - HDTV.mkv"
+        )
+        assert state.manifest == {}
+        mock_refresh.assert_called_once_with(["tv/Show/Season 1"])
+        mock_changed.assert_called_once()
+        assert mock_changed.call_args[0][0] == [str(new)]
+
+    @patch("upload.server_delete")
+    @patch("upload.run_changed", return_value=True)
+    def test_keeps_objects_still_needed(
+        self, mock_changed, mock_delete, tmp_path, state
+    ):
+        season = tmp_path / "arr" / "tv" / "Show"
+        season.mkdir(parents=True)
+        ep = season / "ep.mkv"
+        ep.write_bytes(b"new")
+        kept = season / "other.mkv"
+        kept.write_bytes(b"still here")
+        state.manifest = {
+            "tv/Show/ep.mkv": (3, 0, None),
+            "tv/Show/other.mkv": (10, 0, None),
+        }
+
+        # Same file name as the new release; a path that still exists;
+        # an object the listing doesn't have
+        events = [("Download", [str(ep)], [str(ep), str(kept), str(season / "x.mkv")])]
+        assert self._run(tmp_path, state, events)
+        mock_delete.assert_not_called()
+
+    @patch("upload.refresh_mount")
+    @patch("upload.server_delete", return_value=True)
+    @patch("upload.rclone_copy_batch", return_value=set())
+    def test_upgrade_after_upload(
+        self, mock_batch, mock_delete, mock_refresh, tmp_path, state
+    ):
+        season = tmp_path / "arr" / "tv" / "Show"
+        season.mkdir(parents=True)
+        old = season / "ep - HDTV.mkv"
+        old.write_bytes(b"old")
+        # Listing fetched before the upload
+        state.replace_manifest({})
+        batch = {}
+        assert process_item(old, "tv/Show/", "b2:bucket", "/x", state, batch)
+        assert upload_batch(batch, state)
+
+        # Sonarr replaces it before the listing is fetched again
+        old.unlink()
+        assert retire_objects(
+            [str(old)], set(), str(tmp_path / "arr"), ["tv"], "b2:bucket", state
+        )
+        mock_delete.assert_called_once_with("b2:bucket", "tv/Show/ep - HDTV.mkv")
+        assert state.manifest == {}
+
+    @patch("upload.server_delete", return_value=True)
+    def test_record_newer_than_listing(self, mock_delete, tmp_path, state):
+        season = tmp_path / "arr" / "tv" / "Show"
+        season.mkdir(parents=True)
+        old = season / "ep.mkv"
+        old.write_bytes(b"old")
+        state.replace_manifest({})
+        state.mark(old, "tv/Show/ep.mkv")
+        old.unlink()
+
+        # Uploaded after the listing but missing from it (not added on upload)
+        with patch("upload.refresh_mount"):
+            assert retire_objects(
+                [str(old)], set(), str(tmp_path / "arr"), ["tv"], "b2:bucket", state
+            )
+        mock_delete.assert_called_once_with("b2:bucket", "tv/Show/ep.mkv")
+
+    @patch("upload.run_changed")
+    def test_nothing_imported(self, mock_changed, tmp_path, state):
+        assert self._run(tmp_path, state, [])
+        mock_changed.assert_not_called()
+
+
+class TestRecordThroughput:
+    def test_moving_average(self, state):
+        record_throughput(state, 200_000_000, 100)
+        assert float(state.get_meta("upload_throughput")) == 2_000_000
+        record_throughput(state, 1_000_000_000, 1000)
+        assert float(state.get_meta("upload_throughput")) == 1_700_000
+
+    def test_ignores_small_rounds(self, state):
+        record_throughput(state, 1000, 0.001)
+        assert state.get_meta("upload_throughput") is None
+
+
+class TestFilesSize:
+    def test_skips_missing(self, tmp_path):
+        f = tmp_path / "ep.mkv"
+        f.write_bytes(b"data")
+        assert files_size([f, tmp_path / "gone.mkv"]) == 4
+
+
+class TestPlanRun:
+    def _tree(self, tmp_path):
+        completed = tmp_path / "completed"
+        arr = tmp_path / "arr"
+        (completed / "movies").mkdir(parents=True)
+        (completed / "tv").mkdir()
+        (arr / "movies").mkdir(parents=True)
+        (arr / "tv" / "Show").mkdir(parents=True)
+        # Manual category item, still to be linked
+        (completed / "movies" / "movie.mkv").write_bytes(b"m" * 400)
+        # Sonarr-linked episode
+        (completed / "tv" / "torrent.mkv").write_bytes(b"e" * 100)
+        os.link(completed / "tv" / "torrent.mkv", arr / "tv" / "Show" / "ep.mkv")
+        # Uncategorized zip
+        with zipfile.ZipFile(completed / "pack.zip", "w") as zf:
+            zf.writestr("readme.txt", "x" * 50)
+        return completed, arr
+
+    @patch("upload.subprocess")
+    def test_plans_without_side_effects(self, mock_subprocess, tmp_path, state):
+        completed, arr = self._tree(tmp_path)
+        pack_size = (completed / "pack.zip").stat().st_size
+
+        summary = plan_run(
+            str(completed), str(arr), ["movies", "tv"], "b2:bucket", "/x", state
+        )
+
+        assert summary == {
+            "links": 1,
+            "on_b2": 0,
+            "move": 0,
+            "copy": 0,
+            "skip": 0,
+            "stream": 1,
+            "extract": 0,
+            "upload": 2,
+            "possible_copy": 0,
+            "propagate": 2,
+            "bytes": 400 + 100 + pack_size + 50,
+            "seconds": None,
+        }
+        # Nothing linked, started or recorded
+        assert not (arr / "movies" / "movie.mkv").exists()
+        mock_subprocess.run.assert_not_called()
+        mock_subprocess.Popen.assert_not_called()
+        assert not state.is_uploaded(completed / "tv" / "torrent.mkv")
+
+    @patch("upload.subprocess")
+    def test_leaves_state_and_markers_alone(self, mock_subprocess, tmp_path):
+        completed, arr = self._tree(tmp_path)
+        db_path = tmp_path / "state.db"
+        # Legacy marker, not imported yet
+        (completed / "old.mkv").write_bytes(b"o")
+        marker = completed / "old.mkv.uploaded"
+        marker.touch()
+        state = open_state(db_path, completed, arr, ["movies", "tv"], False)
+        # Show/ is complete, so a real scan would snapshot it
+        state.mark(arr / "tv" / "Show" / "ep.mkv", "tv/Show/ep.mkv")
+
+        def dump():
+            with sqlite3.connect(db_path) as db:
+                tables = [
+                    name
+                    for (name,) in db.execute(
+                        "SELECT name FROM sqlite_master WHERE type = 'table'"
+                    )
+                ]
+                return {
+                    table: sorted(db.execute(f"SELECT * FROM {table}"))
+                    for table in tables
+                }
+
+        before = dump()
+        plan_run(str(completed), str(arr), ["movies", "tv"], "b2:bucket", "/x", state)
+        state.close()
+        assert dump() == before
+        assert marker.exists()
+
+    @patch("upload.subprocess")
+    def test_listing_and_estimate(self, mock_subprocess, tmp_path, state):
+        completed, arr = self._tree(tmp_path)
+        ep = arr / "tv" / "Show" / "ep.mkv"
+        st = ep.stat()
+        # Cached listing, however old, says the episode is already there
+        state.replace_manifest({"tv/Show/ep.mkv": (st.st_size, st.st_mtime_ns, None)})
+        state.set_meta("manifest_fetched_at", 0)
+        state.set_meta("upload_throughput", 100)
+        (completed / "pack.zip").unlink()
+
+        summary = plan_run(
+            str(completed), str(arr), ["movies", "tv"], "b2:bucket", "/x", state
+        )
+
+        assert summary["on_b2"] == 1
+        assert summary["upload"] == 1
+        assert summary["bytes"] == 400
+        assert summary["seconds"] == 4
+        mock_subprocess.run.assert_not_called()
+
+    @patch("upload.SERVER_COPY_MIN", 100)
+    def test_possible_copy_not_hashed(self, tmp_path, state):
+        completed, arr = self._tree(tmp_path)
+        # Same size as the manual movie, under another name
+        state.replace_manifest({"downloads/old.mkv": (400, 0, "0" * 40)})
+
+        with patch("state.hashlib.sha1", side_effect=AssertionError):
+            summary = plan_run(
+                str(completed), str(arr), ["movies", "tv"], "b2:bucket", "/x", state
+            )
+
+        assert summary["possible_copy"] == 1
+        assert summary["copy"] == 0
+        # Nothing cached for the daemon to pick up
+        assert state.db.execute("SELECT COUNT(*) FROM hashes").fetchone()[0] == 0
+        assert state.item_files == {}
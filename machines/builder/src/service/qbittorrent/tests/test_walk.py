@@ -0,0 +1,98 @@
+"""Tests for walk.py — shared directory tree snapshot."""
+
+import os
+from unittest.mock import patch
+
+from walk import Tree
+
+
+def _layout(tmp_path):
+    season = tmp_path / "tv" / "Show" / "Season 1"
+    season.mkdir(parents=True)
+    (season / "ep1.mkv").write_bytes(b"one")
+    (season / "ep2.mkv").write_bytes(b"two")
+    (tmp_path / "tv" / "empty").mkdir()
+    return season
+
+
+class TestTree:
+    def test_lists_once(self, tmp_path):
+        season = _layout(tmp_path)
+        tree = Tree([tmp_path / "tv"])
+        with patch("walk.os.scandir", side_effect=AssertionError):
+            assert tree.files(tmp_path / "tv") == [
+                str(season / "ep1.mkv"),
+                str(season / "ep2.mkv"),
+            ]
+            assert tree.listdir(tmp_path / "tv") == [
+                str(tmp_path / "tv" / "Show"),
+                str(tmp_path / "tv" / "empty"),
+            ]
+            assert tree.is_dir(season)
+            assert tree.is_file(season / "ep1.mkv")
+
+    def test_top_level_only(self, tmp_path):
+        _layout(tmp_path)
+        tree = Tree([tmp_path / "tv"], recursive=False)
+        assert tree.listdir(tmp_path / "tv") == [
+            str(tmp_path / "tv" / "Show"),
+            str(tmp_path / "tv" / "empty"),
+        ]
+        assert tree.listdir(tmp_path / "tv" / "Show") is None
+        assert tree.stat(tmp_path / "tv" / "Show") is not None
+
+    def test_stat_cached(self, tmp_path):
+        season = _layout(tmp_path)
+        tree = Tree([tmp_path])
+        assert tree.stat(season / "ep1.mkv").st_size == 3
+        with patch("os.stat", side_effect=AssertionError):
+            assert tree.stat(season / "ep1.mkv").st_size == 3
+        assert tree.stat(season / "missing.mkv") is None
+
+    def test_missing_root(self, tmp_path):
+        tree = Tree([tmp_path / "missing"])
+        assert tree.listdir(tmp_path / "missing") is None
+        assert tree.files(tmp_path / "missing") == []
+        assert tree.stat(tmp_path / "missing") is None
+
+    def test_file_root(self, tmp_path):
+        f = tmp_path / "movie.mkv"
+        f.write_bytes(b"data")
+        tree = Tree([f])
+        assert tree.files(f) == [str(f)]
+
+    def test_exists_outside_roots(self, tmp_path):
+        _layout(tmp_path)
+        (tmp_path / "other").write_bytes(b"x")
+        tree = Tree([tmp_path / "tv"])
+        assert tree.exists(tmp_path / "other")
+        assert not tree.exists(tmp_path / "tv" / "gone.mkv")
+
+    def test_add_and_remove(self, tmp_path):
+        season = _layout(tmp_path)
+        tree = Tree([tmp_path / "tv"])
+        new = tmp_path / "tv" / "Movie" / "movie.mkv"
+        new.parent.mkdir()
+        new.write_bytes(b"m")
+        tree.add(new)
+        assert tree.exists(new)
+        assert str(new.parent) in tree.listdir(tmp_path / "tv")
+        assert tree.files(new.parent) == [str(new)]
+
+        os.unlink(season / "ep1.mkv")
+        tree.remove(season / "ep1.mkv")
+        tree.remove(tmp_path / "tv" / "Show")
+        assert not tree.exists(season / "ep2.mkv")
+        assert tree.listdir(tmp_path / "tv") == [
+            str(new.parent),
+            str(tmp_path / "tv" / "empty"),
+        ]
+
+    def test_dirs(self, tmp_path):
+        season = _layout(tmp_path)
+        tree = Tree([tmp_path / "tv"])
+        assert sorted(tree.dirs(tmp_path / "tv")) == [
+            str(season.parent),
+            str(season),
+            str(tmp_path / "tv" / "empty"),
+        ]
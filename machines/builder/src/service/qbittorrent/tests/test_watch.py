@@ -0,0 +1,102 @@
+"""Tests for watch.py — inotify watcher and debouncer."""
+
+import os
+import select
+import threading
+
+from watch import Debouncer, EventQueue, Inotify
+
+
+class TestInotify:
+    def test_reports_new_file(self, tmp_path):
+        watcher = Inotify()
+        watcher.add_tree(tmp_path)
+        (tmp_path / "ep.mkv").write_bytes(b"data")
+
+        paths, overflow = watcher.read(1)
+        assert str(tmp_path / "ep.mkv") in paths
+        assert not overflow
+        watcher.close()
+
+    def test_reports_hard_link(self, tmp_path):
+        src = tmp_path / "completed"
+        dst = tmp_path / "arr"
+        src.mkdir()
+        dst.mkdir()
+        (src / "ep.mkv").write_bytes(b"data")
+        watcher = Inotify()
+        watcher.add_tree(dst)
+        os.link(src / "ep.mkv", dst / "Show - S01E01.mkv")
+
+        paths, _ = watcher.read(1)
+        assert paths == [str(dst / "Show - S01E01.mkv")]
+        watcher.close()
+
+    def test_watches_new_subdirectories(self, tmp_path):
+        watcher = Inotify()
+        watcher.add_tree(tmp_path)
+        season = tmp_path / "Show" / "Season 1"
+        season.mkdir(parents=True)
+        (season / "ep.mkv").write_bytes(b"data")
+
+        paths, _ = watcher.read(1)
+        # Files created before the new directories were watched are listed
+        assert str(season / "ep.mkv") in paths
+
+        (season / "ep2.mkv").write_bytes(b"data")
+        paths, _ = watcher.read(1)
+        assert str(season / "ep2.mkv") in paths
+        watcher.close()
+
+    def test_timeout_without_events(self, tmp_path):
+        watcher = Inotify()
+        watcher.add_tree(tmp_path)
+        assert watcher.read(0) == ([], False)
+        watcher.close()
+
+    def test_missing_directory(self, tmp_path):
+        watcher = Inotify()
+        assert watcher.add_tree(tmp_path / "missing") == []
+        assert watcher.watches == {}
+        watcher.close()
+
+
+class TestDebouncer:
+    def test_waits_for_quiet(self):
+        debouncer = Debouncer(30)
+        debouncer.add("/a", 0)
+        debouncer.add("/a", 20)
+        assert debouncer.next_due() == 50
+        assert debouncer.ready(49) == []
+        assert debouncer.ready(50) == ["/a"]
+        assert debouncer.next_due() is None
+
+    def test_paths_released_independently(self):
+        debouncer = Debouncer(30)
+        debouncer.add("/b", 0)
+        debouncer.add("/a", 10)
+        assert debouncer.ready(35) == ["/b"]
+        assert debouncer.ready(40) == ["/a"]
+
+
+class TestEventQueue:
+    def test_readable_while_queued(self):
+        queue = EventQueue()
+        assert select.select([queue], [], [], 0)[0] == []
+        queue.put("a")
+        queue.put("b")
+        assert select.select([queue], [], [], 0)[0] == [queue]
+        assert queue.get_all() == ["a", "b"]
+        assert select.select([queue], [], [], 0)[0] == []
+        assert queue.get_all() == []
+        queue.close()
+
+    def test_put_from_threads(self):
+        queue = EventQueue()
+        threads = [threading.Thread(target=lambda i=i: queue.put(i)) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sorted(queue.get_all()) == list(range(10))
+        queue.close()
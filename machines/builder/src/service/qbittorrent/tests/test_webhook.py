@@ -0,0 +1,135 @@
+"""Tests for webhook.py — Sonarr/Radarr webhook receiver."""
+
+import json
+import select
+import threading
+import urllib.error
+import urllib.request
+
+from webhook import WebhookServer, parse_event
+
+SONARR_UPGRADE = {
+    "eventType": "Download",
+    "isUpgrade": True,
+    "series": {"path": "/media/arr/tv/Show"},
+    "episodeFile": {
+        "relativePath": "Season 1/Show - S01E01 - Bluray-1080p.mkv",
+        "path": "/media/arr/tv/Show/Season 1/Show - S01E01 - Bluray-1080p.mkv",
+    },
+    "deletedFiles": [
+        {
+            "relativePath": "Season 1/Show - S01E01 - HDTV-720p.mkv",
+            "path": "/media/arr/tv/Show/Season 1/Show - S01E01 - HDTV-720p.mkv",
+        }
+    ],
+}
+
+
+class TestParseEvent:
+    def test_sonarr_upgrade(self):
+        assert parse_event(SONARR_UPGRADE) == (
+            ["/media/arr/tv/Show/Season 1/Show - S01E01 - Bluray-1080p.mkv"],
+            ["/media/arr/tv/Show/Season 1/Show - S01E01 - HDTV-720p.mkv"],
+        )
+
+    def test_radarr_import_relative_path(self):
+        payload = {
+            "eventType": "Download",
+            "movie": {"folderPath": "/media/arr/movies/Film (2020)"},
+            "movieFile": {"relativePath": "Film (2020).mkv"},
+        }
+        assert parse_event(payload) == (
+            ["/media/arr/movies/Film (2020)/Film (2020).mkv"],
+            [],
+        )
+
+    def test_season_pack(self):
+        payload = {
+            "eventType": "Download",
+            "series": {"path": "/media/arr/tv/Show"},
+            "episodeFiles": [
+                {"relativePath": "S1/e1.mkv"},
+                {"relativePath": "S1/e2.mkv"},
+            ],
+        }
+        assert parse_event(payload)[0] == [
+            "/media/arr/tv/Show/S1/e1.mkv",
+            "/media/arr/tv/Show/S1/e2.mkv",
+        ]
+
+    def test_rename(self):
+        payload = {
+            "eventType": "Rename",
+            "series": {"path": "/media/arr/tv/Show"},
+            "renamedEpisodeFiles": [
+                {
+                    "previousPath": "/media/arr/tv/Show/old.mkv",
+                    "path": "/media/arr/tv/Show/new.mkv",
+                }
+            ],
+        }
+        assert parse_event(payload) == (["/media/arr/tv/Show/new.mkv"], [])
+
+    def test_other_events(self):
+        assert parse_event({"eventType": "Test"}) == ([], [])
+        assert parse_event({"eventType": "Grab", "series": {}}) == ([], [])
+
+
+class TestWebhookServer:
+    def _post_only(self, server, body):
+        """POST body to the server, returning the response status."""
+        port = server.server_address[1]
+        req = urllib.request.Request(
+            f"http://127.0.0.1:{port}/", data=body, method="POST"
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=5) as resp:
+                status = resp.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        return status
+
+    def _post(self, server, body):
+        status = self._post_only(server, body)
+        # Answered after the event was queued
+        return status, server.receive()
+
+    def test_queues_import(self):
+        server = WebhookServer("127.0.0.1:0")
+        status, events = self._post(server, json.dumps(SONARR_UPGRADE).encode())
+        assert status == 200
+        assert events == [("Download", *parse_event(SONARR_UPGRADE))]
+        server.close()
+
+    def test_test_event(self):
+        server = WebhookServer("127.0.0.1:0")
+        status, events = self._post(server, b'{"eventType": "Test"}')
+        assert (status, events) == (200, [])
+        server.close()
+
+    def test_bad_request(self):
+        server = WebhookServer("127.0.0.1:0")
+        status, events = self._post(server, b"not json")
+        assert (status, events) == (400, [])
+        server.close()
+
+    def test_serves_while_daemon_is_busy(self):
+        server = WebhookServer("127.0.0.1:0")
+        body = json.dumps(SONARR_UPGRADE).encode()
+        # Nothing reads the events while these are posted at once
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(self._post_only(server, body))
+            )
+            for _ in range(3)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == [200] * 3
+        assert select.select([server], [], [], 0)[0] == [server]
+        assert len(server.receive()) == 3
+        assert select.select([server], [], [], 0)[0] == []
+        server.close()
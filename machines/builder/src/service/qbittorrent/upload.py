@@ -5,25 +5,231 @@
    Sonarr/Radarr haven't touched them).
 2. Upload: scans import directories (/media/arr/tv/, /media/arr/movies/) for
    files to upload. Falls back to completed/ for uncategorized downloads.
-3. Propagate: copies .uploaded markers from import dirs back to completed/
-   items (by inode match), so the cleanup timer can eventually remove them.
-
-Triggered by qbt-upload-b2.timer every 2 minutes.
+   Plain files are collected into a batch and uploaded with one rclone call
+   per destination root (tv/, movies/, downloads/); items with archives are
+   uploaded individually, with zip contents streamed straight to B2 and
+   other archives (rar) extracted first. Files of 1 GB or more go through
+   the B2 API as resumable large files (see b2.py). Items are ordered by
+   UPLOAD_POLICY with categories taking turns (see schedule.py). Batches
+   and archive items run on a pool of UPLOAD_WORKERS threads sharing at
+   most MAX_TRANSFERS concurrent transfers (rclone's and large-file parts).
+3. Propagate: marks completed/ items as uploaded once all their files are
+   uploaded from the import dirs (by inode, size and mtime), so the cleanup timer can
+   eventually remove them.
+
+Upload status lives in the state database (see state.py), not in marker
+files next to each item.
+
+Runs as a daemon (`upload.py --daemon`, see run_daemon): inotify reports
+new and changed paths under the import dirs and completed/, which are
+uploaded once they've been quiet for UPLOAD_DEBOUNCE seconds. A full scan
+of every step runs at startup and every RESCAN_INTERVAL seconds as a
+safety net. Torrents qBittorrent reports finished through hook.py on
+HOOK_SOCKET are linked and uploaded at once (see run_completed), and so
+are the files Sonarr/Radarr report importing to the webhook listener on
+WEBHOOK_ADDR (see run_webhook). Without --daemon, one full scan runs and
+the script exits.
+With --plan, it only prints what that scan would do (see plan_run).
 
 Environment variables:
   COMPLETED_DIR  - base directory for completed downloads
-  EXTRACTED_DIR  - temporary directory for archive extraction
+  EXTRACTED_DIR  - temporary directory for archives that can't be streamed
   IMPORT_BASE    - base path for import directories (e.g. /media/arr)
   B2_REMOTE      - rclone remote with bucket (e.g. b2:entertainment-netmount)
   CATEGORIES     - comma-separated name:subdir pairs (e.g. tv-sonarr:tv,radarr:movies)
-  RCLONE_CONFIG_B2_*  - rclone B2 credentials (via EnvironmentFile)
+  MANUAL_CATEGORIES - (optional) comma-separated categories nobody imports
+                   (e.g. tv,movie); completion hooks link only these
+  STATE_DB       - path to the upload state database (SQLite)
+  MANIFEST_MAX_AGE - seconds before the cached B2 listing is re-fetched
+  UPLOAD_WORKERS - number of upload jobs (batches/archive items) run at once
+  MAX_TRANSFERS  - total transfers (rclone --transfers and large-file
+                   parts) across all running jobs
+  UPLOAD_POLICY  - upload order: oldest, smallest or pressure
+  UPLOAD_MIN_FREE - percent free disk below which the pressure order is used
+  MIN_SEEDING_HOURS - hours cleanup lets items seed; the pressure order
+                   puts items seeded that long first
+  ARCHIVE_POLICY - (optional) per B2 root: upload archive releases "both"
+                   (contents and volumes, default) or "extracted" only,
+                   e.g. tv:extracted,movies:extracted
+  RCLONE_RC_URL  - (optional) rclone rcd to send copies and listings to
+  UPLOAD_BWLIMIT - upload bandwidth timetable, rclone --bwlimit syntax
+  UPLINK_RATE    - uplink capacity shared with seeding ("off" to ignore it)
+  UPLOAD_MIN_RATE - least upload bandwidth left over while seeding is busy
+  MOUNT_BUSY_RATE - upload cap while the B2 mount is transferring ("off")
+  QBT_API_URL    - (optional) qBittorrent API, for its current upload rate
+  MOUNT_RC_URL   - (optional) rclone rc of the B2 mount, for its transfers
+                   and to refresh its listings after uploads
+  UPLOAD_DEBOUNCE - (daemon) seconds a changed path must be quiet before upload
+  RESCAN_INTERVAL - (daemon) seconds between full safety-net scans
+  HOOK_SOCKET    - (daemon, optional) Unix socket for qBittorrent's
+                   completion hook (hook.py)
+  WEBHOOK_ADDR   - (daemon, optional) host:port to receive Sonarr/Radarr
+                   webhooks on (webhook.py)
+  METRICS_FILE   - (optional) Prometheus textfile for node_exporter
+  PROFILE_FILE   - (optional) write a cProfile dump of the run here (phases.py)
+  RCLONE_CONFIG_B2_*  - rclone B2 credentials (via EnvironmentFile), also
+                   used for resumable large-file uploads (see b2.py)
 """
 
+import argparse
+import itertools
+import json
+import math
 import os
+import queue
+import re
+import select
 import shutil
+import sqlite3
+import stat
 import subprocess
 import sys
-from pathlib import Path
+import tempfile
+import threading
+import time
+import traceback
+import zipfile
+from concurrent.futures import Future
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from pathlib import Path, PurePosixPath
+
+from b2 import B2, LARGE_FILE_MIN, B2Error, cancel_abandoned, upload_large_file
+from bwlimit import BandwidthController, parse_rate, parse_timetable
+from hook import HookListener
+from metrics import Metrics
+from phases import Phases, profiled
+from rc import RcError, rc_call, rc_job
+from schedule import Scheduler, item_info
+from state import file_key, open_state
+from walk import Tree
+from watch import Debouncer, Inotify
+from webhook import WebhookServer
+
+# rclone remote control daemon for copies and listings; without it every
+# rclone operation is a separate process (see rc.py)
+RC_URL = os.environ.get("RCLONE_RC_URL")
+
+# rc of the B2 FUSE mount, told to re-read the directories uploads wrote
+# to (see refresh_mount) and watched for playback (bwlimit.py)
+MOUNT_RC_URL = os.environ.get("MOUNT_RC_URL")
+
+# Categories the upload script links itself; Sonarr/Radarr link the rest
+# when they import, which is after the torrent finishes (see run_completed)
+MANUAL_CATEGORIES = {
+    c.strip() for c in os.environ.get("MANUAL_CATEGORIES", "").split(",") if c.strip()
+}
+
+# Most items per batch job, so one category's backlog is split into jobs
+# that take turns with the others instead of one long rclone call
+BATCH_ITEMS = 20
+
+# Bytes of a zip member piped to rclone rcat at a time (see stream_archive)
+STREAM_CHUNK = 1024 * 1024
+
+# Files at least this big are copied server-side when identical content
+# (same size and SHA1) is already in the bucket under another name
+SERVER_COPY_MIN = 10 * 1000 * 1000
+
+# New-style multi-volume rar sets: name.part01.rar, name.part02.rar, ...
+RAR_PART = re.compile(r"(?P<stem>.+)\.part(?P<number>\d+)\.rar", re.IGNORECASE)
+
+# Upload rounds smaller than this don't update the throughput --plan uses
+THROUGHPUT_MIN_BYTES = 100 * 1000 * 1000
+
+# Seconds between checks whether a running full pass has ended, once the
+# next one is due (see run_daemon)
+RESCAN_POLL = 5
+
+# Live upload bandwidth limit (see bwlimit.py), set up by main
+BANDWIDTH = None
+
+# What to upload of archive releases, per B2 root (see archive_policy),
+# set up by main from ARCHIVE_POLICY
+ARCHIVE_POLICY = {}
+ARCHIVE_POLICIES = ("both", "extracted")
+
+# Prometheus textfile (see metrics.py); nothing is written without a path
+METRICS = Metrics(
+    os.environ.get("METRICS_FILE"),
+    {
+        "qbt_upload_items_total": (
+            "counter",
+            "Items uploaded to B2, by category (B2 root).",
+            None,
+        ),
+        "qbt_upload_bytes_total": (
+            "counter",
+            "Bytes of items uploaded to B2, by category.",
+            None,
+        ),
+        "qbt_upload_failures_total": (
+            "counter",
+            "Items whose upload failed, by category.",
+            None,
+        ),
+        "qbt_upload_check_hits_total": (
+            "counter",
+            "Items found already on B2 instead of uploaded, by how.",
+            None,
+        ),
+        "qbt_upload_copied_bytes_total": (
+            "counter",
+            "Bytes copied server-side from identical objects instead of"
+            " uploaded, by category.",
+            None,
+        ),
+        "qbt_upload_moved_bytes_total": (
+            "counter",
+            "Bytes of renamed files moved server-side instead of uploaded,"
+            " by category.",
+            None,
+        ),
+        "qbt_upload_retired_objects_total": (
+            "counter",
+            "Objects deleted from B2 because Sonarr/Radarr replaced the file,"
+            " by category.",
+            None,
+        ),
+        "qbt_upload_extract_seconds": (
+            "histogram",
+            "Time spent extracting one item's archives to disk.",
+            (1, 5, 15, 60, 300, 900, 3600),
+        ),
+        "qbt_upload_job_seconds": (
+            "histogram",
+            "Duration of one upload job (batch or archive item), by category.",
+            (10, 60, 300, 900, 3600, 4 * 3600, 12 * 3600),
+        ),
+        "qbt_upload_throughput_bytes_per_second": (
+            "histogram",
+            "Average throughput of one upload job, by category.",
+            tuple(n * 1024**2 for n in (0.25, 0.5, 1, 2, 5, 10, 20, 50, 100)),
+        ),
+        "qbt_upload_pending_items": (
+            "gauge",
+            "Items waiting to be uploaded in the current round.",
+            None,
+        ),
+        "qbt_upload_pending_bytes": (
+            "gauge",
+            "Bytes of items waiting to be uploaded in the current round.",
+            None,
+        ),
+        "qbt_upload_last_success_timestamp_seconds": (
+            "gauge",
+            "Unix time of the last run whose uploads all succeeded.",
+            None,
+        ),
+    },
+)
+
+# Time, entries and bytes per phase of the current run, printed by finish_run
+PHASES = Phases()
+
+# remote:bucket -> shared B2 API client for resumable large files (b2.py)
+B2_CLIENTS = {}
+B2_CLIENTS_LOCK = threading.Lock()
 
 
 def parse_categories(env_value):
@@ -42,45 +248,868 @@ def parse_categories(env_value):
     return result
 
 
-def rclone_copy(src, dest):
+def parse_archive_policy(env_value):
+    """Parse ARCHIVE_POLICY env var into a dict.
+
+    Format: "tv:extracted,movies:extracted,downloads:both"
+    Returns: {"tv": "extracted", "movies": "extracted", "downloads": "both"}
+    Raises ValueError for a policy not in ARCHIVE_POLICIES.
+    """
+    result = parse_categories(env_value)
+    for root, policy in result.items():
+        if policy not in ARCHIVE_POLICIES:
+            raise ValueError(
+                f"Unknown archive policy {policy!r} for {root}"
+                f" (expected one of {ARCHIVE_POLICIES})"
+            )
+    return result
+
+
+def archive_policy(b2_base):
+    """Return what to upload of archive releases under b2_base.
+
+    both      - the unpacked contents and the original volumes (default)
+    extracted - only the unpacked contents and files outside the archive
+                sets; the volumes stay on disk for seeding, and are
+                recorded as uploaded so cleanup and marker propagation
+                treat them like uploaded files
+    """
+    return ARCHIVE_POLICY.get(b2_base.partition("/")[0], "both")
+
+
+class TransferBudget:
+    """Caps the total transfers across concurrent upload jobs.
+
+    A transfer is one of rclone's --transfers or one large-file part being
+    read and sent (see b2.upload_large_file). Every rclone call and every
+    part takes its transfers when it starts and gives them back when it
+    ends, so no more than `total` run at once, whatever the jobs are doing.
+
+    A call asks for its share (see share): the total split between the
+    jobs running now, so a job running alone also gets what idle workers
+    would use. One transfer stays free for each idle worker, so a job
+    that starts next never waits for a long rclone call to end.
+    """
+
+    def __init__(self, total, workers=1):
+        self.total = total
+        self.workers = workers
+        self.available = total
+        # Jobs between job() and its end
+        self.running = 0
+        self.cond = threading.Condition()
+
+    def _reserved(self):
+        # One transfer per idle worker; a caller outside job() counts as one
+        idle = self.workers - max(1, self.running)
+        return max(0, min(idle, self.total - 1))
+
+    @contextmanager
+    def job(self):
+        """Count the with-block as a running job (see share)."""
+        with self.cond:
+            self.running += 1
+            self.cond.notify_all()
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.running -= 1
+                self.cond.notify_all()
+
+    def share(self):
+        """Return how many transfers one call of a running job should ask for."""
+        with self.cond:
+            return max(1, (self.total - self._reserved()) // max(1, self.running))
+
+    @contextmanager
+    def take(self, n):
+        """Hold up to n transfers for the with-block, yielding how many.
+
+        Waits until one is free (besides those kept for idle workers),
+        then takes as many of n as are.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.available > self._reserved())
+            n = max(1, min(n, self.available - self._reserved()))
+            self.available -= n
+        try:
+            yield n
+        finally:
+            with self.cond:
+                self.available += n
+                self.cond.notify_all()
+
+
+class JobPool:
+    """Upload workers shared by every round of the daemon.
+
+    Jobs start in priority order (lowest first), then in the order they
+    were submitted, so the jobs of a round started by an event (inotify,
+    hook, webhook) go ahead of those a full scan queued earlier. Rounds
+    claim their items first (see claim), so two rounds running at once
+    never upload the same item.
+    """
+
+    def __init__(self, workers):
+        self.queue = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        # Items claimed by a round and not uploaded yet
+        self.claimed = set()
+        self.threads = [
+            threading.Thread(target=self._work, name=f"upload-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _work(self):
+        while True:
+            _, _, task = self.queue.get()
+            if task is None:
+                return
+            future, func, args = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, priority, func, *args):
+        """Queue func(*args), returning a Future for its result."""
+        future = Future()
+        self.queue.put((priority, next(self.order), (future, func, args)))
+        return future
+
+    def claim(self, items):
+        """Claim items for the calling round, returning those nobody else has."""
+        with self.lock:
+            free = [item for item in items if item not in self.claimed]
+            self.claimed.update(free)
+        return free
+
+    def release(self, items):
+        """Give claimed items back, once uploaded (or failed)."""
+        with self.lock:
+            self.claimed.difference_update(items)
+
+    def shutdown(self):
+        """Stop the workers once every queued job has run."""
+        for _ in self.threads:
+            self.queue.put((math.inf, next(self.order), None))
+        for thread in self.threads:
+            thread.join()
+
+
+def bandwidth_share(kind):
+    """Count the with-block as one upload of BANDWIDTH's budget.
+
+    See BandwidthController.consumer; yields the --bwlimit of a "process"
+    upload, None for the other kinds and without a controller.
+    """
+    if BANDWIDTH is None:
+        return nullcontext()
+    return BANDWIDTH.consumer(kind)
+
+
+def bwlimit_args(limit):
+    """rclone arguments for a process's part of the limit (see bandwidth_share)."""
+    if limit is None:
+        return []
+    return ["--bwlimit", limit]
+
+
+@PHASES.timed("upload")
+def rclone_copy(src, dest, transfers=4):
     """Upload src to dest via rclone copy.
 
+    Goes through the rc daemon when RC_URL is set (see rc_copy).
     Returns True on success, False on failure.
     """
-    result = subprocess.run(
-        [
-            "rclone",
-            "copy",
-            str(src),
-            dest,
-            "--transfers",
-            "4",
-            "--checksum",
-            "--stats",
-            "30s",
-            "--stats-log-level",
-            "NOTICE",
-        ],
-    )
+    if RC_URL:
+        with bandwidth_share("rcd"):
+            return rc_copy(src, dest, transfers)
+    with bandwidth_share("process") as limit:
+        result = subprocess.run(
+            [
+                "rclone",
+                "copy",
+                str(src),
+                dest,
+                "--transfers",
+                str(transfers),
+                "--checksum",
+                "--stats",
+                "30s",
+                "--stats-log-level",
+                "NOTICE",
+            ]
+            + bwlimit_args(limit),
+        )
     if result.returncode != 0:
         print(f"Upload failed: {src}")
         return False
     return True
 
 
-def rclone_check(src, dest):
-    """Check if src already exists at dest with correct checksum.
+@PHASES.timed("upload")
+def rclone_copy_batch(src_root, dest, rel_paths, transfers=4):
+    """Upload many files under src_root to dest in a single rclone call.
 
-    Uses rclone check --one-way so only src→dest is verified.
-    Returns True if the file exists with matching checksum.
+    rel_paths are relative to src_root and keep their relative location
+    under dest. rclone reads the list via --files-from-raw and transfers the
+    files with its own --transfers parallelism, so a batch pays for one
+    process startup, config load and B2 authorization.
+
+    Returns the set of rel_paths that failed to upload. Per-file failures
+    come from rclone's JSON log; if rclone fails without naming any file
+    (e.g. B2 auth error), every file counts as failed.
+
+    Goes through the rc daemon when RC_URL is set (see rc_copy_batch).
     """
-    result = subprocess.run(
-        ["rclone", "check", str(src), dest, "--checksum", "--one-way"],
-        capture_output=True,
-    )
-    return result.returncode == 0
+    if RC_URL:
+        with bandwidth_share("rcd"):
+            return rc_copy_batch(src_root, dest, rel_paths, transfers)
+    with bandwidth_share("process") as limit, tempfile.NamedTemporaryFile(
+        "w", prefix="qbt-upload-", suffix=".txt"
+    ) as f:
+        f.write("".join(f"{rel}\n" for rel in rel_paths))
+        f.flush()
+        proc = subprocess.Popen(
+            [
+                "rclone",
+                "copy",
+                str(src_root),
+                dest,
+                "--files-from-raw",
+                f.name,
+                "--transfers",
+                str(transfers),
+                "--checksum",
+                "--stats",
+                "30s",
+                "--stats-log-level",
+                "NOTICE",
+                "--use-json-log",
+                "--log-level",
+                "INFO",
+            ]
+            + bwlimit_args(limit),
+            stderr=subprocess.PIPE,
+            text=True,
+        )
+        failed = set()
+        for line in proc.stderr:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                print(line.rstrip())
+                continue
+            obj = entry.get("object")
+            print(f"{obj}: {entry.get('msg')}" if obj else entry.get("msg"))
+            if entry.get("level") == "error" and obj:
+                failed.add(obj)
+        returncode = proc.wait()
+
+    if returncode == 0:
+        return set()
+    return failed or set(rel_paths)
+
+
+def b2_client(dest):
+    """Return (client, bucket-relative prefix) for an rclone dest, or None.
+
+    Large files go through the native B2 API only if the remote's rclone
+    credentials are in the environment (RCLONE_CONFIG_<REMOTE>_ACCOUNT and
+    _KEY); otherwise rclone uploads them like any other file.
+    """
+    remote, _, path = dest.partition(":")
+    bucket, _, prefix = path.partition("/")
+    account = os.environ.get(f"RCLONE_CONFIG_{remote.upper()}_ACCOUNT")
+    key = os.environ.get(f"RCLONE_CONFIG_{remote.upper()}_KEY")
+    if not account or not key or not bucket:
+        return None
+    with B2_CLIENTS_LOCK:
+        client = B2_CLIENTS.get((remote, bucket))
+        if client is None:
+            client = B2_CLIENTS[(remote, bucket)] = B2(account, key, bucket)
+    return client, prefix
+
+
+@PHASES.timed("upload")
+def upload_large_files(src_root, dest, rel_paths, state, budget=None):
+    """Upload the large files among rel_paths as resumable B2 large files.
+
+    Each file's parts are sent on up to the job's share of the budget's
+    transfers, every part holding one while it is read and sent. Files
+    already on B2 are skipped: found in the cached listing, or without
+    one, by checking the object with rclone_check.
+
+    Returns (failed, rest): the large files that failed, and the rel_paths
+    left for rclone (all of them if the B2 API isn't available).
+    """
+    target = b2_client(dest)
+    if target is None:
+        return set(), list(rel_paths)
+    client, prefix = target
+    if budget is None:
+        budget = TransferBudget(4)
+    failed = set()
+    rest = []
+    for rel in rel_paths:
+        path = Path(src_root) / rel
+        try:
+            large = path.stat().st_size >= LARGE_FILE_MIN
+        except OSError:
+            large = False
+        if not large:
+            rest.append(rel)
+            continue
+        # Copied server-side (see copy_within_bucket), or uploaded by a run
+        # that ended before recording it
+        if state.manifest is not None:
+            on_b2 = manifest_has(state.manifest, path, f"{prefix}{rel}", state)
+        else:
+            on_b2 = rclone_check(
+                path, f"{dest.rstrip('/')}/{rel}".rsplit("/", 1)[0], state
+            )
+        if on_b2:
+            continue
+        print(f"Uploading large file: {rel}")
+        throttle = BANDWIDTH.throttle if BANDWIDTH is not None else None
+        with bandwidth_share("throttle"):
+            sent = upload_large_file(
+                client,
+                state,
+                path,
+                f"{prefix}{rel}",
+                budget.share(),
+                throttle,
+                budget=budget,
+            )
+        if not sent:
+            failed.add(rel)
+    return failed, rest
+
+
+def upload_files(src_root, dest, rel_paths, state, budget):
+    """Upload rel_paths under src_root to dest, large files resumably.
+
+    Large files go through upload_large_files, the rest in one
+    rclone_copy_batch holding the job's share of budget. Returns the set
+    of rel_paths that failed.
+    """
+    failed, rest = upload_large_files(src_root, dest, rel_paths, state, budget)
+    if rest:
+        with budget.take(budget.share()) as transfers:
+            failed |= rclone_copy_batch(src_root, dest, rest, transfers)
+    return failed
+
+
+def upload_tree(src, dest, state, budget):
+    """Upload a file or directory like rclone_copy, large files resumably.
+
+    dest follows rclone copy: the parent directory for a file, the target
+    directory for a directory. Without large files (or the B2 API, see
+    b2_client) this is one rclone_copy. Returns True on success.
+    """
+    src = Path(src)
+    if src.is_dir():
+        root = src
+        rels = [
+            f.relative_to(src).as_posix() for f in sorted(src.rglob("*")) if f.is_file()
+        ]
+    else:
+        root, rels = src.parent, [src.name]
+    dest_dir = f"{dest.rstrip('/')}/"
+    failed, rest = upload_large_files(root, dest_dir, rels, state, budget)
+    if len(rest) == len(rels):
+        with budget.take(budget.share()) as transfers:
+            return rclone_copy(src, dest, transfers)
+    if rest:
+        with budget.take(budget.share()) as transfers:
+            failed |= rclone_copy_batch(root, dest_dir, rest, transfers)
+    return not failed
+
+
+def mount_dirs(dirs):
+    """Expand bucket-relative directories to every listing that shows them.
+
+    Each directory comes with its ancestors (but not the bucket root),
+    parents before children: a new "tv/Show/Season 1/" only appears in
+    the mount once "tv/" lists "Show" and "tv/Show" lists "Season 1".
+    """
+    expanded = set()
+    for d in dirs:
+        parts = PurePosixPath(d).parts
+        for i in range(1, len(parts) + 1):
+            expanded.add("/".join(parts[:i]))
+    return sorted(expanded, key=lambda d: (d.count("/"), d))
+
+
+def item_dirs(item, dest, archives=()):
+    """Return the bucket-relative directories uploading item to dest writes.
+
+    A directory is its own listing; a file goes into dest's parent, and
+    the contents of a single-file archive into dest next to it.
+    """
+    if Path(item).is_dir():
+        return [dest]
+    parent = str(PurePosixPath(dest).parent)
+    return [parent, dest] if archives else [parent]
+
+
+@PHASES.timed("mount")
+def refresh_mount(dirs):
+    """Make the B2 mount show what was just written to dirs.
+
+    The mount caches directory listings for --dir-cache-time, so a new
+    upload (and a negative lookup made before it) would stay invisible
+    to Jellyfin and Copyparty until then. vfs/refresh on the mount's rc
+    (MOUNT_RC_URL) re-reads just these directories and their ancestors,
+    one at a time, top-down, so the cache time can stay long. Errors are
+    only logged: the listing catches up when the cache expires anyway.
+    """
+    if not MOUNT_RC_URL:
+        return
+    for d in mount_dirs(dirs):
+        if d == ".":
+            continue
+        try:
+            reply = rc_call(MOUNT_RC_URL, "vfs/refresh", {"dir": d}, timeout=30)
+        except RcError as e:
+            print(f"Cannot refresh B2 mount: {e}")
+            return
+        result = reply.get("result", {}).get(d, "OK")
+        if result != "OK":
+            print(f"Cannot refresh B2 mount: {d}: {result}")
+
+
+def cancel_abandoned_uploads(state, b2_remote):
+    """Cancel unfinished large-file uploads nothing will resume (see b2.py)."""
+    target = b2_client(f"{b2_remote}/")
+    if target is None:
+        return
+    try:
+        cancel_abandoned(target[0], state)
+    except B2Error as e:
+        print(f"Cannot list unfinished uploads: {e}")
+
+
+def rc_copy(src, dest, transfers=4):
+    """rclone_copy as an async job on the rc daemon at RC_URL."""
+    src = Path(src)
+    if src.is_dir():
+        command, params = "sync/copy", {"srcFs": str(src), "dstFs": dest}
+    else:
+        command = "operations/copyfile"
+        params = {
+            "srcFs": str(src.parent),
+            "srcRemote": src.name,
+            "dstFs": dest,
+            "dstRemote": src.name,
+        }
+    params["_config"] = {"Transfers": transfers, "CheckSum": True}
+    try:
+        error, _ = rc_job(RC_URL, command, params)
+    except RcError as e:
+        error = e
+    if error:
+        print(f"Upload failed: {src}: {error}")
+        return False
+    return True
+
+
+def rc_copy_batch(src_root, dest, rel_paths, transfers=4):
+    """rclone_copy_batch as one sync/copy job on the rc daemon at RC_URL.
+
+    The daemon runs on the same machine and reads the file list from a
+    temporary file, like --files-from-raw. Per-file results come from the
+    job's stats group. If the job fails, every file not confirmed as
+    transferred counts as failed; files rclone skipped as already present
+    are uploaded (i.e. skipped) again next time.
+    """
+    with tempfile.NamedTemporaryFile("w", prefix="qbt-upload-", suffix=".txt") as f:
+        f.write("".join(f"{rel}\n" for rel in rel_paths))
+        f.flush()
+        try:
+            error, transferred = rc_job(
+                RC_URL,
+                "sync/copy",
+                {
+                    "srcFs": str(src_root),
+                    "dstFs": dest,
+                    "_config": {"Transfers": transfers, "CheckSum": True},
+                    "_filter": {"FilesFromRaw": [f.name]},
+                },
+            )
+        except RcError as e:
+            print(f"Upload failed: {dest}: {e}")
+            return set(rel_paths)
+
+    for name, file_error in sorted(transferred.items()):
+        print(f"{name}: {file_error or 'Copied'}")
+    if error is None:
+        return set()
+    print(f"Upload failed: {dest}: {error}")
+    return set(rel_paths) - {name for name, e in transferred.items() if not e}
+
+
+@PHASES.timed("check")
+def rclone_check(src, dest, state):
+    """Check if src already exists at dest with the same content.
+
+    dest follows rclone copy: the parent directory for a file, the target
+    directory for a directory. Lists dest with rclone lsjson, which returns
+    the SHA1 B2 stores for each object, and compares it with the local SHA1
+    from the state's hash cache. Unlike rclone check, a file is only read
+    for hashing the first time it is compared.
+
+    Returns True if every file exists with matching size and SHA1.
+    """
+    src = Path(src)
+    if src.is_dir():
+        files = {
+            f.relative_to(src).as_posix(): f for f in src.rglob("*") if f.is_file()
+        }
+        remote = dest
+    else:
+        files = {src.name: src}
+        remote = f"{dest.rstrip('/')}/{src.name}"
+    if not files:
+        return False
+    objects = rclone_lsjson(remote, quiet=True)
+    if not objects:
+        return False
+    for rel, f in files.items():
+        entry = objects.get(rel)
+        # Objects without a stored SHA1 can't be verified
+        if entry is None or entry[2] is None:
+            return False
+        try:
+            if f.stat().st_size != entry[0]:
+                return False
+        except OSError:
+            return False
+        if state.sha1(f) != entry[2]:
+            return False
+    return True
 
 
+def rclone_lsjson(b2_remote, quiet=False):
+    """List every object in the bucket with one recursive rclone lsjson.
+
+    B2 returns each file's SHA1 and rclone's stored modification time in
+    the listing itself, so this costs one list transaction per 1000
+    objects and no local hashing. b2_remote may also be a path inside the
+    bucket; keys are then relative to it.
+
+    Returns {path: (size, mtime_ns, sha1)}, or None on failure (not
+    reported when quiet, e.g. for paths that may not exist yet). Uses the
+    rc daemon's operations/list when RC_URL is set.
+    """
+    if RC_URL:
+        opt = {
+            "recurse": True,
+            "filesOnly": True,
+            "showHash": True,
+            "hashTypes": ["sha1"],
+        }
+        try:
+            reply = rc_call(
+                RC_URL,
+                "operations/list",
+                {"fs": b2_remote, "remote": "", "opt": opt},
+                timeout=600,
+            )
+        except RcError as e:
+            if not quiet:
+                print(f"Listing failed: {b2_remote}: {e}")
+            return None
+        entries = reply.get("list", [])
+    else:
+        result = subprocess.run(
+            ["rclone", "lsjson", "-R", "--files-only", "--hash", b2_remote],
+            capture_output=True,
+            text=True,
+        )
+        if result.returncode != 0:
+            if not quiet:
+                print(f"Listing failed: {b2_remote}: {result.stderr.strip()}")
+            return None
+        try:
+            entries = json.loads(result.stdout)
+        except json.JSONDecodeError as e:
+            print(f"Listing failed: {b2_remote}: unexpected output ({e})")
+            return None
+    try:
+        objects = {}
+        for e in entries:
+            # Hash names are "sha1" in current rclone, "SHA-1" in older ones
+            hashes = e.get("Hashes") or {}
+            sha1 = hashes.get("sha1") or hashes.get("SHA-1")
+            objects[e["Path"]] = (e["Size"], parse_modtime(e["ModTime"]), sha1)
+        return objects
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"Listing failed: {b2_remote}: unexpected output ({e})")
+        return None
+
+
+def parse_modtime(value):
+    """Convert an rclone ModTime ("2024-05-01T12:00:00.123456789Z") to ns."""
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return int(dt.timestamp()) * 1_000_000_000 + dt.microsecond * 1000
+
+
+@PHASES.timed("manifest")
+def refresh_manifest(state, b2_remote, max_age):
+    """Make state.manifest available for this run.
+
+    Uses the cached listing if it is younger than max_age seconds,
+    otherwise re-lists the bucket. Returns False (leaving state.manifest
+    as None, so process_item falls back to rclone check) if the bucket
+    can't be listed.
+    """
+    if state.load_manifest(max_age):
+        return True
+    print(f"Refreshing B2 listing: {b2_remote}")
+    objects = rclone_lsjson(b2_remote)
+    if objects is None:
+        return False
+    state.replace_manifest(objects)
+    print(f"Cached {len(objects)} B2 objects")
+    return True
+
+
+def item_objects(item, dest):
+    """Return [(file, object name)] for item uploaded to dest (bucket-relative).
+
+    A file maps to dest itself, a directory's files to their paths under it.
+    """
+    item = Path(item)
+    if item.is_dir():
+        return [
+            (f, f"{dest}/{f.relative_to(item).as_posix()}")
+            for f in sorted(item.rglob("*"))
+            if f.is_file()
+        ]
+    return [(item, dest)]
+
+
+def manifest_has(manifest, item, dest, state=None):
+    """Check the cached bucket listing for item at dest (bucket-relative).
+
+    Files match on size and modification time: rclone stores the source
+    modtime on every B2 upload with millisecond precision. If only the
+    modtime differs (e.g. the local file was touched) and the listing has
+    a SHA1, the file matches if its cached local SHA1 does. Directories
+    match if every file inside them does.
+    """
+    for f, key in item_objects(item, dest):
+        entry = manifest.get(key)
+        if entry is None:
+            return False
+        try:
+            st = f.stat()
+        except OSError:
+            return False
+        size, mtime_ns, sha1 = entry
+        if st.st_size != size:
+            return False
+        if abs(st.st_mtime_ns - mtime_ns) < 1_000_000:
+            continue
+        if sha1 is None or state is None or state.sha1(f) != sha1:
+            return False
+    return True
+
+
+def bucket_copies(item, dest, state, hash_files=True):
+    """Find files of item whose content is already in the bucket elsewhere.
+
+    Returns [(file, key, source)]: key is the file's object name under
+    dest (bucket-relative) and source an object in the cached listing
+    with the same size and SHA1, e.g. the same release uploaded under
+    downloads/ before it was re-categorized. Only files of at least
+    SERVER_COPY_MIN bytes are looked at, and only those with an object of
+    the same size are hashed (state.sha1, cached).
+
+    With hash_files=False nothing is read or cached: only SHA1s already
+    cached are used, and a file without one that has an object of the
+    same size is returned with source None (a possible copy).
+    """
+    if state.manifest is None:
+        return []
+    copies = []
+    for f, key in item_objects(item, dest):
+        try:
+            st = f.stat()
+        except OSError:
+            continue
+        size = st.st_size
+        if size < SERVER_COPY_MIN or not state.has_object_size(size):
+            continue
+        if key in state.manifest:
+            # Something is there already; the upload's checksum compare decides
+            continue
+        sha1 = state.sha1(f) if hash_files else state.cached_sha1(st)
+        if sha1 is None and not hash_files:
+            copies.append((f, key, None))
+            continue
+        source = state.find_object(size, sha1) if sha1 else None
+        if source is not None and source != key:
+            copies.append((f, key, source))
+    return copies
+
+
+def bucket_moves(item, dest, state):
+    """Find uploaded objects that files of item were renamed from.
+
+    When Sonarr renames an episode or Radarr moves a movie folder, the
+    file keeps its inode, size and mtime, so its upload record still
+    matches, only under the old object name. Returns
+    [(file, key, old_key, old_path)] for files of item (key being the
+    object name under dest) recorded as uploaded to another old_key from
+    an old_path that no longer exists, where the cached listing has
+    old_key with the file's size. A record whose path still exists is a
+    second copy, not a rename, and is left to bucket_copies.
+    """
+    if state.manifest is None:
+        return []
+    moves = []
+    for f, key in item_objects(item, dest):
+        try:
+            st = f.stat()
+        except OSError:
+            continue
+        for old_key, old_path in sorted(state.destinations(st).items()):
+            # "" is a completed/ item's propagated record, not an object
+            if not old_key or old_key == key or os.path.lexists(old_path):
+                continue
+            entry = state.manifest.get(old_key)
+            if entry is not None and entry[0] == st.st_size:
+                moves.append((f, key, old_key, old_path))
+                break
+    return moves
+
+
+@PHASES.timed("server_side")
+def server_copy(b2_remote, source, key, move=False):
+    """Copy (or with move=True, move) object source to key inside the bucket.
+
+    B2 copies the data itself (b2_copy_file, or b2_copy_part for big
+    files), so nothing goes over the uplink; a move then deletes source.
+    rclone keeps the source's file info, including its modification time.
+    Returns True on success.
+    """
+    if RC_URL:
+        try:
+            error, _ = rc_job(
+                RC_URL,
+                "operations/movefile" if move else "operations/copyfile",
+                {
+                    "srcFs": b2_remote,
+                    "srcRemote": source,
+                    "dstFs": b2_remote,
+                    "dstRemote": key,
+                },
+            )
+        except RcError as e:
+            error = e
+    else:
+        result = subprocess.run(
+            [
+                "rclone",
+                "moveto" if move else "copyto",
+                f"{b2_remote}/{source}",
+                f"{b2_remote}/{key}",
+            ]
+        )
+        error = result.returncode and f"rclone exited with {result.returncode}"
+    if error:
+        action = "move" if move else "copy"
+        print(f"Server-side {action} failed: {source} -> {key}: {error}")
+        return False
+    return True
+
+
+@PHASES.timed("server_side")
+def server_delete(b2_remote, key):
+    """Delete object key from the bucket. Returns True on success.
+
+    rclone hides the file on B2 rather than erasing it, so the bucket's
+    lifecycle rules decide when the old versions go.
+    """
+    if RC_URL:
+        try:
+            error, _ = rc_job(
+                RC_URL, "operations/deletefile", {"fs": b2_remote, "remote": key}
+            )
+        except RcError as e:
+            error = e
+    else:
+        result = subprocess.run(["rclone", "deletefile", f"{b2_remote}/{key}"])
+        error = result.returncode and f"rclone exited with {result.returncode}"
+    if error:
+        print(f"Cannot delete from B2: {key}: {error}")
+        return False
+    return True
+
+
+def copy_within_bucket(copies, b2_remote, state):
+    """Make server-side copies for bucket_copies' result.
+
+    Each copy is added to the cached listing, so the upload that follows
+    (or manifest_has) sees the file as present, and shown in the B2 mount
+    (see refresh_mount). Returns the number of files copied.
+    """
+    copied = 0
+    dirs = []
+    for _, key, source in copies:
+        if not server_copy(b2_remote, source, key):
+            continue
+        dirs.append(str(PurePosixPath(key).parent))
+        size, mtime_ns, sha1 = state.manifest[source]
+        state.add_object(key, size, mtime_ns, sha1)
+        METRICS.inc(
+            "qbt_upload_copied_bytes_total", size, category=key.partition("/")[0]
+        )
+        PHASES.count("server_side", nbytes=size)
+        print(f"Copied on B2: {source} -> {key}")
+        copied += 1
+    refresh_mount(dirs)
+    return copied
+
+
+def move_within_bucket(moves, b2_remote, state):
+    """Make server-side moves for bucket_moves' result.
+
+    The cached listing and the B2 mount follow the move and the record of
+    the old path is dropped. Returns the number of files moved.
+    """
+    moved = 0
+    dirs = []
+    for _, key, old_key, old_path in moves:
+        if not server_copy(b2_remote, old_key, key, move=True):
+            continue
+        dirs += [str(PurePosixPath(k).parent) for k in (old_key, key)]
+        state.add_object(key, *state.manifest[old_key])
+        state.remove_object(old_key)
+        state.forget(old_path)
+        METRICS.inc(
+            "qbt_upload_moved_bytes_total",
+            state.manifest[key][0],
+            category=key.partition("/")[0],
+        )
+        PHASES.count("server_side", nbytes=state.manifest[key][0])
+        print(f"Moved on B2: {old_key} -> {key}")
+        moved += 1
+    refresh_mount(dirs)
+    return moved
+
+
+@PHASES.timed("extract")
 def extract_archive(archive, extract_to):
     """Extract a single archive (zip/rar) into extract_to via unar."""
     print(f"Extracting: {archive.name}")
@@ -90,32 +1119,326 @@ def extract_archive(archive, extract_to):
     )
 
 
-def mark_uploaded(item):
-    """Create .uploaded marker file next to item.
+def archive_members(zf, archive):
+    """Map each file in an open zip to its path in the extracted layout.
 
-    Returns True on success. Warns and returns False on permission error.
+    Mirrors what unar -o does, so streamed and staged archives end up in
+    the same place on B2: a single top-level entry is extracted as-is,
+    several are wrapped in a directory named after the archive. Members
+    with absolute or ".." paths are skipped.
+    """
+    members = [
+        (info, PurePosixPath(info.filename))
+        for info in zf.infolist()
+        if not info.is_dir()
+    ]
+    members = [
+        (info, path)
+        for info, path in members
+        if not path.is_absolute() and ".." not in path.parts
+    ]
+    top_level = {path.parts[0] for _, path in members}
+    if len(top_level) > 1:
+        return [(info, f"{Path(archive).stem}/{path}") for info, path in members]
+    return [(info, str(path)) for info, path in members]
+
+
+@PHASES.timed("stream")
+def stream_archive(archive, dest, transfers=4):
+    """Upload the contents of a zip archive to dest without extracting it.
+
+    Each member is decompressed in memory and piped into `rclone rcat`, so
+    nothing is written to local disk. The rc daemon can't take a piped
+    stream, so every member is its own rclone process; the pipe is paced
+    with BANDWIDTH's Throttle, so the stream keeps to its part of the
+    limit as it changes. Members go one at a time, and each uploads at
+    most `transfers` parts at once (held from the TransferBudget), like the
+    job's other rclone calls. Returns True if every member was
+    uploaded; False if the archive can't be streamed (rar, multi-volume or
+    encrypted zip, corrupt data) or an upload failed, in which case the
+    caller falls back to extract_archive.
     """
-    marker = Path(f"{item}.uploaded")
+    archive = Path(archive)
+    if archive.suffix.lower() != ".zip":
+        return False
+    if len(archive_volumes(archive)) > 1:
+        # Split zip (.z01, ...): Python's zipfile can't read across volumes
+        return False
     try:
-        marker.touch()
+        with zipfile.ZipFile(archive) as zf:
+            for info, rel in archive_members(zf, archive):
+                proc = subprocess.Popen(
+                    [
+                        "rclone",
+                        "rcat",
+                        f"{dest}/{rel}",
+                        "--size",
+                        str(info.file_size),
+                        # Big members are multipart uploads, sent in parallel
+                        "--b2-upload-concurrency",
+                        str(transfers),
+                    ],
+                    stdin=subprocess.PIPE,
+                )
+                try:
+                    with bandwidth_share("throttle"), zf.open(info) as member:
+                        while chunk := member.read(STREAM_CHUNK):
+                            if BANDWIDTH is not None:
+                                BANDWIDTH.throttle.wait(len(chunk))
+                            proc.stdin.write(chunk)
+                    proc.stdin.close()
+                except BaseException:
+                    # Abort the upload rather than leave a truncated object
+                    proc.kill()
+                    proc.wait()
+                    raise
+                if proc.wait() != 0:
+                    print(f"Streaming upload failed: {archive.name}/{rel}")
+                    return False
+    except (OSError, RuntimeError, NotImplementedError, zipfile.BadZipFile) as e:
+        print(f"Cannot stream {archive.name}: {e}")
+        return False
+    print(f"Streamed: {archive.name} -> {dest}")
+    return True
+
+
+def mark_uploaded(item, dest, state):
+    """Record item as uploaded to dest (bucket-relative) in the upload state.
+
+    Returns True on success. Warns and returns False if the item can't be
+    stat'ed or the state database can't be written.
+    """
+    try:
+        state.mark(item, dest)
         return True
-    except PermissionError:
-        print(f"WARNING: Cannot create upload marker: {marker} (permission denied)")
-        print(f'Fix ownership: chown -R media:media "{item.parent}"')
+    except (OSError, sqlite3.Error) as e:
+        print(f"WARNING: Cannot record upload of {item}: {e}")
+        print(f'Check ownership: chown media:media "{state.db_path}"')
         return False
 
 
-def process_item(item, b2_base, b2_remote, extracted_dir):
-    """Process a single item (file or directory) for upload.
+def add_uploaded_objects(item, dest, state, files=None):
+    """Add the objects item's upload to dest created to the cached listing.
+
+    So a rename or upgrade before the next listing finds the object (see
+    bucket_moves and retire_objects). files limits it to the files of item
+    that were uploaded as they are. The SHA1 is added only if it's cached;
+    uploading doesn't hash files.
+    """
+    for f, key in item_objects(item, dest):
+        if files is not None and f not in files:
+            continue
+        try:
+            st = f.stat()
+        except OSError:
+            continue
+        state.add_object(key, st.st_size, st.st_mtime_ns, state.cached_sha1(st))
 
-    Checks if already on B2, extracts archives if present, uploads
-    the original item and any extracted contents, then creates an
-    .uploaded marker.
 
-    Returns True on success, False on failure.
+def record_upload(item, dest, size=None):
+    """Count item (uploaded to bucket-relative dest) in METRICS and PHASES.
+
+    size is the item's size if already known (see Scheduler.order).
+    Returns its size in bytes.
+    """
+    category = dest.partition("/")[0]
+    if size is None:
+        size = item_info(item, dest)[0]
+    METRICS.inc("qbt_upload_items_total", category=category)
+    METRICS.inc("qbt_upload_bytes_total", size, category=category)
+    PHASES.count("upload", nbytes=size)
+    return size
+
+
+def record_job(category, started, size):
+    """Record an upload job's duration and throughput in METRICS.
+
+    started is the time.monotonic() at which the job began and size the
+    bytes it uploaded.
+    """
+    elapsed = max(time.monotonic() - started, 1e-3)
+    METRICS.observe("qbt_upload_job_seconds", elapsed, category=category)
+    METRICS.observe(
+        "qbt_upload_throughput_bytes_per_second", size / elapsed, category=category
+    )
+
+
+def record_throughput(state, size, elapsed):
+    """Fold a round's overall upload rate into the one --plan estimates with.
+
+    Kept in the state's meta table as a moving average, so one slow round
+    (an evening under the bandwidth cap) doesn't decide the estimate.
+    Rounds of less than THROUGHPUT_MIN_BYTES are ignored: their time is
+    mostly per-job overhead, not transfer.
+    """
+    if size < THROUGHPUT_MIN_BYTES or elapsed <= 0:
+        return
+    rate = size / elapsed
+    previous = state.get_meta("upload_throughput")
+    if previous is not None:
+        rate = 0.7 * float(previous) + 0.3 * rate
+    state.set_meta("upload_throughput", rate)
+
+
+def archive_volumes(archive):
+    """Return every volume of the archive set that archive is the first of.
+
+    name.part01.rar comes with the other name.partNN.rar, name.rar with
+    name.r00, name.r01, ... and name.zip with name.z01, name.z02, ... (unar
+    reads a split zip from its .zip). A single-volume archive returns
+    [archive].
+    """
+    archive = Path(archive)
+    try:
+        siblings = sorted(p for p in archive.parent.iterdir() if p.is_file())
+    except OSError:
+        return [archive]
+    part = RAR_PART.fullmatch(archive.name)
+    if part:
+        stem = part["stem"].lower()
+        rest = [
+            p
+            for p in siblings
+            if (m := RAR_PART.fullmatch(p.name)) and m["stem"].lower() == stem
+        ]
+    else:
+        letter = archive.suffix[1:2].lower()
+        rest = [
+            p
+            for p in siblings
+            if p.stem == archive.stem
+            and re.fullmatch(rf"\.{letter}\d\d+", p.suffix, re.IGNORECASE)
+        ]
+    return [archive] + [p for p in rest if p != archive]
+
+
+def is_first_volume(path):
+    """Check whether path is a zip/rar that unar should be started on.
+
+    Plain .rar and .zip files are; of a name.partNN.rar set only part 1 is.
+    Continuation volumes (.r00, .z01) never are.
+    """
+    path = Path(path)
+    if path.suffix.lower() not in (".zip", ".rar"):
+        return False
+    part = RAR_PART.fullmatch(path.name)
+    return part is None or int(part["number"]) == 1
+
+
+def is_later_volume(path):
+    """Check whether path continues an archive set (.r00, .z01, .part02.rar)."""
+    path = Path(path)
+    part = RAR_PART.fullmatch(path.name)
+    if part:
+        return int(part["number"]) > 1
+    return re.fullmatch(r"\.[rz]\d\d+", path.suffix, re.IGNORECASE) is not None
+
+
+def non_volume_files(item, archives):
+    """Return the files of item that belong to none of archives' sets."""
+    item = Path(item)
+    if not item.is_dir():
+        return []
+    volumes = {volume for archive in archives for volume in archive_volumes(archive)}
+    return [f for f in sorted(item.rglob("*")) if f.is_file() and f not in volumes]
+
+
+def find_archives(item):
+    """Return the archives to extract for item, one per archive set.
+
+    A single-file archive returns itself; a directory returns the
+    archives anywhere below it (e.g. Subs/subs.rar next to the main set).
+    Multi-volume sets are returned once, by their first volume (see
+    archive_volumes), so unar runs once per set. A set whose first volume
+    is missing is left out, since it can't be extracted. Archives inside
+    archives are ignored.
+    """
+    item = Path(item)
+    if item.is_file():
+        return [item] if is_first_volume(item) else []
+    if item.is_dir():
+        return [
+            f for f in sorted(item.rglob("*")) if f.is_file() and is_first_volume(f)
+        ]
+    return []
+
+
+def process_item(
+    item, b2_base, b2_remote, extracted_dir, state, batch=None, budget=None, size=None
+):
+    """Process a single item (file or directory) for upload.
+
+    Checks if already on B2, uploads the contents of any archives
+    (streamed for zip, extracted to disk otherwise) and the original item,
+    then records the upload in the state database. Archives in
+    subdirectories of the item are unpacked into the same subdirectory
+    on B2.
+
+    The "already on B2" check uses the cached bucket listing when one is
+    loaded (state.manifest), and rclone check otherwise. Renamed files
+    are moved server-side from their old object (see bucket_moves) and
+    files whose content the listing has under another name are copied
+    (see bucket_copies); the upload then skips them by checksum.
+
+    With a batch, items without archives are only queued (see queue_upload)
+    and uploaded later by upload_batch. Archive items are always processed
+    immediately, extracting into their own temporary directory under
+    extracted_dir so concurrent workers never share one. Each upload holds
+    transfers from budget (see TransferBudget) while it runs, and large
+    files, of the item or extracted, go through the B2 API like a batch's
+    (see upload_tree).
+
+    Under the "extracted" archive policy (see archive_policy), only the
+    contents and the files outside the archive sets are uploaded, and a
+    continuation volume is recorded without uploading it.
+
+    Returns True on success (or when queued), False on failure.
     """
     item = Path(item)
     name = item.name
+    archives = find_archives(item)
+    if budget is None:
+        budget = TransferBudget(4)
+    extracted_only = archive_policy(b2_base) == "extracted"
+
+    # Check the cached listing first — avoids re-uploading when a previous
+    # upload succeeded but was not recorded, without touching B2
+    if state.manifest is not None and manifest_has(
+        state.manifest, item, f"{b2_base}{name}", state
+    ):
+        print(f"Already on B2 (listing match): {name}")
+        METRICS.inc("qbt_upload_check_hits_total", method="listing")
+        mark_uploaded(item, f"{b2_base}{name}", state)
+        return True
+
+    # A volume of a set that is unpacked from its first volume (e.g. a
+    # .part02.rar hard linked into an import dir on its own)
+    if extracted_only and not archives and is_later_volume(item):
+        print(f"Not uploading archive volume: {name}")
+        mark_uploaded(item, f"{b2_base}{name}", state)
+        return True
+
+    # Sonarr/Radarr renames: move the old object to the new name. Then
+    # re-categorized items and re-downloaded releases: copy what B2
+    # already has. Either way the bytes aren't sent again.
+    moved = move_within_bucket(
+        bucket_moves(item, f"{b2_base}{name}", state), b2_remote, state
+    )
+    copied = copy_within_bucket(
+        bucket_copies(item, f"{b2_base}{name}", state), b2_remote, state
+    )
+    if (moved or copied) and manifest_has(
+        state.manifest, item, f"{b2_base}{name}", state
+    ):
+        method = "copy" if copied else "move"
+        print(f"Already on B2 (server-side {method}): {name}")
+        METRICS.inc("qbt_upload_check_hits_total", method=method)
+        mark_uploaded(item, f"{b2_base}{name}", state)
+        return True
+
+    if batch is not None and not archives:
+        queue_upload(batch, item, b2_base, b2_remote)
+        return True
 
     # Compute B2 destination: directories get a named subfolder,
     # files go directly into the base path
@@ -124,240 +1447,1355 @@ def process_item(item, b2_base, b2_remote, extracted_dir):
     else:
         dest = f"{b2_remote}/{b2_base}"
 
-    # Check if already on B2 with correct checksum — avoids re-uploading
-    # when a previous upload succeeded but the marker was not created
-    if rclone_check(item, dest):
+    # Without a listing, ask B2 directly (with correct checksum)
+    if state.manifest is None and rclone_check(item, dest, state):
         print(f"Already on B2 (checksum match): {name}")
-        mark_uploaded(item)
+        METRICS.inc("qbt_upload_check_hits_total", method="checksum")
+        mark_uploaded(item, f"{b2_base}{name}", state)
         return True
 
-    work_dir = Path(extracted_dir) / name
-    has_archives = False
+    # Single file archive, or one archive per set anywhere in a directory.
+    # Zips are streamed straight to B2; anything else is extracted to disk
+    # first. Contents land in the archive's directory within the item.
+    def contents_dir(archive):
+        return archive.parent.relative_to(item) if item.is_dir() else Path()
+
+    started = time.monotonic()
+    contents_ok = True
+    staged = []
+    for archive in archives:
+        contents = PurePosixPath(b2_base, name, contents_dir(archive))
+        with budget.take(budget.share()) as transfers:
+            streamed = stream_archive(archive, f"{b2_remote}/{contents}", transfers)
+        if not streamed:
+            staged.append(archive)
+
+    if staged:
+        # Per-item work dir: two items with the same name (e.g. from tv/ and
+        # downloads/) can be extracted at the same time
+        Path(extracted_dir).mkdir(parents=True, exist_ok=True)
+        work_dir = Path(tempfile.mkdtemp(prefix=f"{name}.", dir=extracted_dir))
+        try:
+            extract_started = time.monotonic()
+            for archive in staged:
+                extract_to = work_dir / contents_dir(archive)
+                extract_to.mkdir(parents=True, exist_ok=True)
+                extract_archive(archive, extract_to)
+            METRICS.observe(
+                "qbt_upload_extract_seconds", time.monotonic() - extract_started
+            )
+
+            # Upload extracted contents then clean up
+            print(f"Uploading extracted: {name}")
+            contents_ok = upload_tree(
+                work_dir, f"{b2_remote}/{b2_base}{name}", state, budget
+            )
+        except (subprocess.CalledProcessError, OSError) as e:
+            # Corrupt or password-protected archive, or a full disk
+            print(f"Extraction failed: {name}: {e}")
+            METRICS.inc("qbt_upload_failures_total", category=b2_base.partition("/")[0])
+            return False
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if archives and extracted_only:
+        # The contents are all B2 gets of the archives, so they must be there
+        uploaded = set(non_volume_files(item, archives))
+        rest = [f.relative_to(item).as_posix() for f in sorted(uploaded)]
+        print(f"Uploading without archive volumes: {name}")
+        ok = contents_ok
+        if ok and rest:
+            ok = not upload_files(
+                item, f"{b2_remote}/{b2_base}{name}/", rest, state, budget
+            )
+    else:
+        # Upload the original item
+        print(f"Uploading: {name} -> {dest}")
+        ok = upload_tree(item, dest, state, budget)
+        uploaded = None
+    if not ok:
+        METRICS.inc("qbt_upload_failures_total", category=b2_base.partition("/")[0])
+        return False
+
+    mark_uploaded(item, f"{b2_base}{name}", state)
+    add_uploaded_objects(item, f"{b2_base}{name}", state, uploaded)
+    size = record_upload(item, f"{b2_base}{name}", size)
+    record_job(b2_base.partition("/")[0], started, size)
+    print(f"Uploaded: {name}")
+    refresh_mount(item_dirs(item, f"{b2_base}{name}", archives))
+    return True
 
-    # Clean up any previous extraction attempt
-    if work_dir.exists():
-        shutil.rmtree(work_dir)
-    work_dir.mkdir(parents=True)
 
-    # Single file archive
-    if item.is_file() and item.suffix.lower() in (".zip", ".rar"):
-        extract_archive(item, work_dir)
-        has_archives = True
+def queue_upload(batch, item, b2_base, b2_remote):
+    """Add item to the run's upload batch.
 
-    # Directory containing archives (top-level only)
+    The batch maps (local root, B2 root) to a list of
+    (item, dest, rel_paths) entries. The root is the first component of
+    b2_base (e.g. "tv/"), and the local root is the directory whose layout
+    mirrors it, so every item for one B2 root goes into the same rclone call:
+      /media/arr/tv/Show/Season 1/ep.mkv, "tv/Show/Season 1/"
+        -> root ("/media/arr/tv", "b2:bucket/tv/"), rel "Show/Season 1/ep.mkv"
+    Directory items contribute one rel path per file inside them.
+    """
+    item = Path(item)
+    root, _, sub = b2_base.partition("/")
+    rel = f"{sub}{item.name}"
+    src_root = str(item)[: -len(rel)].rstrip("/")
     if item.is_dir():
-        for child in item.iterdir():
-            if child.is_file() and child.suffix.lower() in (".zip", ".rar"):
-                extract_archive(child, work_dir)
-                has_archives = True
-
-    # Upload extracted contents then clean up
-    if has_archives:
-        print(f"Uploading extracted: {name}")
-        rclone_copy(work_dir, f"{b2_remote}/{b2_base}{name}")
-    shutil.rmtree(work_dir, ignore_errors=True)
-
-    # Upload the original item
-    print(f"Uploading: {name} -> {dest}")
-    if not rclone_copy(item, dest):
-        return False
+        rels = [
+            f"{rel}/{f.relative_to(item)}"
+            for f in sorted(item.rglob("*"))
+            if f.is_file()
+        ]
+    else:
+        rels = [rel]
+    key = (src_root, f"{b2_remote}/{root}/")
+    batch.setdefault(key, []).append((item, f"{b2_base}{item.name}", rels))
+
+
+def upload_batch(batch, state, budget=None, sizes=None):
+    """Upload every queued item, one rclone call per B2 root.
+
+    Large files go through the B2 API first, as resumable large files
+    (see upload_large_files). Uploads hold transfers from budget (see
+    TransferBudget) while they run. Each item is recorded as uploaded only if
+    none of its files failed; sizes (item -> bytes) saves walking it again
+    for the count. The B2 mount is refreshed for the uploaded
+    items once per root (see refresh_mount). Empties the batch. Returns
+    True if every item was uploaded.
+    """
+    if budget is None:
+        budget = TransferBudget(4)
+    if sizes is None:
+        sizes = {}
+    ok = True
+    for (src_root, dest_root), entries in sorted(batch.items()):
+        started = time.monotonic()
+        uploaded = 0
+        dirs = []
+        rels = [rel for _, _, item_rels in entries for rel in item_rels]
+        print(f"Uploading {len(entries)} items ({len(rels)} files) -> {dest_root}")
+        failed = upload_files(src_root, dest_root, rels, state, budget)
+        for item, dest, item_rels in entries:
+            if failed.intersection(item_rels):
+                print(f"Upload failed: {item}")
+                METRICS.inc(
+                    "qbt_upload_failures_total", category=dest.partition("/")[0]
+                )
+                ok = False
+                continue
+            mark_uploaded(item, dest, state)
+            add_uploaded_objects(item, dest, state)
+            uploaded += record_upload(item, dest, sizes.get(item))
+            dirs += item_dirs(item, dest)
+            print(f"Uploaded: {item.name}")
+        record_job(dest_root.rstrip("/").rsplit("/", 1)[-1], started, uploaded)
+        refresh_mount(dirs)
+    batch.clear()
+    return ok
+
+
+def clear_extracted_dir(extracted_dir):
+    """Remove work dirs left behind by an interrupted run."""
+    path = Path(extracted_dir)
+    if not path.exists():
+        return
+    for child in path.iterdir():
+        if child.is_dir():
+            shutil.rmtree(child, ignore_errors=True)
+        else:
+            child.unlink(missing_ok=True)
 
-    mark_uploaded(item)
-    print(f"Uploaded: {name}")
-    return True
 
+def job_name(job):
+    """Describe an upload_pending job (batch or archive item) for logs."""
+    if isinstance(job, dict):
+        return ", ".join(
+            f"{len(entries)} items -> {dest_root}"
+            for (_, dest_root), entries in sorted(job.items())
+        )
+    return str(job[0])
+
+
+def upload_pending(
+    pending,
+    b2_remote,
+    extracted_dir,
+    state,
+    workers,
+    budget,
+    scheduler=None,
+    pool=None,
+    priority=0,
+):
+    """Upload every pending (item, b2_base) on a pool of upload workers.
+
+    The scheduler (see schedule.py) decides the order. Plain items are
+    batched into jobs of up to BATCH_ITEMS items per B2 root (see
+    upload_batch); each archive item is its own job since it needs
+    extraction first. Jobs are started in the order of their first item,
+    on up to `workers` threads, sharing the budget's transfers (see
+    TransferBudget).
+
+    The daemon passes its JobPool, shared by every round, with the
+    round's priority; items another round is still uploading are left to
+    it. Without one, a pool is started for this call.
+
+    The backlog (items and bytes left in jobs) is published in METRICS
+    and the metrics file is rewritten as each job finishes. The round's
+    overall throughput is kept for --plan (see record_throughput).
+
+    Returns True if every job succeeded.
+    """
+    if scheduler is None:
+        scheduler = Scheduler()
+    own_pool = pool is None
+    if own_pool:
+        pool = JobPool(workers)
+    claimed = pool.claim([item for item, _ in pending])
+    if len(claimed) < len(pending):
+        print(f"Already being uploaded: {len(pending) - len(claimed)} items")
+        claimed_set = set(claimed)
+        pending = [(item, b2_base) for item, b2_base in pending if item in claimed_set]
 
-def scan_import_dir(directory, b2_base, b2_remote, extracted_dir):
+    try:
+        # Each job is a batch dict or an archive (item, b2_base)
+        jobs = []
+        # (local root, B2 root) -> batch still taking items
+        open_batches = {}
+        # item -> item_info, looked up once for the order, backlog and records
+        info = {}
+        for item, b2_base in scheduler.order(pending, info):
+            if find_archives(item):
+                jobs.append((item, b2_base))
+                continue
+            # Marks items already on B2, queues the rest
+            queued = {}
+            process_item(item, b2_base, b2_remote, extracted_dir, state, queued)
+            for key, entries in queued.items():
+                batch = open_batches.get(key)
+                if batch is None or len(batch[key]) >= BATCH_ITEMS:
+                    batch = open_batches[key] = {key: []}
+                    jobs.append(batch)
+                batch[key].extend(entries)
+
+        # (items, bytes) each job still has to upload
+        backlog = []
+        for job in jobs:
+            if isinstance(job, dict):
+                items = [
+                    (item, dest)
+                    for entries in job.values()
+                    for item, dest, _ in entries
+                ]
+            else:
+                items = [(job[0], job[1])]
+            backlog.append((len(items), sum(info[item][0] for item, _ in items)))
+        sizes = {item: item_size for item, (item_size, _, _) in info.items()}
+        # Rounds running at once add up to the daemon's backlog
+        METRICS.inc("qbt_upload_pending_items", sum(n for n, _ in backlog))
+        METRICS.inc("qbt_upload_pending_bytes", sum(size for _, size in backlog))
+
+        def run_job(job, job_backlog):
+            try:
+                with budget.job():
+                    if isinstance(job, dict):
+                        ok = upload_batch(job, state, budget, sizes=sizes)
+                    else:
+                        item, b2_base = job
+                        ok = process_item(
+                            item,
+                            b2_base,
+                            b2_remote,
+                            extracted_dir,
+                            state,
+                            budget=budget,
+                            size=sizes[item],
+                        )
+            except Exception:
+                # One broken job must not stop the others or the rest of the run
+                print(f"Upload job failed: {job_name(job)}")
+                traceback.print_exc()
+                ok = False
+            METRICS.inc("qbt_upload_pending_items", -job_backlog[0])
+            METRICS.inc("qbt_upload_pending_bytes", -job_backlog[1])
+            METRICS.write()
+            return ok
+
+        started = time.monotonic()
+        futures = [
+            pool.submit(priority, run_job, *entry) for entry in zip(jobs, backlog)
+        ]
+        results = [future.result() for future in futures]
+        # Bytes of this round's jobs only, other rounds may be uploading too
+        uploaded = sum(size for ok, (_, size) in zip(results, backlog) if ok)
+        record_throughput(state, uploaded, time.monotonic() - started)
+        return all(results)
+    finally:
+        pool.release(claimed)
+        if own_pool:
+            pool.shutdown()
+
+
+def scan_import_dir(
+    directory,
+    b2_base,
+    b2_remote,
+    extracted_dir,
+    state,
+    pending=None,
+    tree=None,
+    save=True,
+):
     """Scan an import directory for items to upload.
 
     Recurses into subdirectories to handle show/season structure
     (e.g. /media/arr/tv/Show Name/Season 1/episode.mkv).
+
+    A directory whose files were all uploaded on a previous scan is
+    snapshotted (mtime, entry count, see UploadState.dir_unchanged). While
+    the snapshot still matches, its files aren't stat'ed or looked up
+    again; only its subdirectories are descended into, since changes
+    further down don't touch this directory's mtime. Files rewritten in
+    place don't change the directory either — the daemon's inotify events
+    cover those.
+
+    Entries come from tree (a walk.Tree covering directory), listed once
+    for the whole run; without one, directory is listed here.
+
+    With a pending list, items are appended as (item, b2_base) for
+    upload_pending instead of being processed during the scan. Snapshots
+    are only saved with save (plan_run doesn't).
     """
+    if tree is None:
+        tree = Tree([directory])
     directory = Path(directory)
-    if not directory.exists():
+    children = tree.listdir(directory)
+    dir_st = tree.stat(directory)
+    if children is None or dir_st is None:
         return
 
-    for item in sorted(directory.iterdir()):
-        if item.name.endswith(".uploaded"):
+    unchanged = state.dir_unchanged(directory, dir_st, len(children))
+    complete = True
+    for child in children:
+        item = Path(child)
+        if tree.is_dir(item):
+            scan_import_dir(
+                item,
+                f"{b2_base}{item.name}/",
+                b2_remote,
+                extracted_dir,
+                state,
+                pending,
+                tree,
+                save,
+            )
             continue
-        if Path(f"{item}.uploaded").exists():
+        if unchanged or not tree.is_file(item):
             continue
 
-        if item.is_dir():
-            scan_import_dir(item, f"{b2_base}{item.name}/", b2_remote, extracted_dir)
+        st = tree.stat(item)
+        if st is None:
+            complete = False
+        elif state.is_uploaded_stat(st, f"{b2_base}{item.name}"):
+            continue
+        elif pending is not None:
+            complete = False
+            pending.append((item, b2_base))
         else:
-            process_item(item, b2_base, b2_remote, extracted_dir)
-
-
-def scan_completed_dir(directory, b2_base, b2_remote, extracted_dir, category_dirs):
+            complete = False
+            process_item(item, b2_base, b2_remote, extracted_dir, state)
+
+    if complete and not unchanged and save:
+        state.save_dir_snapshot(directory, dir_st, len(children))
+
+
+def scan_completed_dir(
+    directory,
+    b2_base,
+    b2_remote,
+    extracted_dir,
+    category_dirs,
+    state,
+    pending=None,
+    tree=None,
+):
     """Scan completed/ for uncategorized downloads.
 
     Skips category subdirectories (those are handled via import dirs).
+    With a pending list, items are collected as in scan_import_dir.
     """
-    directory = Path(directory)
-    if not directory.exists():
+    if tree is None:
+        tree = Tree([directory])
+    children = tree.listdir(directory)
+    if children is None:
         return
 
-    for item in sorted(directory.iterdir()):
-        if item.name.endswith(".uploaded"):
-            continue
-        if Path(f"{item}.uploaded").exists():
+    for child in children:
+        if child in category_dirs:
             continue
-        if item.is_dir() and str(item) in category_dirs:
+        item = Path(child)
+        st = tree.stat(item)
+        if st is None or state.is_uploaded_stat(st, f"{b2_base}{item.name}"):
             continue
 
-        process_item(item, b2_base, b2_remote, extracted_dir)
+        if pending is not None:
+            pending.append((item, b2_base))
+        else:
+            process_item(item, b2_base, b2_remote, extracted_dir, state)
 
 
-def needs_linking(item):
+def needs_linking(item, tree=None):
     """Check if a completed item needs hard linking to import dir.
 
     Returns True if all files have link count 1 (no hard links exist).
     Sonarr/Radarr-managed items will have link count > 1 because they
     create hard links into the import directory.
     """
-    item = Path(item)
-    if item.is_file():
-        return os.stat(item).st_nlink == 1
-    for f in item.rglob("*"):
-        if f.is_file() and os.stat(f).st_nlink > 1:
+    if tree is None:
+        tree = Tree([item])
+    for f in tree.files(item):
+        st = tree.stat(f)
+        if st is not None and st.st_nlink > 1:
             return False
     return True
 
 
-def link_to_import_dir(completed_dir, import_base, subdirs):
-    """Hard link manual category items to import directories.
+def plan_links(completed_dir, import_base, subdirs, state, tree):
+    """Find the hard links link_to_import_dir would create.
 
-    Scans completed/<subdir>/ for items where all files have st_nlink == 1
-    (manual downloads, not yet linked by Sonarr/Radarr). Creates hard links
-    in /media/arr/<subdir>/ preserving directory structure.
+    Returns [(item, [(src, dst), ...])] for every completed item that needs
+    linking and still has files missing from its import dir.
     """
+    planned = []
     for subdir in subdirs:
         src_dir = Path(completed_dir) / subdir
         dst_dir = Path(import_base) / subdir
-        if not src_dir.exists():
+        children = tree.listdir(src_dir)
+        if children is None:
             continue
 
-        for item in sorted(src_dir.iterdir()):
-            if item.name.endswith(".uploaded"):
-                continue
-            if Path(f"{item}.uploaded").exists():
-                continue
-            if not needs_linking(item):
-                continue
+        for child in children:
+            item = Path(child)
+            links = item_links(item, dst_dir, state, tree)
+            if links:
+                planned.append((item, links))
+    return planned
+
+
+def item_links(item, dst_dir, state, tree):
+    """Return the (src, dst) hard links linking one item into dst_dir needs.
+
+    Empty if the item is already uploaded, already linked (by Sonarr/Radarr
+    or an earlier run) or gone.
+    """
+    st = tree.stat(item)
+    if st is None or state.is_uploaded_stat(st):
+        return []
+    if not needs_linking(item, tree):
+        return []
+    if tree.is_file(item):
+        links = [(item, dst_dir / item.name)]
+    elif tree.is_dir(item):
+        links = [
+            (f, dst_dir / item.name / f.relative_to(item))
+            for f in map(Path, tree.files(item))
+        ]
+    else:
+        return []
+    return [(src, dst) for src, dst in links if not tree.exists(dst)]
+
+
+def make_links(item, links, tree):
+    """Create the hard links of one item (from item_links)."""
+    for src, dst in links:
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.link(src, dst)
+        except FileExistsError:
+            # Linked meanwhile by another daemon round (see run_daemon)
+            pass
+        tree.add(dst)
+    if item.is_dir():
+        print(f"Linked: {item.name}/ -> {links[0][1].parent}/")
+    else:
+        print(f"Linked: {item.name} -> {links[0][1]}")
+
+
+@PHASES.timed("link")
+def link_to_import_dir(completed_dir, import_base, subdirs, state, tree=None):
+    """Hard link manual category items to import directories.
 
-            if item.is_file():
-                dst = dst_dir / item.name
-                if not dst.exists():
-                    os.link(item, dst)
-                    print(f"Linked: {item.name} -> {dst}")
-            elif item.is_dir():
-                for f in item.rglob("*"):
-                    if not f.is_file():
-                        continue
-                    rel = f.relative_to(item)
-                    dst = dst_dir / item.name / rel
-                    if not dst.exists():
-                        dst.parent.mkdir(parents=True, exist_ok=True)
-                        os.link(f, dst)
-                print(f"Linked: {item.name}/ -> {dst_dir / item.name}/")
-
-
-def propagate_markers(completed_dir, import_base, subdirs):
-    """Propagate .uploaded markers from import dirs to completed/ items.
-
-    For each item in completed/<subdir>/ without an .uploaded marker,
-    collects file inodes and checks if those inodes have .uploaded markers
-    in the import dir. If all do, marks the completed item as uploaded.
+    Scans completed/<subdir>/ for items where all files have st_nlink == 1
+    (manual downloads, not yet linked by Sonarr/Radarr). Creates hard links
+    in /media/arr/<subdir>/ preserving directory structure. New links are
+    added to tree so the import dir scan that follows picks them up.
+    """
+    if tree is None:
+        tree = Tree([completed_dir] + [f"{import_base}/{subdir}" for subdir in subdirs])
+    for item, links in plan_links(completed_dir, import_base, subdirs, state, tree):
+        make_links(item, links, tree)
+
+
+def completed_item_keys(item, st, state, tree, save=True):
+    """Return the file key (see state.file_key) of every file in a completed item.
+
+    Cached in the state by the item's mtime (see UploadState.item_keys);
+    on a miss the item is walked, from tree if it lists the whole item,
+    and the result cached unless save is False.
+    """
+    item_keys = state.item_keys(item, st)
+    if item_keys is None:
+        walker = tree if tree.recursive else Tree([item])
+        item_keys = set()
+        for f in walker.files(item):
+            f_st = walker.stat(f)
+            if f_st is not None:
+                item_keys.add(file_key(f_st))
+        if save:
+            state.save_item_keys(item, st, item_keys)
+    return item_keys
+
+
+@PHASES.timed("propagate")
+def propagate_markers(completed_dir, import_base, subdirs, state, tree=None):
+    """Propagate upload status from import dirs to completed/ items.
+
+    For each item in completed/<subdir>/ not yet recorded as uploaded,
+    checks if all of its files have been uploaded (from the import dir),
+    matching on inode, size and mtime: an inode alone may have been
+    reused since cleanup deleted the file it was recorded for. If so,
+    records the completed item as uploaded with an empty destination —
+    its content is on B2 under the import dir names, not its own.
+
+    The state caches each item's file keys, so an item is only walked the
+    first time it is seen (or after it changed). Without a tree, only the
+    top level of completed/ is listed.
 
     This works for both arr-managed items (different names in import dir,
     same inodes) and manual items (same names, same inodes).
     """
+    # Nothing uploaded yet, so nothing can be propagated
+    if not state.uploads:
+        return
+
+    if tree is None:
+        tree = Tree(
+            [Path(completed_dir) / subdir for subdir in subdirs], recursive=False
+        )
     for subdir in subdirs:
         src_dir = Path(completed_dir) / subdir
         import_dir = Path(import_base) / subdir
-        if not src_dir.exists() or not import_dir.exists():
-            continue
-
-        # Build a set of inodes that have .uploaded markers in the import dir
-        uploaded_inodes = set()
-        for marker in import_dir.rglob("*.uploaded"):
-            source = marker.with_suffix("")
-            if source.exists() and source.is_file():
-                try:
-                    uploaded_inodes.add(os.stat(source).st_ino)
-                except OSError:
-                    continue
-
-        if not uploaded_inodes:
+        children = tree.listdir(src_dir)
+        if children is None or not import_dir.exists():
             continue
 
-        for item in sorted(src_dir.iterdir()):
-            if item.name.endswith(".uploaded"):
-                continue
-            if Path(f"{item}.uploaded").exists():
+        for child in children:
+            item = Path(child)
+            st = tree.stat(item)
+            if st is None or state.is_uploaded_stat(st):
                 continue
 
-            # Collect inodes for this completed item
-            item_inodes = set()
-            if item.is_file():
-                try:
-                    item_inodes.add(os.stat(item).st_ino)
-                except OSError:
-                    continue
-            elif item.is_dir():
-                for f in item.rglob("*"):
-                    if f.is_file():
-                        try:
-                            item_inodes.add(os.stat(f).st_ino)
-                        except OSError:
-                            continue
-
-            if not item_inodes:
+            item_keys = completed_item_keys(item, st, state, tree)
+            if not item_keys:
                 continue
 
-            # All file inodes must have .uploaded markers in import dir
-            if item_inodes.issubset(uploaded_inodes):
-                mark_uploaded(item)
+            # All files must have been uploaded
+            if state.files_uploaded(item_keys):
+                mark_uploaded(item, "", state)
                 print(f"Propagated marker: {item.name}")
 
 
-def main():
-    completed_dir = os.environ["COMPLETED_DIR"]
-    extracted_dir = os.environ["EXTRACTED_DIR"]
-    import_base = os.environ["IMPORT_BASE"]
-    b2_remote = os.environ["B2_REMOTE"]
-    categories = parse_categories(os.environ["CATEGORIES"])
+def format_size(size):
+    """Format bytes for humans (decimal units, like B2's console)."""
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1000:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1000
+    return f"{size:.1f} TB"
 
-    # Deduplicate subdirs — multiple categories can map to the same subdir
-    # (e.g. tv-sonarr and tv both map to "tv")
-    subdirs = sorted(set(categories.values()))
-    category_dirs = {f"{completed_dir}/{subdir}" for subdir in subdirs}
 
-    # Step 1: hard link manual category items to import dirs
-    link_to_import_dir(completed_dir, import_base, subdirs)
+def format_duration(seconds):
+    """Format seconds as e.g. "2h 05m" (or "45s" below a minute)."""
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    minutes = round(seconds / 60)
+    if minutes < 60:
+        return f"{minutes}m"
+    return f"{minutes // 60}h {minutes % 60:02d}m"
+
+
+def plan_archive(archive):
+    """Return (how, content bytes) for an archive process_item would unpack.
+
+    how is "stream" for zips stream_archive can read (single volume, not
+    encrypted, not corrupt) and "extract" otherwise. Extracted contents
+    are assumed to be about the size of the archive's volumes, since rar
+    headers aren't read here.
+    """
+    volumes = archive_volumes(archive)
+    if archive.suffix.lower() == ".zip" and len(volumes) == 1:
+        try:
+            with zipfile.ZipFile(archive) as zf:
+                members = archive_members(zf, archive)
+                if not any(info.flag_bits & 0x1 for info, _ in members):
+                    return "stream", sum(info.file_size for info, _ in members)
+        except (OSError, zipfile.BadZipFile):
+            pass
+    size = 0
+    for volume in volumes:
+        try:
+            size += volume.stat().st_size
+        except OSError:
+            pass
+    return "extract", size
+
+
+def files_size(files):
+    """Return the total size of files, skipping any that are gone."""
+    total = 0
+    for f in files:
+        try:
+            total += f.stat().st_size
+        except OSError:
+            continue
+    return total
+
+
+def plan_run(
+    completed_dir, import_base, subdirs, b2_remote, extracted_dir, state, scheduler=None
+):
+    """Print what run_full would do now, without doing any of it.
+
+    Lists and scans the trees exactly like run_full, then reports the
+    hard links it would create, the items it would upload (in scheduler
+    order) split into already on B2, server-side moves and copies,
+    archive volumes the archive policy skips, zip contents to stream,
+    archives to extract and plain uploads, and the completed/ items it
+    could then propagate to. No links are made, no rclone is
+    started and B2 is not contacted: the "already on B2" and server-side
+    move and copy checks use the cached bucket listing however old it is (and
+    without it every item counts as an upload). Nothing is written to the
+    state database, which the daemon may be using: files aren't hashed,
+    and hashes, item file keys and directory snapshots aren't cached. A
+    file with an object of the same size but no cached SHA1 is listed as
+    a possible copy and counted as an upload.
+    Files removed while planning are skipped.
+
+    The duration estimate divides the bytes to send by the throughput of
+    recent upload rounds (see record_throughput).
+
+    Returns a summary dict: links, on_b2, move, copy, skip, stream, extract
+    and upload (item counts), possible_copy (files), propagate (completed/
+    items), bytes and seconds (None until a throughput has been recorded).
+    """
+    category_dirs = {f"{completed_dir}/{subdir}" for subdir in subdirs}
+    import_dirs = [f"{import_base}/{subdir}" for subdir in subdirs]
+    tree = Tree([completed_dir] + import_dirs)
+    links = plan_links(completed_dir, import_base, subdirs, state, tree)
 
-    # Step 2: upload from import directories (nice names from *arr + manual links)
+    pending = []
     for subdir in subdirs:
         scan_import_dir(
             f"{import_base}/{subdir}",
             f"{subdir}/",
             b2_remote,
             extracted_dir,
+            state,
+            pending,
+            tree,
+            save=False,
         )
-
-    # Step 3: upload uncategorized downloads (torrent names)
     scan_completed_dir(
         completed_dir,
         "downloads/",
         b2_remote,
         extracted_dir,
         category_dirs,
+        state,
+        pending,
+        tree,
+    )
+    # Files the links would add, as the import dir scan would then find
+    # them (links keep the file names, so only the directories differ)
+    for item, item_links in links:
+        subdir = item.parent.name
+        for src, dst in item_links:
+            rel = dst.parent.relative_to(Path(import_base) / subdir).as_posix()
+            pending.append((src, f"{subdir}/" if rel == "." else f"{subdir}/{rel}/"))
+
+    state.load_manifest(math.inf)
+    if scheduler is None:
+        scheduler = Scheduler()
+
+    # action -> [(item, dest, bytes to send)]
+    actions = {
+        "on_b2": [],
+        "move": [],
+        "copy": [],
+        "skip": [],
+        "stream": [],
+        "extract": [],
+        "upload": [],
+    }
+    # (file, key) of files that may be copies of objects of the same size
+    possible = []
+    uploaded = set(state.uploads)
+    for item, b2_base in scheduler.order(pending):
+        dest = f"{b2_base}{item.name}"
+        item_tree = Tree([item])
+        size = 0
+        for f in item_tree.files(item):
+            f_st = item_tree.stat(f)
+            if f_st is not None:
+                size += f_st.st_size
+                uploaded.add(file_key(f_st))
+        if state.manifest is not None and manifest_has(state.manifest, item, dest):
+            actions["on_b2"].append((item, dest, 0))
+            continue
+        moved = {f for f, _, _, _ in bucket_moves(item, dest, state)}
+        # A renamed file's old object would also match as a copy source
+        copies = bucket_copies(item, dest, state, hash_files=False)
+        possible += [(f, key) for f, key, source in copies if source is None]
+        copied = {f for f, _, source in copies if source is not None} - moved
+        saved = files_size(moved | copied)
+        if (moved or copied) and saved == size:
+            actions["move" if moved else "copy"].append((item, dest, 0))
+            continue
+        size -= saved
+        archives = find_archives(item)
+        if archive_policy(b2_base) == "extracted":
+            if not archives and is_later_volume(item):
+                actions["skip"].append((item, dest, 0))
+                continue
+            if archives:
+                size = files_size(non_volume_files(item, archives))
+        # Archive items send their contents (and the original, see
+        # archive_policy)
+        action = "upload"
+        for archive in archives:
+            how, content = plan_archive(archive)
+            if action != "extract":
+                action = how
+            size += content
+        actions[action].append((item, dest, size))
+
+    propagate = []
+    for subdir in subdirs:
+        children = tree.listdir(Path(completed_dir) / subdir)
+        if children is None or not (Path(import_base) / subdir).exists():
+            continue
+        for child in children:
+            item = Path(child)
+            st = tree.stat(item)
+            if st is None or state.is_uploaded_stat(st):
+                continue
+            item_keys = completed_item_keys(item, st, state, tree, save=False)
+            if item_keys and item_keys <= uploaded:
+                propagate.append(item)
+
+    total = sum(size for entries in actions.values() for _, _, size in entries)
+    throughput = state.get_meta("upload_throughput")
+    seconds = total / float(throughput) if throughput else None
+
+    print(f"Link ({sum(len(item_links) for _, item_links in links)} files):")
+    for item, item_links in links:
+        print(f"  {item} -> {item_links[0][1].parent}/ ({len(item_links)} files)")
+    headings = {
+        "on_b2": "Already on B2 (listing match)",
+        "move": "Move server-side from the name before a rename",
+        "copy": "Copy server-side from identical objects",
+        "skip": "Archive volumes not uploaded (archive policy)",
+        "stream": "Stream zip contents and upload",
+        "extract": "Extract archives and upload",
+        "upload": "Upload",
+    }
+    for action, heading in headings.items():
+        print(f"{heading} ({len(actions[action])} items):")
+        for item, dest, size in actions[action]:
+            print(
+                f"  {dest}" if action == "on_b2" else f"  {dest} ({format_size(size)})"
+            )
+    if possible:
+        print(
+            f"Possible server-side copies ({len(possible)} files, same size as"
+            " an object, not hashed by --plan):"
+        )
+        for _, key in possible:
+            print(f"  {key}")
+    print(f"Propagate ({len(propagate)} items):")
+    for item in propagate:
+        print(f"  {item}")
+    if state.manifest is None:
+        print("No cached B2 listing: every item is counted as an upload")
+    if seconds is None:
+        print(f"Total: {format_size(total)}, no upload throughput recorded yet")
+    else:
+        print(
+            f"Total: {format_size(total)}, about {format_duration(seconds)}"
+            f" at {format_size(float(throughput))}/s"
+        )
+
+    return {
+        "links": sum(len(item_links) for _, item_links in links),
+        **{action: len(entries) for action, entries in actions.items()},
+        "possible_copy": len(possible),
+        "propagate": len(propagate),
+        "bytes": total,
+        "seconds": seconds,
+    }
+
+
+def finish_run(ok):
+    """Publish the outcome of a run in the metrics file and print its phases."""
+    if ok:
+        METRICS.set("qbt_upload_last_success_timestamp_seconds", time.time())
+    METRICS.write()
+    PHASES.report("Upload run")
+
+
+def run_full(
+    completed_dir,
+    import_base,
+    subdirs,
+    b2_remote,
+    extracted_dir,
+    state,
+    workers,
+    budget,
+    scheduler=None,
+    pool=None,
+):
+    """Run every step over the whole tree. Returns True if all uploads succeeded.
+
+    completed/ and the import dirs are listed once (walk.Tree) and every
+    step works from that listing.
+    """
+    category_dirs = {f"{completed_dir}/{subdir}" for subdir in subdirs}
+    import_dirs = [f"{import_base}/{subdir}" for subdir in subdirs]
+    with PHASES.phase("list"):
+        tree = Tree([completed_dir] + import_dirs)
+    PHASES.count("list", entries=len(tree.entries))
+
+    # Step 1: hard link manual category items to import dirs
+    link_to_import_dir(completed_dir, import_base, subdirs, state, tree)
+
+    # Items from steps 2 and 3 are collected here and uploaded together
+    pending = []
+
+    with PHASES.phase("scan"):
+        # Step 2: upload from import directories (nice names from *arr + manual links)
+        for subdir in subdirs:
+            scan_import_dir(
+                f"{import_base}/{subdir}",
+                f"{subdir}/",
+                b2_remote,
+                extracted_dir,
+                state,
+                pending,
+                tree,
+            )
+
+        # Step 3: upload uncategorized downloads (torrent names)
+        scan_completed_dir(
+            completed_dir,
+            "downloads/",
+            b2_remote,
+            extracted_dir,
+            category_dirs,
+            state,
+            pending,
+            tree,
+        )
+    PHASES.count("scan", entries=len(pending))
+    # Behind the jobs of rounds started by events (see JobPool)
+    ok = upload_pending(
+        pending,
+        b2_remote,
+        extracted_dir,
+        state,
+        workers,
+        budget,
+        scheduler,
+        pool,
+        priority=1,
+    )
+
+    # Step 4: propagate upload status from import dirs to completed/ items
+    # (uploads only add state records, so the listing is still current)
+    propagate_markers(completed_dir, import_base, subdirs, state, tree)
+    finish_run(ok)
+    return ok
+
+
+def collect_changed(paths, completed_dir, import_base, subdirs, state, pending):
+    """Turn changed paths reported by inotify into pending uploads.
+
+    Maps each path to the item a full scan would have found for it:
+      - /media/arr/<subdir>/... → the file itself (or every file below a
+        new directory), with b2_base mirroring its parent directories
+      - completed/<name>/... (uncategorized) → the top-level completed/<name>
+      - completed/<subdir>/... → nothing to upload directly; the item has
+        to be linked into the import dir first
+    Paths that no longer exist (deleted, renamed away) are ignored.
+
+    Returns True if anything below a completed/<subdir>/ changed, meaning
+    the link step should run.
+    """
+    completed = Path(completed_dir)
+    queued = {item for item, _ in pending}
+    link_needed = False
+
+    def add(item, b2_base):
+        if item not in queued:
+            queued.add(item)
+            pending.append((item, b2_base))
+
+    for path in map(Path, paths):
+        for subdir in subdirs:
+            root = Path(import_base) / subdir
+            if path.is_relative_to(root) and path != root:
+                parent = path.parent.relative_to(root).as_posix()
+                b2_base = f"{subdir}/" if parent == "." else f"{subdir}/{parent}/"
+                try:
+                    st = path.stat()
+                except OSError:
+                    break
+                if stat.S_ISDIR(st.st_mode):
+                    found = []
+                    scan_import_dir(
+                        path, f"{b2_base}{path.name}/", None, None, state, found
+                    )
+                    for entry in found:
+                        add(*entry)
+                elif not state.is_uploaded_stat(st, f"{b2_base}{path.name}"):
+                    add(path, b2_base)
+                break
+        else:
+            if not path.is_relative_to(completed) or path == completed:
+                continue
+            top = completed / path.relative_to(completed).parts[0]
+            if top.name in subdirs:
+                link_needed = link_needed or path != top
+                continue
+            if top.exists() and not state.is_uploaded(top, f"downloads/{top.name}"):
+                add(top, "downloads/")
+    return link_needed
+
+
+def run_changed(
+    paths,
+    completed_dir,
+    import_base,
+    subdirs,
+    b2_remote,
+    extracted_dir,
+    state,
+    workers,
+    budget,
+    scheduler=None,
+    pool=None,
+):
+    """Run the steps for a set of changed paths only.
+
+    Links new manual items if a category dir changed (the links show up as
+    new inotify events and are uploaded on the next round), uploads the
+    changed items, then propagates upload status to completed/. Returns
+    True if all uploads succeeded.
+    """
+    pending = []
+    with PHASES.phase("scan"):
+        link_needed = collect_changed(
+            paths, completed_dir, import_base, subdirs, state, pending
+        )
+    PHASES.count("scan", entries=len(pending))
+    if link_needed:
+        link_to_import_dir(completed_dir, import_base, subdirs, state)
+    ok = True
+    if pending:
+        ok = upload_pending(
+            pending, b2_remote, extracted_dir, state, workers, budget, scheduler, pool
+        )
+    if pending or link_needed:
+        propagate_markers(completed_dir, import_base, subdirs, state)
+    finish_run(ok)
+    return ok
+
+
+def run_completed(
+    completions,
+    completed_dir,
+    import_base,
+    subdirs,
+    b2_remote,
+    extracted_dir,
+    state,
+    workers,
+    budget,
+    scheduler=None,
+    pool=None,
+):
+    """Link and upload the items of torrents qBittorrent just finished.
+
+    completions are (hash, category, content path) from hook.py. An item
+    of a manual category (MANUAL_CATEGORIES) is hard linked into its
+    import dir if it needs linking, as the link step would (see
+    item_links), and the links are uploaded. An uncategorized item is
+    uploaded from completed/. Either way it goes through run_changed
+    without waiting for the debounce, since a finished torrent's files are
+    complete. Items of other categories are left alone: Sonarr/Radarr
+    haven't imported them yet, and linking them under the release name
+    would upload a second copy next to the one they import (their webhook
+    and inotify pick up the import). Returns True if all uploads
+    succeeded.
+    """
+    completed = Path(completed_dir)
+    changed = []
+    for info_hash, category, path in completions:
+        path = Path(path)
+        print(f"Torrent finished: {path.name} ({category or 'no category'})")
+        if not path.is_relative_to(completed) or path == completed:
+            print(f"Not under {completed_dir}, left to the scans: {info_hash}")
+            continue
+        parts = path.relative_to(completed).parts
+        if parts[0] not in subdirs:
+            changed.append(path)
+            continue
+        if len(parts) < 2:
+            continue
+        if category not in MANUAL_CATEGORIES:
+            print(f"Left for Sonarr/Radarr to import: {path.name}")
+            continue
+        item = completed / parts[0] / parts[1]
+        tree = Tree([item])
+        links = item_links(item, Path(import_base) / parts[0], state, tree)
+        if links:
+            make_links(item, links, tree)
+            changed.extend(dst for _, dst in links)
+    if not changed:
+        return True
+    return run_changed(
+        changed,
+        completed_dir,
+        import_base,
+        subdirs,
+        b2_remote,
+        extracted_dir,
+        state,
+        workers,
+        budget,
+        scheduler,
+        pool,
     )
 
-    # Step 4: propagate .uploaded markers from import dirs to completed/ items
-    propagate_markers(completed_dir, import_base, subdirs)
+
+def object_key(path, import_base, subdirs):
+    """Return the object name a file in an import dir is uploaded to.
+
+    /media/arr/tv/Show/Season 1/ep.mkv -> "tv/Show/Season 1/ep.mkv";
+    None for paths outside the import dirs.
+    """
+    path = Path(path)
+    for subdir in subdirs:
+        root = Path(import_base) / subdir
+        if path.is_relative_to(root) and path != root:
+            return f"{subdir}/{path.relative_to(root).as_posix()}"
+    return None
+
+
+def retire_objects(paths, keep, import_base, subdirs, b2_remote, state):
+    """Delete the B2 objects of import dir files Sonarr/Radarr replaced.
+
+    paths are the files an upgrade deleted (webhook deletedFiles). Their
+    objects would otherwise stay next to the new release, and Jellyfin,
+    which also reads /media/b2, would list both. Objects named in keep
+    (where the new files go, e.g. an upgrade with the same file name) are
+    left alone, as are paths that still exist locally and, with a cached
+    listing, objects it doesn't have unless they were uploaded after it was
+    fetched. The listing, the records of the deleted paths and the B2
+    mount follow. Returns the number deleted.
+    """
+    retired = 0
+    dirs = []
+    for path in paths:
+        key = object_key(path, import_base, subdirs)
+        if key is None or key in keep or os.path.lexists(path):
+            continue
+        if state.manifest is not None and key not in state.manifest:
+            uploaded_at = state.uploaded_at(path, key)
+            fetched_at = state.get_meta("manifest_fetched_at")
+            if uploaded_at is None or (
+                fetched_at is not None and uploaded_at < int(float(fetched_at))
+            ):
+                continue
+        if not server_delete(b2_remote, key):
+            continue
+        state.remove_object(key)
+        state.forget(path)
+        METRICS.inc("qbt_upload_retired_objects_total", category=key.partition("/")[0])
+        print(f"Deleted from B2 (replaced): {key}")
+        dirs.append(str(PurePosixPath(key).parent))
+        retired += 1
+    refresh_mount(dirs)
+    return retired
+
+
+def run_webhook(
+    events,
+    completed_dir,
+    import_base,
+    subdirs,
+    b2_remote,
+    extracted_dir,
+    state,
+    workers,
+    budget,
+    scheduler=None,
+    pool=None,
+):
+    """Act on Sonarr/Radarr webhook events (see webhook.py).
+
+    Files an upgrade replaced are deleted from B2 (see retire_objects),
+    then the imported files go through run_changed without waiting for
+    the debounce: Sonarr/Radarr hard link complete files, and name every
+    one, so nothing is walked. Renamed files are moved server-side from
+    their old objects there (see bucket_moves). Returns True if all
+    uploads succeeded.
+    """
+    imported = []
+    for event, new, old in events:
+        print(f"Webhook {event}: {len(new)} imported, {len(old)} replaced")
+        keep = {object_key(path, import_base, subdirs) for path in new}
+        retire_objects(old, keep, import_base, subdirs, b2_remote, state)
+        imported.extend(new)
+    if not imported:
+        return True
+    return run_changed(
+        imported,
+        completed_dir,
+        import_base,
+        subdirs,
+        b2_remote,
+        extracted_dir,
+        state,
+        workers,
+        budget,
+        scheduler,
+        pool,
+    )
+
+
+@contextmanager
+def daemon_round(name):
+    """Log an exception from one daemon round instead of ending the daemon.
+
+    Restarting would only run the startup full scan into the same failure
+    (e.g. a corrupt archive) and drop hook and webhook events meanwhile.
+    """
+    try:
+        yield
+    except Exception:
+        print(f"{name} failed, continuing:")
+        traceback.print_exc()
+
+
+def run_daemon(
+    completed_dir,
+    import_base,
+    subdirs,
+    b2_remote,
+    extracted_dir,
+    state,
+    workers,
+    budget,
+    manifest_max_age,
+    debounce,
+    rescan_interval,
+    scheduler=None,
+    hook_socket=None,
+    webhook_addr=None,
+):
+    """Watch the import and completed trees and upload changes as they happen.
+
+    Changed paths are debounced (see watch.Debouncer) and then handed to
+    run_changed. Completions qBittorrent sends to hook_socket (hook.py)
+    skip the debounce and go to run_completed as soon as they arrive, and
+    Sonarr/Radarr events posted to webhook_addr (webhook.py) go to
+    run_webhook; the inotify events they cause later find the items
+    already uploaded.
+    A full run_full pass still happens at startup, every
+    rescan_interval seconds, and whenever the kernel drops events, as a
+    safety net for anything inotify missed. The in-memory state and the
+    B2 listing are reloaded before each full pass, picking up records
+    cleanup.py removed in the meantime. A round that fails is logged and
+    the daemon carries on (see daemon_round).
+
+    Each round runs on its own thread and queues its uploads on one
+    JobPool of `workers` threads, so the loop keeps reading events while
+    uploads run: a torrent finishing during a long full pass is uploaded
+    ahead of the pass's backlog instead of after it. Only one full pass
+    runs at a time; one that is due waits for the last to end. Rounds
+    running at once share the phase report (see phases.py).
+    """
+    args = (completed_dir, import_base, subdirs, b2_remote, extracted_dir, state)
+    watcher = Inotify()
+    watcher.add_tree(completed_dir)
+    for subdir in subdirs:
+        watcher.add_tree(f"{import_base}/{subdir}")
+    print(f"Watching {len(watcher.watches)} directories")
+    hooks = HookListener(hook_socket) if hook_socket else None
+    webhooks = WebhookServer(webhook_addr) if webhook_addr else None
+    sources = [source for source in (hooks, webhooks) if source is not None]
+    pool = JobPool(workers)
+    round_args = (workers, budget, scheduler, pool)
+
+    def start_round(name, func, *func_args):
+        def run():
+            with daemon_round(name):
+                func(*func_args)
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def full_pass():
+        state.reload()
+        refresh_manifest(state, b2_remote, manifest_max_age)
+        cancel_abandoned_uploads(state, b2_remote)
+        run_full(*args, *round_args)
+
+    debouncer = Debouncer(debounce)
+    next_rescan = 0
+    # Thread of the full pass while one runs
+    rescan = None
+    while True:
+        now = time.monotonic()
+        if rescan is not None and not rescan.is_alive():
+            rescan = None
+        if now >= next_rescan and rescan is None:
+            print("Full rescan")
+            # Everything changed so far is covered by the full pass
+            debouncer.pending.clear()
+            rescan = start_round("Full rescan", full_pass)
+            next_rescan = now + rescan_interval
+            continue
+
+        ready = debouncer.ready(now)
+        if ready:
+            print(f"Changed: {len(ready)} paths")
+            start_round(
+                "Upload of changed paths", run_changed, ready, *args, *round_args
+            )
+            continue
+
+        due = debouncer.next_due()
+        rescan_at = (
+            next_rescan if rescan is None else max(next_rescan, now + RESCAN_POLL)
+        )
+        timeout = rescan_at - now if due is None else min(due, rescan_at) - now
+        if sources:
+            ready, _, _ = select.select([watcher.fd, *sources], [], [], max(0, timeout))
+            if hooks in ready:
+                start_round(
+                    "Upload of finished torrents",
+                    run_completed,
+                    hooks.receive(),
+                    *args,
+                    *round_args,
+                )
+            if webhooks in ready:
+                start_round(
+                    "Webhook round", run_webhook, webhooks.receive(), *args, *round_args
+                )
+            timeout = 0
+        paths, overflow = watcher.read(timeout)
+        if overflow:
+            print("inotify queue overflowed, rescanning")
+            next_rescan = 0
+        now = time.monotonic()
+        for path in paths:
+            debouncer.add(path, now)
+
+
+def main():
+    global ARCHIVE_POLICY, BANDWIDTH
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and upload changes as inotify reports them",
+    )
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="print what the next run would link, upload and propagate, and exit",
+    )
+    args = parser.parse_args()
+
+    completed_dir = os.environ["COMPLETED_DIR"]
+    extracted_dir = os.environ["EXTRACTED_DIR"]
+    import_base = os.environ["IMPORT_BASE"]
+    b2_remote = os.environ["B2_REMOTE"]
+    categories = parse_categories(os.environ["CATEGORIES"])
+    state_db = os.environ["STATE_DB"]
+    manifest_max_age = int(os.environ["MANIFEST_MAX_AGE"])
+    workers = int(os.environ["UPLOAD_WORKERS"])
+    max_transfers = int(os.environ["MAX_TRANSFERS"])
+
+    # Deduplicate subdirs — multiple categories can map to the same subdir
+    # (e.g. tv-sonarr and tv both map to "tv")
+    subdirs = sorted(set(categories.values()))
+
+    ARCHIVE_POLICY = parse_archive_policy(os.environ.get("ARCHIVE_POLICY", ""))
+    # --plan leaves legacy markers for the upload service to import
+    state = open_state(
+        state_db, completed_dir, import_base, subdirs, import_markers=not args.plan
+    )
+    run_args = (completed_dir, import_base, subdirs, b2_remote, extracted_dir, state)
+    scheduler = Scheduler(
+        os.environ["UPLOAD_POLICY"],
+        float(os.environ["UPLOAD_MIN_FREE"]) / 100,
+        float(os.environ["MIN_SEEDING_HOURS"]) * 3600,
+    )
+    if args.plan:
+        # Leaves extracted/ alone: the daemon may be extracting into it
+        plan_run(*run_args, scheduler)
+        state.close()
+        return
+
+    clear_extracted_dir(extracted_dir)
+    budget = TransferBudget(max_transfers, workers)
+    BANDWIDTH = BandwidthController(
+        parse_timetable(os.environ["UPLOAD_BWLIMIT"]),
+        parse_rate(os.environ["UPLINK_RATE"]),
+        parse_rate(os.environ["UPLOAD_MIN_RATE"]) or 0,
+        parse_rate(os.environ["MOUNT_BUSY_RATE"]),
+        os.environ.get("QBT_API_URL"),
+        MOUNT_RC_URL,
+        RC_URL,
+    )
+    BANDWIDTH.start()
+
+    if args.daemon:
+        run_daemon(
+            *run_args,
+            workers,
+            budget,
+            manifest_max_age,
+            float(os.environ["UPLOAD_DEBOUNCE"]),
+            float(os.environ["RESCAN_INTERVAL"]),
+            scheduler,
+            os.environ.get("HOOK_SOCKET"),
+            os.environ.get("WEBHOOK_ADDR"),
+        )
+    else:
+        refresh_manifest(state, b2_remote, manifest_max_age)
+        cancel_abandoned_uploads(state, b2_remote)
+        run_full(*run_args, workers, budget, scheduler)
+    state.close()
 
 
 if __name__ == "__main__":
-    main()
+    with profiled(os.environ.get("PROFILE_FILE")):
+        main()
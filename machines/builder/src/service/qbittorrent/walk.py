@@ -0,0 +1,174 @@
+"""Single-pass directory tree snapshot shared by the steps of one run.
+
+Upload and cleanup each look at completed/ and the import dirs several
+times per run (linking, scanning, propagation; inode matching, sibling
+cleanup, pruning). Instead of every step walking with rglob and calling
+is_file() and os.stat() per entry, a run lists each directory once with
+os.scandir and every step queries that listing.
+
+File types come from the directory listing itself (d_type), so building
+the snapshot costs one getdents per directory. Stat results (inode, link
+count, size, mtime) are fetched on first use and cached on the DirEntry,
+so each entry is stat'ed at most once per run — and not at all if no step
+needs it.
+
+Steps that change the tree (linking, deleting) report it via add() and
+remove() so later steps see the current state.
+
+With recursive=False only the top level of each root is listed, for
+callers that look at the entries of a directory but rarely inside them.
+"""
+
+import os
+import stat
+
+
+def _key(path):
+    return os.fspath(path).rstrip("/") or "/"
+
+
+class Tree:
+    """In-memory listing of one or more directory trees."""
+
+    def __init__(self, roots, recursive=True):
+        self.roots = [_key(root) for root in roots]
+        self.recursive = recursive
+        # path -> os.DirEntry for everything below a root
+        self.entries = {}
+        # directory path -> sorted child paths
+        self.children = {}
+        # stat results for roots, added paths (no DirEntry for those) and
+        # paths outside the roots
+        self.stats = {}
+        for root in self.roots:
+            self._scan(root)
+
+    def _scan(self, directory):
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            return
+        self.children[directory] = [entry.path for entry in entries]
+        for entry in entries:
+            self.entries[entry.path] = entry
+            try:
+                # Don't follow symlinked directories (same as rglob)
+                if self.recursive and entry.is_dir(follow_symlinks=False):
+                    self._scan(entry.path)
+            except OSError:
+                continue
+
+    def covers(self, path):
+        """Check whether path lies inside one of the snapshot's roots."""
+        path = _key(path)
+        return any(path == root or path.startswith(f"{root}/") for root in self.roots)
+
+    def stat(self, path):
+        """Return os.stat() of path (following symlinks), or None."""
+        path = _key(path)
+        entry = self.entries.get(path)
+        try:
+            if entry is not None:
+                return entry.stat()
+            if path not in self.stats:
+                if self.covers(path) and path not in self.roots:
+                    # Inside the snapshot but not in it: doesn't exist
+                    return None
+                self.stats[path] = os.stat(path)
+            return self.stats[path]
+        except OSError:
+            return None
+
+    def exists(self, path):
+        """Check whether path exists.
+
+        Answered from the snapshot for paths inside a root, from the
+        filesystem otherwise.
+        """
+        path = _key(path)
+        if not self.covers(path):
+            return os.path.lexists(path)
+        return path in self.entries or path in self.children or path in self.stats
+
+    def is_dir(self, path):
+        """Check whether path is a directory (symlinks to dirs aren't)."""
+        return _key(path) in self.children
+
+    def is_file(self, path):
+        path = _key(path)
+        entry = self.entries.get(path)
+        if entry is not None:
+            try:
+                return entry.is_file()
+            except OSError:
+                return False
+        st = self.stat(path)
+        return st is not None and stat.S_ISREG(st.st_mode)
+
+    def listdir(self, path):
+        """Return the sorted child paths of directory path, or None."""
+        children = self.children.get(_key(path))
+        return None if children is None else list(children)
+
+    def files(self, path):
+        """Return every file at or below path, depth first, sorted."""
+        path = _key(path)
+        if path not in self.children:
+            return [path] if self.is_file(path) else []
+        found = []
+        for child in self.children[path]:
+            found.extend(self.files(child))
+        return found
+
+    def dirs(self, path):
+        """Return every directory strictly below path."""
+        found = []
+        for child in self.children.get(_key(path), []):
+            if child in self.children:
+                found.append(child)
+                found.extend(self.dirs(child))
+        return found
+
+    def add(self, path):
+        """Record a file created during the run, with any new parent dirs."""
+        path = _key(path)
+        try:
+            self.stats[path] = os.stat(path)
+        except OSError:
+            return
+        self._attach(path)
+
+    def add_dir(self, path):
+        """Record a directory created during the run."""
+        path = _key(path)
+        if path not in self.children:
+            self.children[path] = []
+            try:
+                self.stats[path] = os.stat(path)
+            except OSError:
+                pass
+            self._attach(path)
+
+    def _attach(self, path):
+        if path in self.roots:
+            return
+        parent = os.path.dirname(path)
+        if not self.covers(parent):
+            return
+        self.add_dir(parent)
+        siblings = self.children[parent]
+        if path not in siblings:
+            siblings.append(path)
+            siblings.sort()
+
+    def remove(self, path):
+        """Forget path and everything below it (deleted during the run)."""
+        path = _key(path)
+        for child in self.children.pop(path, []):
+            self.remove(child)
+        self.entries.pop(path, None)
+        self.stats.pop(path, None)
+        siblings = self.children.get(os.path.dirname(path))
+        if siblings is not None and path in siblings:
+            siblings.remove(path)
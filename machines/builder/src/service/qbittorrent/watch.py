@@ -0,0 +1,204 @@
+"""inotify watching for the upload daemon (upload.py --daemon).
+
+A thin ctypes wrapper around the Linux inotify API (no third-party
+dependency), watching whole directory trees, plus a Debouncer that holds
+changed paths back until they've been quiet for a while — Sonarr/Radarr
+imports arrive as a burst of creates and writes, and a file being copied
+in must not be uploaded half-written. An EventQueue carries events
+received on other threads (hook.py, webhook.py) into the same loop.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+# Everything that can make an item appear or change. Hard links from
+# Sonarr/Radarr only produce IN_CREATE; copies end with IN_CLOSE_WRITE;
+# IN_MODIFY keeps a file that is still being written from going quiet.
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_ONLYDIR
+    | IN_DONT_FOLLOW
+    | IN_EXCL_UNLINK
+)
+
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """Recursive inotify watch over one or more directory trees.
+
+    New subdirectories are watched as soon as their creation is read, so
+    a season folder created by Sonarr is covered before its episodes land.
+    Anything created inside it before the watch was added is reported by
+    read() as well, by listing the new directory.
+    """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # watch descriptor -> directory path
+        self.watches = {}
+
+    def close(self):
+        os.close(self.fd)
+
+    def add_watch(self, path):
+        """Watch one directory. Returns False if it can't be watched."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                print(f"inotify watch limit reached, not watching: {path}")
+            elif err != errno.ENOENT:
+                print(f"Cannot watch {path}: {os.strerror(err)}")
+            return False
+        self.watches[wd] = str(path)
+        return True
+
+    def add_tree(self, root):
+        """Watch root and every directory below it.
+
+        Returns the files found inside the newly watched directories.
+        """
+        found = []
+        if not self.add_watch(root):
+            return found
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in dirnames:
+                self.add_watch(os.path.join(dirpath, name))
+            found.extend(os.path.join(dirpath, name) for name in filenames)
+        return found
+
+    def read(self, timeout):
+        """Wait up to timeout seconds for events.
+
+        Returns (paths, overflow): the paths that were created or changed,
+        and whether the kernel queue overflowed (events were lost, so the
+        caller should fall back to a full scan).
+        """
+        ready, _, _ = select.select([self.fd], [], [], max(0, timeout))
+        if not ready:
+            return [], False
+
+        paths = []
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & IN_IGNORED:
+                    # Directory deleted or moved away — the kernel dropped it
+                    self.watches.pop(wd, None)
+                    continue
+                parent = self.watches.get(wd)
+                if parent is None or not name:
+                    continue
+
+                path = os.path.join(parent, os.fsdecode(name))
+                paths.append(path)
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    paths.extend(self.add_tree(path))
+        return paths, overflow
+
+
+class Debouncer:
+    """Holds changed paths until they've seen no events for `delay` seconds.
+
+    A file still being copied in keeps producing IN_MODIFY, so it isn't
+    released until the copy has finished.
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        # path -> time of the last event
+        self.pending = {}
+
+    def add(self, path, now):
+        self.pending[path] = now
+
+    def next_due(self):
+        """Time at which the next path becomes ready, or None if idle."""
+        if not self.pending:
+            return None
+        return min(self.pending.values()) + self.delay
+
+    def ready(self, now):
+        """Remove and return the paths that are due at time now."""
+        due = sorted(
+            path for path, last in self.pending.items() if last + self.delay <= now
+        )
+        for path in due:
+            del self.pending[path]
+        return due
+
+
+class EventQueue:
+    """Events put by background threads, for the daemon's select loop.
+
+    fileno() is readable while events are queued (a pipe holding one byte
+    then), so the daemon waits on it together with inotify, and get_all()
+    takes them all.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+        self.read_fd, self.write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+
+    def fileno(self):
+        return self.read_fd
+
+    def put(self, event):
+        with self.lock:
+            self.events.append(event)
+            if len(self.events) == 1:
+                os.write(self.write_fd, b"\0")
+
+    def get_all(self):
+        """Remove and return every queued event, oldest first."""
+        with self.lock:
+            events, self.events = self.events, []
+            if events:
+                os.read(self.read_fd, 1)
+        return events
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
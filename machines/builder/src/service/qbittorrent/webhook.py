@@ -0,0 +1,125 @@
+"""Sonarr/Radarr webhook receiver for the upload daemon.
+
+Sonarr and Radarr post a JSON event to a Webhook connection when they
+import a file, replace one with a better release, or rename files. The
+payload has the exact paths under their root folders (/media/arr/tv,
+/media/arr/movies), so the daemon can upload what was just imported
+without waiting for inotify's debounce or walking the tree, and delete
+the B2 objects of files an upgrade replaced.
+
+The server is a plain http.server on localhost, serving on threads of
+its own (see WebhookServer): requests are answered at once, whatever the
+daemon is doing, and the events queued for the daemon to process after.
+
+Events used (Sonarr v3/v4 and Radarr payloads):
+  Download - "On Import" and "On Upgrade": episodeFile / episodeFiles /
+             movieFile are imported, deletedFiles were replaced
+  Rename   - renamedEpisodeFiles / renamedMovieFiles: the new paths are
+             imported (upload.py moves the old objects server-side)
+  Test     - the "Test" button; accepted and ignored
+"""
+
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from watch import EventQueue
+
+# Largest request body accepted; import events are a few KB
+MAX_BODY = 1024 * 1024
+
+
+def _file_path(f, root):
+    """Absolute path of a file object from a payload."""
+    if f.get("path"):
+        return f["path"]
+    if root and f.get("relativePath"):
+        return os.path.join(root, f["relativePath"])
+    return None
+
+
+def parse_event(payload):
+    """Return (imported, deleted) paths of a Sonarr/Radarr webhook payload.
+
+    Both are empty for events that don't change files (Test, Grab,
+    Health, ...).
+    """
+    event = payload.get("eventType")
+    root = (payload.get("series") or {}).get("path") or (
+        payload.get("movie") or {}
+    ).get("folderPath")
+    imported = []
+    deleted = []
+    if event == "Download":
+        files = payload.get("episodeFiles") or []
+        for key in ("episodeFile", "movieFile"):
+            if payload.get(key):
+                files.append(payload[key])
+        imported = [_file_path(f, root) for f in files]
+        deleted = [_file_path(f, root) for f in payload.get("deletedFiles") or []]
+    elif event == "Rename":
+        for key in ("renamedEpisodeFiles", "renamedMovieFiles"):
+            imported.extend(_file_path(f, root) for f in payload.get(key) or [])
+    return [p for p in imported if p], [p for p in deleted if p]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Don't let a client that stops sending hold a thread forever
+    timeout = 10
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length > MAX_BODY:
+                raise ValueError(f"body too large ({length} bytes)")
+            payload = json.loads(self.rfile.read(length))
+            imported, deleted = parse_event(payload)
+        except (ValueError, AttributeError, TypeError) as e:
+            print(f"Ignoring bad webhook request: {e}")
+            self.send_response(400)
+            self.end_headers()
+            return
+        if imported or deleted:
+            self.server.events.put((payload.get("eventType"), imported, deleted))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        # Events are logged by the daemon when it processes them
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+class WebhookServer:
+    """HTTP listener for Sonarr/Radarr webhooks at addr ("host:port").
+
+    Serves from a background thread, a thread per request. Events wait in
+    an EventQueue: fileno() lets the daemon wait on it together with
+    inotify, and receive() returns the events queued so far as (event
+    type, imported paths, deleted paths).
+    """
+
+    def __init__(self, addr):
+        host, _, port = addr.rpartition(":")
+        self.server = _Server((host or "127.0.0.1", int(port)), _Handler)
+        self.server.events = EventQueue()
+        self.server_address = self.server.server_address
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="webhook", daemon=True
+        )
+        self.thread.start()
+
+    def fileno(self):
+        return self.server.events.fileno()
+
+    def receive(self):
+        return self.server.events.get_all()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.events.close()
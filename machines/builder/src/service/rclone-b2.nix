@@ -41,6 +41,8 @@
       # All RC endpoints require POST. Useful ones:
       #   curl -X POST localhost:5572/vfs/stats    — cache size, open files
       #   curl -X POST localhost:5572/core/stats   — active transfers, bandwidth
+      # qbt-upload-b2 calls vfs/refresh here for the directories it uploads to,
+      # so new content appears without waiting for --dir-cache-time.
       #
       # Transfer logging:
       # Logs transfer stats every 30s, visible via: journalctl -u rclone-b2-mount -f
@@ -9,8 +9,11 @@
 # 3. Set root folder to /media/arr/tv — Sonarr will hard link completed
 #    downloads here with clean names. The upload script reads from
 #    this directory to upload with nice names to B2.
-# 4. Prowlarr will sync indexers automatically once configured there
-# 5. Series > Add New > search for a show, select episodes, hit Search
+# 4. Settings > Connect > Add > Webhook, URL http://localhost:5574/,
+#    On Import, On Upgrade, On Rename — the upload daemon uploads imports
+#    right away and drops replaced files from B2
+# 5. Prowlarr will sync indexers automatically once configured there
+# 6. Series > Add New > search for a show, select episodes, hit Search
 { ... }:
 {
   services.sonarr = {
@@ -31,6 +31,15 @@ in
           }
         ];
       }
+      {
+        # node_exporter on builder (over Tailscale), incl. qbt-upload-b2 metrics
+        job_name = "builder";
+        static_configs = [
+          {
+            targets = [ "builder:9100" ];
+          }
+        ];
+      }
     ];
   };
 